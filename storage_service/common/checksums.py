@@ -0,0 +1,271 @@
+"""Checksums.
+
+Helpers for computing checksums of package contents while they are being
+copied, so that spaces don't have to read a file a second time (or a third
+time) just to hash it. A :class:`MultiHash` accumulates several digests of the
+same byte stream at once, and :class:`HashingReader` and
+:class:`HashingWriter` feed it from the bytes flowing through a file object.
+
+When a file on disk does have to be hashed, :func:`hash_file` reads it once
+with large reusable buffers and computes every requested algorithm in that
+pass, and :func:`hash_files` does the same for many files using a pool of
+threads (hashlib releases the GIL while it digests large buffers).
+
+"""
+
+from __future__ import absolute_import
+
+# stdlib, alphabetical
+from collections import OrderedDict
+import hashlib
+import io
+import mmap
+import os
+
+# Core Django, alphabetical
+from django.utils import six
+
+# Third party dependencies, alphabetical
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size of the reads done by ``copyfileobj``: 1 MiB.
+BUFFER_SIZE = 1024 * 1024
+
+# Size of the reads done by ``hash_file``: 4 MiB, a multiple of the page size
+# so that reads and mmap windows stay page aligned.
+FILE_BUFFER_SIZE = 4 * 1024 * 1024 // mmap.PAGESIZE * mmap.PAGESIZE
+
+# Default number of threads used by ``hash_files``.
+MAX_WORKERS = 4
+
+
+class MultiHash(object):
+    """Compute the digests of several algorithms in a single pass.
+
+    >>> hasher = MultiHash(["md5", "sha256"])
+    >>> hasher.update(b"data")
+    >>> hasher.hexdigest("md5")
+    '8d777f385d3dfec8815d20f7496026dc'
+
+    If an algorithm is not supported, ValueError is raised by hashlib.
+    """
+
+    def __init__(self, algorithms):
+        if isinstance(algorithms, six.string_types):
+            algorithms = [algorithms]
+        self._hashes = OrderedDict(
+            (algorithm, hashlib.new(algorithm)) for algorithm in algorithms
+        )
+
+    @property
+    def algorithms(self):
+        return list(self._hashes)
+
+    def __getitem__(self, algorithm):
+        """Return the hashlib object for ``algorithm``."""
+        return self._hashes[algorithm]
+
+    def __contains__(self, algorithm):
+        return algorithm in self._hashes
+
+    def update(self, data):
+        for checksum in self._hashes.values():
+            checksum.update(data)
+
+    def reset(self):
+        """Discard everything hashed so far."""
+        for algorithm in self._hashes:
+            self._hashes[algorithm] = hashlib.new(algorithm)
+
+    def hexdigest(self, algorithm):
+        return self._hashes[algorithm].hexdigest()
+
+    def hexdigests(self):
+        """Return a dict of ``{algorithm: hexdigest}``."""
+        return {
+            algorithm: checksum.hexdigest()
+            for algorithm, checksum in self._hashes.items()
+        }
+
+
+class HashingReader(object):
+    """Read-only file object wrapper that hashes everything read through it.
+
+    It reports itself as not seekable, so that consumers like boto3's
+    transfer manager read it sequentially instead of in ranges. It can still
+    be rewound to its starting position with ``reset`` (which also restarts
+    the hashes), which swiftclient uses to retry a failed upload.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self._fileobj = fileobj
+        self.hasher = hasher
+        self.bytes_read = 0
+        try:
+            self._start = fileobj.tell()
+        except (AttributeError, IOError, OSError):
+            self._start = None
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.hasher.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def seekable(self):
+        return False
+
+    def reset(self):
+        if self._start is None:
+            raise IOError("Unable to rewind %r" % self._fileobj)
+        self._fileobj.seek(self._start)
+        self.hasher.reset()
+        self.bytes_read = 0
+
+    def close(self):
+        self._fileobj.close()
+
+
+class HashingWriter(object):
+    """Write-only file object wrapper that hashes everything written to it.
+
+    Like :class:`HashingReader`, it is not seekable, so the data must be
+    written in order.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self._fileobj = fileobj
+        self.hasher = hasher
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.bytes_written += len(data)
+        return self._fileobj.write(data)
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def close(self):
+        self._fileobj.close()
+
+
+def copyfileobj(src, dst, hasher, length=BUFFER_SIZE):
+    """Copy ``src`` to ``dst`` like ``shutil.copyfileobj``, hashing the data
+    with ``hasher`` on the way through.
+
+    :returns: Number of bytes copied.
+    """
+    copied = 0
+    while True:
+        buf = src.read(length)
+        if not buf:
+            break
+        hasher.update(buf)
+        dst.write(buf)
+        copied += len(buf)
+    return copied
+
+
+def hasher_for(package, *algorithms):
+    """Return a :class:`MultiHash` for ``algorithms`` plus any algorithms
+    ``package`` wants recorded while it is moved (see
+    ``Package.transfer_checksum_algorithms``).
+    """
+    algorithms = list(algorithms)
+    for algorithm in getattr(package, "transfer_checksum_algorithms", ()):
+        if algorithm not in algorithms:
+            algorithms.append(algorithm)
+    return MultiHash(algorithms)
+
+
+def record_transfer_checksums(package, hasher):
+    """Remember the digests computed while moving ``package`` so that they
+    don't have to be computed again from disk.
+
+    Only call this when ``hasher`` has seen the whole package, i.e. the
+    package is a single file that has been copied in full.
+    """
+    if package is not None and hasattr(package, "transfer_checksums"):
+        package.transfer_checksums.update(hasher.hexdigests())
+
+
+def _advise_sequential(f):
+    """Tell the kernel that ``f`` will be read sequentially, so it can read
+    ahead more aggressively. Only available on Python 3 and some platforms.
+    """
+    fadvise = getattr(os, "posix_fadvise", None)
+    if fadvise is None:
+        return
+    try:
+        fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+
+def _hash_read(f, hasher, buffer_size):
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        size = f.readinto(buf)
+        if not size:
+            break
+        hasher.update(view[:size])
+
+
+def _hash_mmap(f, hasher, buffer_size):
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        return  # Empty files can't be mapped
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for offset in range(0, size, buffer_size):
+            if six.PY2:
+                window = buffer(mapped, offset, buffer_size)  # noqa: F821
+            else:
+                window = memoryview(mapped)[offset : offset + buffer_size]
+            hasher.update(window)
+            del window
+    finally:
+        mapped.close()
+
+
+def hash_file(path, algorithms, buffer_size=FILE_BUFFER_SIZE, use_mmap=False):
+    """Return a :class:`MultiHash` of the contents of the file at ``path``
+    for each of ``algorithms``, reading the file only once.
+
+    :param buffer_size: Size of each read, or of each mmap window.
+    :param use_mmap: Map the file into memory instead of reading it into a
+        buffer; this avoids a copy for files already in the page cache.
+    """
+    hasher = MultiHash(algorithms)
+    with io.open(path, "rb", buffering=0) as f:
+        _advise_sequential(f)
+        if use_mmap:
+            _hash_mmap(f, hasher, buffer_size)
+        else:
+            _hash_read(f, hasher, buffer_size)
+    return hasher
+
+
+def hash_files(paths, algorithms, max_workers=MAX_WORKERS, **kwargs):
+    """Hash several files concurrently with :func:`hash_file`.
+
+    :returns: OrderedDict of ``{path: MultiHash}`` in the order of ``paths``.
+    Exceptions raised while hashing a file are re-raised.
+    """
+    paths = list(paths)
+    if len(paths) <= 1 or max_workers <= 1:
+        return OrderedDict(
+            (path, hash_file(path, algorithms, **kwargs)) for path in paths
+        )
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        futures = [
+            (path, executor.submit(hash_file, path, algorithms, **kwargs))
+            for path in paths
+        ]
+        return OrderedDict((path, future.result()) for path, future in futures)
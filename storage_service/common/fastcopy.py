@@ -0,0 +1,234 @@
+"""Fast file copies.
+
+:func:`copyfile` copies the data of a file with the cheapest mechanism the
+source and destination filesystems support:
+
+1. a reflink (``FICLONE``), which shares the data blocks of the source on
+   copy-on-write filesystems like XFS and btrfs, so it's instant;
+2. ``copy_file_range``, which copies inside the kernel, and lets NFS 4.2 and
+   other network filesystems copy on the server;
+3. ``sendfile``, which also copies inside the kernel; and
+4. a plain copy through a userspace buffer.
+
+Mechanisms that a pair of filesystems doesn't support are remembered, so
+copying a tree of files only tries them once. :func:`copy`, :func:`copy2`
+and :func:`copytree` work like their ``shutil`` counterparts, using
+:func:`copyfile`.
+
+"""
+
+from __future__ import absolute_import
+
+# stdlib, alphabetical
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+LOGGER = logging.getLogger(__name__)
+
+# ioctl to clone a whole file, from linux/fs.h.
+FICLONE = 0x40049409
+
+# Largest amount of data asked of copy_file_range and sendfile in one call
+# (the kernel copies at most about 2 GiB at once anyway).
+CHUNK_SIZE = 1024 * 1024 * 1024
+
+# Size of the buffer of the userspace copy.
+BUFFER_SIZE = 1024 * 1024
+
+# Errors that mean a mechanism isn't supported for these files, rather than
+# that the copy failed.
+UNSUPPORTED_ERRNOS = frozenset(
+    (
+        errno.EINVAL,
+        errno.ENOSYS,
+        errno.ENOTSUP,
+        errno.EOPNOTSUPP,
+        errno.ENOTTY,
+        errno.EXDEV,
+    )
+)
+
+# {(mechanism, source st_dev, destination st_dev)} known not to work.
+_unsupported = set()
+
+
+def _libc_function(name, argtypes):
+    """Return the libc function ``name``, or None if it isn't available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = getattr(libc, name)
+    except (AttributeError, OSError, TypeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_ssize_t
+    return function
+
+
+_libc_copy_file_range = _libc_function(
+    "copy_file_range",
+    [
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_uint,
+    ],
+)
+_libc_sendfile = _libc_function(
+    "sendfile", [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+)
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError as err:
+        raise OSError(err.errno, err.strerror)
+
+
+def _copy_file_range(src_fd, dst_fd):
+    """Copy from the current position of ``src_fd`` to its end, with
+    ``copy_file_range``."""
+    if hasattr(os, "copy_file_range"):  # Python 3.8+
+
+        def copy_chunk():
+            return os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE)
+
+    elif _libc_copy_file_range is not None:
+
+        def copy_chunk():
+            return _check(
+                _libc_copy_file_range(src_fd, None, dst_fd, None, CHUNK_SIZE, 0)
+            )
+
+    else:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    while copy_chunk():
+        pass
+
+
+def _sendfile(src_fd, dst_fd):
+    """Copy from the current position of ``src_fd`` to its end, with
+    ``sendfile``."""
+    if hasattr(os, "sendfile"):  # Python 3
+
+        def copy_chunk():
+            return os.sendfile(dst_fd, src_fd, None, CHUNK_SIZE)
+
+    elif _libc_sendfile is not None:
+
+        def copy_chunk():
+            return _check(_libc_sendfile(dst_fd, src_fd, None, CHUNK_SIZE))
+
+    else:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    while copy_chunk():
+        pass
+
+
+def _userspace_copy(src_fd, dst_fd):
+    while True:
+        buf = os.read(src_fd, BUFFER_SIZE)
+        if not buf:
+            break
+        while buf:
+            buf = buf[os.write(dst_fd, buf) :]
+
+
+MECHANISMS = (
+    ("reflink", _reflink),
+    ("copy_file_range", _copy_file_range),
+    ("sendfile", _sendfile),
+    ("userspace", _userspace_copy),
+)
+
+
+def copyfile(src, dst):
+    """Copy the data of the file ``src`` to the file ``dst``, replacing it.
+
+    :returns: The name of the mechanism that copied the data (or the last
+        part of it, if a mechanism stopped working partway through).
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+            for name, mechanism in MECHANISMS:
+                if (name,) + devices in _unsupported:
+                    continue
+                try:
+                    mechanism(src_fd, dst_fd)
+                except OSError as err:
+                    if name == "userspace" or err.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+                    LOGGER.debug("Unable to copy %s with %s: %s", src, name, err)
+                    _unsupported.add((name,) + devices)
+                    continue
+                return name
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copy(src, dst):
+    """Copy the file ``src`` to ``dst`` (a file or directory) and its
+    permissions, like ``shutil.copy``."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return dst
+
+
+def copy2(src, dst):
+    """Copy the file ``src`` to ``dst`` (a file or directory) and its
+    metadata, like ``shutil.copy2``."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copytree(src, dst, symlinks=False):
+    """Copy the directory ``src`` to ``dst``, which mustn't exist, like
+    ``shutil.copytree``."""
+    names = os.listdir(src)
+    os.makedirs(dst)
+    errors = []
+    for name in names:
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        try:
+            if symlinks and os.path.islink(srcname):
+                os.symlink(os.readlink(srcname), dstname)
+            elif os.path.isdir(srcname):
+                copytree(srcname, dstname, symlinks)
+            else:
+                copy2(srcname, dstname)
+        except shutil.Error as err:
+            errors.extend(err.args[0])
+        except EnvironmentError as why:
+            errors.append((srcname, dstname, str(why)))
+    try:
+        shutil.copystat(src, dst)
+    except OSError as why:
+        errors.append((src, dst, str(why)))
+    if errors:
+        raise shutil.Error(errors)
+    return dst
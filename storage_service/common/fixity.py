@@ -0,0 +1,195 @@
+"""Fixity checks of packages that are not available locally.
+
+Spaces storing packages in a remote service (e.g. S3 or Swift) can check the
+fixity of a package by streaming its objects through the hashes, without
+copying the package to the storage service first. The space provides two
+callables:
+
+- ``list_objects()``, returning a dict of ``{relative path: size}`` of the
+  objects that make up the package, where the path of a package that is a
+  single object (a compressed AIP) is the empty string, and
+- ``read_object(relative_path)``, returning an iterable of the byte chunks of
+  one of those objects.
+
+Compressed packages are checked against the checksum in their pointer file,
+and uncompressed packages (bags) against their manifests and tag manifests.
+The results have the same shape as ``Package.check_fixity``'s.
+"""
+
+from __future__ import absolute_import
+
+# stdlib, alphabetical
+import logging
+import os
+
+# Core Django, alphabetical
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+# Third party dependencies, alphabetical
+import bagit
+from concurrent.futures import ThreadPoolExecutor
+import metsrw
+
+# This project, alphabetical
+from common import checksums
+
+LOGGER = logging.getLogger(__name__)
+
+
+def hash_chunks(chunks, algorithms):
+    """Return a :class:`checksums.MultiHash` of the byte chunks in
+    ``chunks`` for each of ``algorithms``."""
+    hasher = checksums.MultiHash(algorithms)
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher
+
+
+def pointer_checksum(package):
+    """Return ``(algorithm, checksum)`` of a compressed package from its
+    pointer file, or None if it doesn't have one.
+
+    Unlike ``Package.get_pointer_instance`` this doesn't look for the package
+    on the local filesystem.
+    """
+    ptr_path = package.full_pointer_file_path
+    if not ptr_path or not os.path.isfile(ptr_path):
+        return None
+    pointer = metsrw.METSDocument.fromfile(ptr_path)
+    fsentry = pointer.get_file(file_uuid=package.uuid)
+    if fsentry is None:
+        return None
+    premis_object = fsentry.get_premis_objects()[0]
+    return premis_object.message_digest_algorithm, premis_object.message_digest
+
+
+def _result(failures):
+    if not failures:
+        return (True, [], "", None)
+    message = "%s: %s" % (
+        _("Bag validation failed"),
+        "; ".join(force_text(failure) for failure in failures),
+    )
+    return (False, failures, message, None)
+
+
+def check_package_fixity(package, list_objects, read_object, max_workers=1):
+    """Check the fixity of ``package`` reading its objects with
+    ``read_object``, see the module documentation.
+
+    :param int max_workers: Number of objects of an uncompressed package to
+        read at the same time. ``read_object`` must be thread safe if > 1.
+    :raises NotImplementedError: if the fixity can't be checked this way,
+        e.g. a compressed package without a pointer file.
+    :return: Tuple of (success, [errors], message, timestamp)
+    """
+    objects = list_objects()
+    if not objects:
+        return (
+            False,
+            [],
+            _("Package not found: %(path)s") % {"path": package.full_path},
+            None,
+        )
+    if "" in objects:
+        return _check_file_fixity(package, read_object)
+    return _check_bag_fixity(objects, read_object, max_workers)
+
+
+def _check_file_fixity(package, read_object):
+    expected = pointer_checksum(package)
+    if expected is None:
+        raise NotImplementedError(
+            _("Unable to check the fixity of a package without pointer file")
+        )
+    algorithm, checksum = expected
+    try:
+        hasher = hash_chunks(read_object(""), algorithm)
+    except ValueError:  # Invalid checksum type
+        raise NotImplementedError(
+            _("Unsupported checksum algorithm %(algorithm)s") % {"algorithm": algorithm}
+        )
+    found = hasher.hexdigest(algorithm)
+    if found == checksum:
+        return _result([])
+    return _result(
+        [
+            bagit.ChecksumMismatch(
+                os.path.basename(package.current_path), algorithm, checksum, found
+            )
+        ]
+    )
+
+
+def parse_manifest(chunks):
+    """Return a dict of ``{path: checksum}`` from the lines of a bag
+    manifest, given as byte chunks."""
+    entries = {}
+    content = b"".join(chunks).decode("utf-8").lstrip(u"\ufeff")
+    for line in content.splitlines():
+        line = line.strip()
+        # Ignore blank lines and comments.
+        if line == "" or line.startswith("#"):
+            continue
+        entry = line.split(None, 1)
+        if len(entry) != 2:
+            LOGGER.warning("Invalid manifest entry: %s", line)
+            continue
+        entries[os.path.normpath(entry[1].lstrip("*"))] = entry[0].lower()
+    return entries
+
+
+def _manifest_algorithm(path):
+    """Return the algorithm of manifest or tag manifest ``path``, or None
+    if it isn't one."""
+    for prefix in ("manifest-", "tagmanifest-"):
+        if path.startswith(prefix) and path.endswith(".txt") and "/" not in path:
+            return path[len(prefix) : -len(".txt")]
+    return None
+
+
+def _check_bag_fixity(objects, read_object, max_workers):
+    # Gather the checksums of every file from all the manifests
+    expected = {}
+    for path in sorted(objects):
+        algorithm = _manifest_algorithm(path)
+        if algorithm is None:
+            continue
+        for entry, checksum in parse_manifest(read_object(path)).items():
+            expected.setdefault(entry, {})[algorithm] = checksum
+    if not expected:
+        raise NotImplementedError(_("Unable to find the manifests of the bag"))
+
+    failures = []
+    to_check = []
+    for path, digests in sorted(expected.items()):
+        if path in objects:
+            to_check.append((path, digests))
+        else:
+            failures.append(bagit.FileMissing(path))
+    for path in sorted(objects):
+        if path.startswith("data/") and path not in expected:
+            failures.append(bagit.UnexpectedFile(path))
+
+    def check(path, digests):
+        try:
+            hasher = hash_chunks(read_object(path), list(digests))
+        except ValueError:  # Invalid checksum type
+            raise NotImplementedError(
+                _("Unsupported checksum algorithm in %(algorithms)s")
+                % {"algorithms": ", ".join(digests)}
+            )
+        return [
+            bagit.ChecksumMismatch(
+                path, algorithm, checksum, hasher.hexdigest(algorithm)
+            )
+            for algorithm, checksum in digests.items()
+            if hasher.hexdigest(algorithm) != checksum
+        ]
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = [executor.submit(check, *item) for item in to_check]
+    for future in futures:
+        failures.extend(future.result())
+    return _result(failures)
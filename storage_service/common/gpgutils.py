@@ -11,7 +11,9 @@ manage (i.e., list, created, import, delete) GPG keys.
 from __future__ import absolute_import
 
 # stdlib, alphabetical
+import codecs
 import logging
+import subprocess
 
 # Third party dependencies, alphabetical
 import gnupg
@@ -214,7 +216,53 @@ def gpg_decrypt_file(path, decr_path):
     ``decr_path``.
     """
     with open(path, "rb") as stream:
-        return gpg().decrypt_file(stream, output=decr_path)
+        return gpg_decrypt_stream(stream, decr_path)
+
+
+def gpg_decrypt_stream(stream, decr_path=None):
+    """Use GPG to decrypt the data read from the binary file object
+    ``stream`` and save it to ``decr_path``. If ``decr_path`` is None, the
+    decrypted data is kept in the ``data`` attribute of the returned
+    Python-GnuPG decryption result. The result also says whether the data
+    was signed, and by which key.
+    """
+    return gpg().decrypt_file(stream, output=decr_path)
+
+
+def gpg_decrypt_process(path, status):
+    """Start GPG decrypting the file at ``path`` to its standard output, so
+    it can be piped straight into another process. GPG's status is written
+    to the binary file ``status``; once GPG has exited, pass it to
+    ``gpg_decrypt_result``. Returns the GPG ``subprocess.Popen``.
+    """
+    return subprocess.Popen(
+        gpg().make_args(["--decrypt", path], False),
+        stdout=subprocess.PIPE,
+        stderr=status,
+        close_fds=True,
+    )
+
+
+def gpg_decrypt_result(status):
+    """Return the Python-GnuPG decryption result described by the status
+    that a process started by ``gpg_decrypt_process`` wrote to ``status``.
+    """
+    gpg_ = gpg()
+    result = gpg_.result_map["crypt"](gpg_)
+    status.seek(0)
+    lines = codecs.getreader(gpg_.encoding)(status, "replace").readlines()
+    for line in lines:
+        if not line.startswith("[GNUPG:] "):
+            continue
+        keyword, __, value = line[len("[GNUPG:] ") :].rstrip().partition(" ")
+        try:
+            result.handle_status(keyword, value)
+        except ValueError:
+            # Newer versions of GnuPG have status messages that
+            # Python-GnuPG doesn't know, and that we don't need.
+            LOGGER.debug("Ignoring GPG status: %s", line.rstrip())
+    result.stderr = "".join(lines)
+    return result
 
 
 def gpg_encrypt_file(path, recipient_fingerprint):
@@ -225,11 +273,22 @@ def gpg_encrypt_file(path, recipient_fingerprint):
     """
     encr_path = path + ".gpg"
     with open(path, "rb") as stream:
-        result = gpg().encrypt_file(
-            stream,
-            [recipient_fingerprint],
-            armor=False,
-            always_trust=True,  # so we can use imported keys
-            output=encr_path,
-        )
+        result = gpg_encrypt_stream(stream, recipient_fingerprint, encr_path)
     return encr_path, result
+
+
+def gpg_encrypt_stream(stream, recipient_fingerprint, encr_path, sign=None):
+    """Use GPG to encrypt the data read from the binary file object ``stream``
+    (e.g., the output of a ``tar`` process) to the file at ``encr_path``, for
+    the key with fingerprint ``recipient_fingerprint``. If ``sign`` is the
+    fingerprint of a private key, the data is also signed with it. Returns
+    the Python-GnuPG encryption result <gnupg.Crypt> object.
+    """
+    return gpg().encrypt_file(
+        stream,
+        [recipient_fingerprint],
+        sign=sign,
+        armor=False,
+        always_trust=True,  # so we can use imported keys
+        output=encr_path,
+    )
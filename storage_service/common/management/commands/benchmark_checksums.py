@@ -0,0 +1,119 @@
+"""Benchmark checksums Django management command: compares the throughput of
+the checksum engine in ``common.checksums`` with the naive approach of reading
+each file once per algorithm.
+
+Run it against real packages on the storage being evaluated, e.g.::
+
+    $ ./manage.py benchmark_checksums /var/archivematica/AIPsStore/*.7z \\
+          --algorithm md5 --algorithm sha256 --workers 4
+
+Files are read several times, so results for all but the first strategy are
+likely to be served from the page cache unless the files are bigger than the
+available memory.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib, alphabetical
+import hashlib
+import os
+import time
+
+# Core Django, alphabetical
+from django.core.management.base import BaseCommand, CommandError
+
+# This project, alphabetical
+from common import checksums
+
+
+def _naive(paths, algorithms, buffer_size):
+    for path in paths:
+        for algorithm in algorithms:
+            checksum = hashlib.new(algorithm)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(buffer_size), b""):
+                    checksum.update(chunk)
+
+
+class Command(BaseCommand):
+
+    help = "Measure the throughput of the checksum engine on the given files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Files to hash")
+        parser.add_argument(
+            "--algorithm",
+            action="append",
+            dest="algorithms",
+            help="Checksum algorithm, can be repeated. Default: md5 and sha256.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=checksums.MAX_WORKERS,
+            help="Number of threads hashing files concurrently. Default: %(default)s",
+        )
+        parser.add_argument(
+            "--buffer-size",
+            type=int,
+            default=checksums.FILE_BUFFER_SIZE,
+            help="Size of each read in bytes. Default: %(default)s",
+        )
+
+    def handle(self, *args, **options):
+        paths = options["paths"]
+        algorithms = options["algorithms"] or ["md5", "sha256"]
+        buffer_size = options["buffer_size"]
+        try:
+            checksums.MultiHash(algorithms)
+            total = sum(os.path.getsize(path) for path in paths)
+        except (OSError, ValueError) as err:
+            raise CommandError(err)
+
+        strategies = (
+            (
+                "one read per algorithm (64 KiB)",
+                lambda: _naive(paths, algorithms, 64 * 1024),
+            ),
+            (
+                "single pass",
+                lambda: checksums.hash_files(
+                    paths, algorithms, max_workers=1, buffer_size=buffer_size
+                ),
+            ),
+            (
+                "single pass, mmap",
+                lambda: checksums.hash_files(
+                    paths,
+                    algorithms,
+                    max_workers=1,
+                    buffer_size=buffer_size,
+                    use_mmap=True,
+                ),
+            ),
+            (
+                "single pass, {} threads".format(options["workers"]),
+                lambda: checksums.hash_files(
+                    paths,
+                    algorithms,
+                    max_workers=options["workers"],
+                    buffer_size=buffer_size,
+                ),
+            ),
+        )
+
+        print(
+            "Hashing {} file(s), {} bytes, with {}".format(
+                len(paths), total, ", ".join(algorithms)
+            )
+        )
+        for name, run in strategies:
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            print(
+                "{:<40} {:8.3f} s {:10.1f} MiB/s".format(
+                    name, elapsed, total / (1024 * 1024) / max(elapsed, 1e-9)
+                )
+            )
@@ -0,0 +1,43 @@
+"""Reconcile Wellcome ingests Django management command: completes the
+packages stored in Wellcome Storage Service spaces whose ingest has finished.
+
+Storing a package in the Wellcome Storage only submits its ingest, the package
+stays in the STAGING status until the Wellcome Storage calls back. It doesn't
+retry the callback, so run this periodically (e.g. from cron) to complete the
+packages whose callback was missed::
+
+    $ ./manage.py reconcile_wellcome_ingests
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Core Django, alphabetical
+from django.core.management.base import BaseCommand
+
+# This project, alphabetical
+from locations import models
+
+
+class Command(BaseCommand):
+
+    help = "Complete the packages whose Wellcome Storage ingest has finished"
+
+    def handle(self, *args, **options):
+        packages = models.Package.objects.filter(
+            status=models.Package.STAGING,
+            current_location__space__access_protocol=models.Space.WELLCOME,
+        ).select_related("current_location__space")
+
+        # Query the child space of each space once, not for each package
+        children = {}
+        for package in packages:
+            space = package.current_location.space
+            if space.uuid not in children:
+                children[space.uuid] = space.get_child_space()
+            child = children[space.uuid]
+            try:
+                status, message = child.update_package_status(package)
+            except Exception as err:
+                self.stderr.write("{}: {}".format(package.uuid, err))
+                continue
+            self.stdout.write("{}: {} ({})".format(package.uuid, status, message))
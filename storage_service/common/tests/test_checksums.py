@@ -0,0 +1,136 @@
+import hashlib
+from io import BytesIO
+
+import pytest
+
+from common import checksums
+
+
+DATA = b"archivematica " * 1000
+
+
+def test_multihash_computes_all_algorithms():
+    hasher = checksums.MultiHash(["md5", "sha256", "sha512"])
+    hasher.update(DATA[:100])
+    hasher.update(DATA[100:])
+    assert hasher.algorithms == ["md5", "sha256", "sha512"]
+    assert hasher.hexdigests() == {
+        "md5": hashlib.md5(DATA).hexdigest(),
+        "sha256": hashlib.sha256(DATA).hexdigest(),
+        "sha512": hashlib.sha512(DATA).hexdigest(),
+    }
+    assert hasher["md5"].hexdigest() == hashlib.md5(DATA).hexdigest()
+
+
+def test_multihash_accepts_single_algorithm():
+    hasher = checksums.MultiHash("sha1")
+    hasher.update(DATA)
+    assert hasher.hexdigest("sha1") == hashlib.sha1(DATA).hexdigest()
+
+
+def test_multihash_invalid_algorithm():
+    with pytest.raises(ValueError):
+        checksums.MultiHash(["md5", "not-an-algorithm"])
+
+
+def test_hashing_reader():
+    hasher = checksums.MultiHash(["md5", "sha256"])
+    reader = checksums.HashingReader(BytesIO(DATA), hasher)
+    assert not reader.seekable()
+    assert reader.read(10) + reader.read() == DATA
+    assert reader.bytes_read == len(DATA)
+    assert hasher.hexdigest("sha256") == hashlib.sha256(DATA).hexdigest()
+
+
+def test_hashing_reader_reset():
+    hasher = checksums.MultiHash("md5")
+    reader = checksums.HashingReader(BytesIO(DATA), hasher)
+    reader.read(50)
+    reader.reset()
+    assert reader.read() == DATA
+    assert hasher.hexdigest("md5") == hashlib.md5(DATA).hexdigest()
+
+
+def test_hashing_writer():
+    hasher = checksums.MultiHash(["md5", "sha512"])
+    output = BytesIO()
+    writer = checksums.HashingWriter(output, hasher)
+    writer.write(DATA[:7])
+    writer.write(DATA[7:])
+    assert output.getvalue() == DATA
+    assert writer.bytes_written == len(DATA)
+    assert hasher.hexdigest("sha512") == hashlib.sha512(DATA).hexdigest()
+
+
+def test_copyfileobj():
+    hasher = checksums.MultiHash("md5")
+    output = BytesIO()
+    assert checksums.copyfileobj(BytesIO(DATA), output, hasher, length=64) == len(DATA)
+    assert output.getvalue() == DATA
+    assert hasher.hexdigest("md5") == hashlib.md5(DATA).hexdigest()
+
+
+class FakePackage(object):
+    transfer_checksum_algorithms = ["sha256"]
+
+    def __init__(self):
+        self.transfer_checksums = {}
+
+
+def test_hasher_for_package_adds_its_algorithms():
+    assert checksums.hasher_for(FakePackage(), "md5").algorithms == ["md5", "sha256"]
+    assert checksums.hasher_for(None, "md5").algorithms == ["md5"]
+
+
+def test_record_transfer_checksums():
+    package = FakePackage()
+    hasher = checksums.hasher_for(package, "md5")
+    hasher.update(DATA)
+    checksums.record_transfer_checksums(package, hasher)
+    assert package.transfer_checksums == {
+        "md5": hashlib.md5(DATA).hexdigest(),
+        "sha256": hashlib.sha256(DATA).hexdigest(),
+    }
+    # No package, nothing to record
+    checksums.record_transfer_checksums(None, hasher)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_hash_file(tmpdir, use_mmap):
+    path = tmpdir.join("file")
+    path.write_binary(DATA)
+    # A small buffer size, so the file is read in several windows
+    hasher = checksums.hash_file(
+        str(path), ["md5", "sha1"], buffer_size=4096, use_mmap=use_mmap
+    )
+    assert hasher.hexdigests() == {
+        "md5": hashlib.md5(DATA).hexdigest(),
+        "sha1": hashlib.sha1(DATA).hexdigest(),
+    }
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_hash_empty_file(tmpdir, use_mmap):
+    path = tmpdir.join("empty")
+    path.write_binary(b"")
+    hasher = checksums.hash_file(str(path), "md5", use_mmap=use_mmap)
+    assert hasher.hexdigest("md5") == hashlib.md5(b"").hexdigest()
+
+
+def test_hash_files(tmpdir):
+    paths = []
+    for idx in range(5):
+        path = tmpdir.join("file{}".format(idx))
+        path.write_binary(DATA * idx)
+        paths.append(str(path))
+    result = checksums.hash_files(paths, "sha256", max_workers=3)
+    assert list(result) == paths
+    for idx, path in enumerate(paths):
+        assert result[path].hexdigest("sha256") == hashlib.sha256(DATA * idx).hexdigest()
+
+
+def test_hash_files_raises(tmpdir):
+    with pytest.raises(IOError):
+        checksums.hash_files(
+            [str(tmpdir.join("missing")), str(tmpdir.join("also-missing"))], "md5"
+        )
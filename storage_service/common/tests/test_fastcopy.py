@@ -0,0 +1,123 @@
+import errno
+import os
+import shutil
+
+import pytest
+
+from common import fastcopy
+
+
+@pytest.fixture(autouse=True)
+def clear_unsupported():
+    fastcopy._unsupported.clear()
+    yield
+    fastcopy._unsupported.clear()
+
+
+@pytest.fixture
+def source(tmpdir):
+    source = tmpdir.join("source.bin")
+    # Larger than the userspace buffer, so it's copied in several reads
+    source.write_binary(os.urandom(fastcopy.BUFFER_SIZE + 1234))
+    return source
+
+
+def _unsupported(src_fd, dst_fd):
+    raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+
+@pytest.mark.parametrize(
+    "method", ["reflink", "copy_file_range", "sendfile", "userspace"]
+)
+def test_copyfile(source, tmpdir, mocker, method):
+    # Make every mechanism before ``method`` unsupported
+    mechanisms = []
+    for name, mechanism in fastcopy.MECHANISMS:
+        if name == method:
+            break
+        mechanisms.append((name, _unsupported))
+    mocker.patch.object(
+        fastcopy,
+        "MECHANISMS",
+        tuple(mechanisms) + fastcopy.MECHANISMS[len(mechanisms) :],
+    )
+    destination = tmpdir.join("destination.bin")
+    destination.write("previous contents, longer than nothing")
+
+    used = fastcopy.copyfile(str(source), str(destination))
+
+    assert destination.read_binary() == source.read_binary()
+    if used != method:
+        pytest.skip("{} isn't supported here".format(method))
+
+
+def test_copyfile_remembers_unsupported_mechanisms(source, tmpdir, mocker):
+    reflink = mocker.Mock(side_effect=_unsupported)
+    mocker.patch.object(
+        fastcopy,
+        "MECHANISMS",
+        [("reflink", reflink), ("userspace", fastcopy._userspace_copy)],
+    )
+
+    for name in ("first.bin", "second.bin"):
+        assert fastcopy.copyfile(str(source), str(tmpdir.join(name))) == "userspace"
+        assert tmpdir.join(name).read_binary() == source.read_binary()
+
+    assert reflink.call_count == 1
+
+
+def test_copyfile_raises_other_errors(source, tmpdir, mocker):
+    def failing(src_fd, dst_fd):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    mocker.patch.object(
+        fastcopy,
+        "MECHANISMS",
+        [("reflink", failing), ("userspace", fastcopy._userspace_copy)],
+    )
+
+    with pytest.raises(OSError) as excinfo:
+        fastcopy.copyfile(str(source), str(tmpdir.join("destination.bin")))
+
+    assert excinfo.value.errno == errno.ENOSPC
+
+
+def test_copy_into_directory(source, tmpdir):
+    source.chmod(0o640)
+    destination = tmpdir.mkdir("destination")
+
+    assert fastcopy.copy(str(source), str(destination)) == str(
+        destination.join("source.bin")
+    )
+    assert destination.join("source.bin").read_binary() == source.read_binary()
+    assert destination.join("source.bin").stat().mode & 0o777 == 0o640
+
+
+def test_copytree(tmpdir):
+    source = tmpdir.mkdir("source")
+    source.join("a.txt").write("a")
+    source.mkdir("empty")
+    source.mkdir("sub").join("b.txt").write("b")
+    source.join("sub", "b.txt").setmtime(1234567890)
+
+    fastcopy.copytree(str(source), str(tmpdir.join("destination")))
+
+    destination = tmpdir.join("destination")
+    assert destination.join("a.txt").read() == "a"
+    assert destination.join("empty").isdir()
+    assert destination.join("sub", "b.txt").read() == "b"
+    assert destination.join("sub", "b.txt").mtime() == 1234567890
+
+
+def test_copytree_collects_errors(tmpdir, mocker):
+    source = tmpdir.mkdir("source")
+    source.join("a.txt").write("a")
+    source.join("b.txt").write("b")
+    mocker.patch.object(
+        fastcopy, "copyfile", side_effect=IOError(errno.EIO, "I/O error")
+    )
+
+    with pytest.raises(shutil.Error) as excinfo:
+        fastcopy.copytree(str(source), str(tmpdir.join("destination")))
+
+    assert len(excinfo.value.args[0]) == 2
@@ -0,0 +1,104 @@
+import hashlib
+
+import bagit
+import mock
+import pytest
+
+from common import fixity
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def make_bag(files):
+    objects = {"data/" + name: data for name, data in files.items()}
+    objects["bagit.txt"] = b"BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
+    objects["manifest-md5.txt"] = b"".join(
+        "{}  {}\n".format(md5(data), path).encode("utf-8")
+        for path, data in sorted(objects.items())
+        if path.startswith("data/")
+    )
+    objects["tagmanifest-md5.txt"] = "{}  bagit.txt\n".format(
+        md5(objects["bagit.txt"])
+    ).encode("utf-8")
+    return objects
+
+
+def check(objects, package=None, **kwargs):
+    def read_object(path):
+        data = objects[path]
+        # Return several chunks, as a streamed object would
+        return [data[i : i + 3] for i in range(0, len(data), 3)]
+
+    return fixity.check_package_fixity(
+        package or mock.Mock(full_path="/aips/pkg"),
+        lambda: {path: len(data) for path, data in objects.items()},
+        read_object,
+        **kwargs
+    )
+
+
+def test_bag_fixity_success():
+    objects = make_bag({"a.txt": b"a" * 10, "sub/b.txt": b"b"})
+    assert check(objects, max_workers=2) == (True, [], "", None)
+
+
+def test_bag_fixity_checksum_mismatch():
+    objects = make_bag({"a.txt": b"a" * 10, "sub/b.txt": b"b"})
+    objects["data/sub/b.txt"] = b"changed"
+    success, failures, message, timestamp = check(objects)
+    assert success is False
+    assert len(failures) == 1
+    assert isinstance(failures[0], bagit.ChecksumMismatch)
+    assert failures[0].path == "data/sub/b.txt"
+    assert failures[0].found == md5(b"changed")
+    assert message.startswith("Bag validation failed: ")
+
+
+def test_bag_fixity_missing_and_unexpected_files():
+    objects = make_bag({"a.txt": b"a", "b.txt": b"b"})
+    del objects["data/a.txt"]
+    objects["data/c.txt"] = b"c"
+    success, failures, _, _ = check(objects)
+    assert success is False
+    assert sorted((type(f).__name__, f.path) for f in failures) == [
+        ("FileMissing", "data/a.txt"),
+        ("UnexpectedFile", "data/c.txt"),
+    ]
+
+
+def test_package_not_found():
+    success, failures, message, _ = check({})
+    assert success is False
+    assert message == "Package not found: /aips/pkg"
+
+
+def test_bag_without_manifests():
+    with pytest.raises(NotImplementedError):
+        check({"data/a.txt": b"a"})
+
+
+def test_parse_manifest():
+    content = u"\ufeff# comment\n\nABC  data/a.txt\ndef *data/sub/../b.txt\n"
+    assert fixity.parse_manifest([content.encode("utf-8")]) == {
+        "data/a.txt": "abc",
+        "data/b.txt": "def",
+    }
+
+
+def test_compressed_package_fixity():
+    package = mock.Mock(full_path="/aips/pkg.7z", current_path="pkg.7z")
+    with mock.patch(
+        "common.fixity.pointer_checksum", return_value=("md5", md5(b"package"))
+    ):
+        assert check({"": b"package"}, package) == (True, [], "", None)
+        success, failures, _, _ = check({"": b"corrupted"}, package)
+    assert success is False
+    assert failures[0].path == "pkg.7z"
+
+
+def test_compressed_package_without_pointer():
+    package = mock.Mock(full_path="/aips/pkg.7z", full_pointer_file_path=None)
+    with pytest.raises(NotImplementedError):
+        check({"": b"package"}, package)
@@ -291,3 +291,17 @@ def test_get_base_directory_when_no_directory():
 
     with pytest.raises(ValueError, match="Could not find base directory"):
         utils.get_base_directory(path)
+
+
+def test_download_file_range_stream(tmpdir):
+    path = tmpdir.join("aip.7z")
+    path.write(b"0123456789")
+
+    response = utils.download_file_range_stream(str(path), 3, 6, "aip.7z.au-2")
+
+    assert response["Content-Length"] == "4"
+    assert response["Content-Disposition"] == 'attachment; filename="aip.7z.au-2"'
+    # A server using sendfile starts from the position of the file
+    assert os.lseek(response.file_to_stream.fileno(), 0, os.SEEK_CUR) == 3
+    assert b"".join(response.streaming_content) == b"3456"
+    response.file_to_stream.close()
@@ -1,7 +1,6 @@
 import ast
 from collections import namedtuple
 import datetime
-import hashlib
 import json
 import logging
 from lxml import etree
@@ -19,6 +18,7 @@ from django.utils.translation import ugettext as _
 from django.utils import six
 
 from administration import models
+from common import checksums
 from storage_service import __version__ as ss_version
 
 LOGGER = logging.getLogger(__name__)
@@ -178,6 +178,56 @@ def download_file_stream(filepath, temp_dir=None):
     return response
 
 
+class _FileRange(object):
+    """Read-only file object for the bytes ``begin`` to ``end`` (inclusive)
+    of ``fileobj``.
+
+    ``fileno`` is the underlying file's, positioned at ``begin``, so a WSGI
+    server that uses sendfile for file responses (e.g. gunicorn with
+    ``SS_GUNICORN_SENDFILE``) sends the range without copying it through
+    Python, limited by the Content-Length.
+    """
+
+    def __init__(self, fileobj, begin, end):
+        fileobj.seek(begin)
+        self._fileobj = fileobj
+        self._remaining = end - begin + 1
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._fileobj.fileno()
+
+    def close(self):
+        self._fileobj.close()
+
+
+def download_file_range_stream(filepath, begin, end, filename=None):
+    """
+    Returns the bytes ``begin`` to ``end`` (inclusive) of `filepath` as a
+    HttpResponse stream, named ``filename``.
+    """
+    # If not found, return 404
+    if not os.path.exists(filepath):
+        return http.HttpResponseNotFound(_("File not found"))
+
+    filename = filename or os.path.basename(filepath)
+
+    response = http.FileResponse(_FileRange(open(filepath, "rb"), begin, end))
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    response["Content-type"] = mimetype
+    response["Content-Disposition"] = 'attachment; filename="' + filename + '"'
+    response["Content-Length"] = end - begin + 1
+
+    return response
+
+
 # ########## XML & POINTER FILE ############
 
 
@@ -554,12 +604,11 @@ def generate_checksum(file_path, checksum_type="md5"):
     Returns checksum object for `file_path` using `checksum_type`.
 
     If checksum_type is not a valid checksum, ValueError raised by hashlib.
+
+    To compute several checksums of the same file, or checksums of many
+    files, use ``common.checksums.hash_file`` or ``hash_files`` instead.
     """
-    checksum = hashlib.new(checksum_type)
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(128 * checksum.block_size), b""):
-            checksum.update(chunk)
-    return checksum
+    return checksums.hash_file(file_path, checksum_type)[checksum_type]
 
 
 def uuid_to_path(uuid):
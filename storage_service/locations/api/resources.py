@@ -257,17 +257,36 @@ class SpaceResource(ModelResource):
         # Make dict of fields in model and values from bundle.data
         access_protocol = bundle.data["access_protocol"]
         keep_fields = PROTOCOL[access_protocol]["fields"]
-        fields_dict = {key: bundle.data[key] for key in keep_fields}
+        fields_dict = {
+            key: bundle.data[key] for key in keep_fields if key in bundle.data
+        }
         bundle = super(SpaceResource, self).obj_create(bundle, **kwargs)
         model = PROTOCOL[access_protocol]["model"]
         obj = model.objects.create(space=bundle.obj, **fields_dict)
         obj.save()
         return bundle
 
-    def get_objects(self, space, path):
+    def get_objects(self, space, path, **paging):
         message = _("This method should be accessed via a versioned subclass")
         raise NotImplementedError(message)
 
+    @staticmethod
+    def _browse_paging(request):
+        """Return the paging arguments of ``Space.browse`` from the
+        limit=<number> and marker=<marker> request parameters. The response
+        has a 'next_marker' key if there are more entries after the page.
+
+        Raises ValueError if limit is not a positive integer.
+        """
+        paging = {}
+        if request.GET.get("limit"):
+            paging["limit"] = int(request.GET["limit"])
+            if paging["limit"] < 1:
+                raise ValueError("limit must be positive")
+        if request.GET.get("marker"):
+            paging["marker"] = request.GET["marker"]
+        return paging
+
     @_custom_endpoint(expected_methods=["get"])
     def browse(self, request, bundle, **kwargs):
         """ Returns all of the entries in a space, optionally at a subpath.
@@ -278,14 +297,22 @@ class SpaceResource(ModelResource):
         Directories is a subset of entries, all are just the name.
 
         If a path=<path> parameter is provided, will look in that path inside
-        the Space. """
+        the Space.
+
+        If limit=<number> or marker=<marker> parameters are provided, only a
+        page of entries is returned, see ``_browse_paging``. """
 
         space = bundle.obj
         path = request.GET.get("path", "")
         if not path.startswith(space.path):
             path = os.path.join(space.path, path)
 
-        objects = self.get_objects(space, path)
+        try:
+            paging = self._browse_paging(request)
+        except ValueError:
+            return http.HttpBadRequest(_("limit must be a positive integer"))
+
+        objects = self.get_objects(space, path, **paging)
 
         return self.create_response(request, objects)
 
@@ -372,7 +399,7 @@ class LocationResource(ModelResource):
     def decode_path(self, path):
         return path
 
-    def get_objects(self, space, path):
+    def get_objects(self, space, path, **paging):
         message = _("This method should be accessed via a versioned subclass")
         raise NotImplementedError(message)
 
@@ -436,7 +463,10 @@ class LocationResource(ModelResource):
         Directories is a subset of entries, all are just the name.
 
         If a path=<path> parameter is provided, will look in that path inside
-        the Location. """
+        the Location.
+
+        If limit=<number> or marker=<marker> parameters are provided, only a
+        page of entries is returned, see ``SpaceResource._browse_paging``. """
 
         location = bundle.obj
         path = request.GET.get("path", "")
@@ -447,7 +477,12 @@ class LocationResource(ModelResource):
         if not path.startswith(location_path):
             path = os.path.join(location_path, path)
 
-        objects = self.get_objects(location.space, path)
+        try:
+            paging = SpaceResource._browse_paging(request)
+        except ValueError:
+            return http.HttpBadRequest(_("limit must be a positive integer"))
+
+        objects = self.get_objects(location.space, path, **paging)
 
         return self.create_response(request, objects)
 
@@ -1349,6 +1384,11 @@ class PackageResource(ModelResource):
             full_path = package.get_download_path(lockss_au_number)
         except StorageException:
             full_path, temp_dir = package.compress_package(utils.COMPRESSION_TAR)
+        byte_range = package.get_download_range(lockss_au_number)
+        if byte_range is not None:
+            name, begin, end = byte_range
+            LOGGER.debug('Sending bytes %s-%s of %s to client', begin, end, full_path)
+            return utils.download_file_range_stream(full_path, begin, end, name)
         LOGGER.debug('Sending file %s to client', full_path)
         response = utils.download_file_stream(full_path, temp_dir)
         return response
@@ -20,7 +20,7 @@ import requests
 # This project, alphabetical
 from locations import models
 from locations.models.async_manager import AsyncManager
-from common.utils import generate_checksum
+from common import checksums
 
 LOGGER = logging.getLogger(__name__)
 
@@ -93,13 +93,15 @@ def pad_destination_filepath_if_it_already_exists(filepath, original=None, attem
 
 
 def download_resource(
-    url, destination_path, filename=None, username=None, password=None
+    url, destination_path, filename=None, username=None, password=None, hasher=None
 ):
     """
     Download a resource.
 
     Download a URL resource to a destination directory, using the response's Content-Disposition header, if available, to determine the destination filename (using the filename at the end of the URL otherwise)
 
+    The response is streamed to disk. If `hasher` (a common.checksums.MultiHash) is provided, it is updated with the content as it is written.
+
     Returns filename of downloaded resource
     """
     LOGGER.info("downloading url: %s", url)
@@ -109,7 +111,7 @@ def download_resource(
         auth = (username, password)
 
     verify = not settings.INSECURE_SKIP_VERIFY
-    response = requests.get(url, auth=auth, verify=verify)
+    response = requests.get(url, auth=auth, verify=verify, stream=True)
     if filename is None:
         if "content-disposition" in response.headers:
             filename = parse_filename_from_content_disposition(
@@ -121,7 +123,10 @@ def download_resource(
 
     filepath = os.path.join(destination_path, filename)
     with open(filepath, "wb") as fp:
-        fp.write(response.content)
+        if hasher is not None:
+            fp = checksums.HashingWriter(fp, hasher)
+        for chunk in response.iter_content(chunk_size=checksums.BUFFER_SIZE):
+            fp.write(chunk)
 
     return filename
 
@@ -192,20 +197,21 @@ def _fetch_content(deposit_uuid, objects, subdirs=None):
             task_file.url = item["url"]
             task_file.save()
 
+            # Compute both checksums while downloading
+            hasher = checksums.MultiHash(["md5", "sha512"])
             download_resource(
                 url=item["url"],
                 destination_path=temp_dir,
                 filename=filename,
                 username=fedora_username,
                 password=fedora_password,
+                hasher=hasher,
             )
 
             temp_filename = os.path.join(temp_dir, filename)
 
-            if (
-                item["checksum"] is not None
-                and item["checksum"]
-                != generate_checksum(temp_filename, "md5").hexdigest()
+            if item["checksum"] is not None and item["checksum"] != hasher.hexdigest(
+                "md5"
             ):
                 os.unlink(temp_filename)
                 raise Exception(_("Incorrect checksum"))
@@ -232,7 +238,7 @@ def _fetch_content(deposit_uuid, objects, subdirs=None):
             file_record = models.File(
                 name=item["filename"],
                 source_id=item["object_id"],
-                checksum=generate_checksum(new_path, "sha512").hexdigest(),
+                checksum=hasher.hexdigest("sha512"),
             )
             file_record.save()
         except Exception as e:
@@ -10,9 +10,20 @@ class PipelineResource(resources.PipelineResource):
     shared_path = fields.CharField(use_in=lambda x: False)
 
 
+def _browse(space, path, paging):
+    """Call ``space.browse`` with the markers of paged listings encoded in
+    base64, like the entries are."""
+    if "marker" in paging:
+        paging = dict(paging, marker=base64.b64decode(paging["marker"]))
+    objects = space.browse(path, **paging)
+    if "next_marker" in objects:
+        objects["next_marker"] = base64.b64encode(objects["next_marker"])
+    return objects
+
+
 class SpaceResource(resources.SpaceResource):
-    def get_objects(self, space, path):
-        objects = space.browse(path)
+    def get_objects(self, space, path, **paging):
+        objects = _browse(space, path, paging)
         objects["entries"] = map(base64.b64encode, objects["entries"])
         objects["directories"] = map(base64.b64encode, objects["directories"])
 
@@ -27,8 +38,8 @@ class LocationResource(resources.LocationResource):
     def decode_path(self, path):
         return str(base64.b64decode(path))
 
-    def get_objects(self, space, path):
-        objects = space.browse(path)
+    def get_objects(self, space, path, **paging):
+        objects = _browse(space, path, paging)
         objects["entries"] = map(base64.b64encode, objects["entries"])
         objects["directories"] = map(base64.b64encode, objects["directories"])
         objects["properties"] = {
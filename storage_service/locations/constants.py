@@ -106,6 +106,8 @@ PROTOCOL = {
             "aws_secret_access_key",
             "s3_region",
             "s3_bucket",
+            "s3_part_size",
+            "s3_max_concurrency",
         ],
     },
     models.Space.WELLCOME: {
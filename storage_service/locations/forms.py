@@ -199,7 +199,7 @@ class GPGForm(forms.ModelForm):
 
     class Meta:
         model = models.GPG
-        fields = ("key",)
+        fields = ("key", "segment_size")
 
 
 class LocalFilesystemForm(forms.ModelForm):
@@ -225,7 +225,13 @@ class LockssomaticForm(forms.ModelForm):
     # TODO SpaceForm.path help text should say path to staging space, preferably local
     class Meta:
         model = models.Lockssomatic
-        fields = ("sd_iri", "content_provider_id", "external_domain", "keep_local")
+        fields = (
+            "sd_iri",
+            "content_provider_id",
+            "external_domain",
+            "keep_local",
+            "virtual_chunks",
+        )
 
     def clean_external_domain(self):
         data = self.cleaned_data["external_domain"]
@@ -263,6 +269,8 @@ class S3Form(forms.ModelForm):
             "aws_assumed_role",
             "s3_region",
             "s3_bucket",
+            "s3_part_size",
+            "s3_max_concurrency",
         )
 
 
@@ -553,6 +561,8 @@ class WellcomeStorageServiceForm(forms.ModelForm):
             "s3_endpoint_url",
             "s3_region",
             "s3_bucket",
+            "s3_part_size",
+            "s3_max_concurrency",
             "callback_host",
             "callback_username",
             "callback_api_key",
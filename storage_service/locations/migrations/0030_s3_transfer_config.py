@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0029_auto_20200122_0726'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3',
+            name='s3_max_concurrency',
+            field=models.PositiveIntegerField(help_text='Number of parts or objects transferred at the same time. Leave blank for the default (10).', null=True, verbose_name='Maximum concurrency', blank=True),
+        ),
+        migrations.AddField(
+            model_name='s3',
+            name='s3_part_size',
+            field=models.PositiveIntegerField(help_text='Objects bigger than this are transferred in parts of this size. Leave blank for the default (8 MiB).', null=True, verbose_name='Multipart part size (MiB)', blank=True),
+        ),
+        migrations.AddField(
+            model_name='wellcomestorageservice',
+            name='s3_max_concurrency',
+            field=models.PositiveIntegerField(help_text='Number of parts or objects transferred at the same time. Leave blank for the default (10).', null=True, verbose_name='Maximum concurrency', blank=True),
+        ),
+        migrations.AddField(
+            model_name='wellcomestorageservice',
+            name='s3_part_size',
+            field=models.PositiveIntegerField(help_text='Objects bigger than this are transferred in parts of this size. Leave blank for the default (8 MiB).', null=True, verbose_name='Multipart part size (MiB)', blank=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0030_s3_transfer_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gpg',
+            name='segment_size',
+            field=models.PositiveIntegerField(help_text='If set, packages are split into segments of this size (at most 256 MiB), which are encrypted in parallel and can be decrypted separately. Leave blank to encrypt each package as a whole.', null=True, verbose_name='Segment size (MiB)', blank=True, validators=[django.core.validators.MaxValueValidator(256)]),
+        ),
+    ]
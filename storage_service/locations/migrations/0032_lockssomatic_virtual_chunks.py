@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0031_gpg_segment_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lockssomatic',
+            name='virtual_chunks',
+            field=models.BooleanField(default=False, help_text='If checked, large AIPs are sent to LOCKSS as byte ranges of the stored AIP instead of being split into separate files.', verbose_name='Virtual chunks?'),
+        ),
+    ]
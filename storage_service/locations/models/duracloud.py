@@ -5,7 +5,7 @@ import logging
 from lxml import etree
 import os
 import re
-import shutil
+import threading
 import urllib
 
 # Core Django, alphabetical
@@ -13,19 +13,43 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 # Third party dependencies, alphabetical
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import scandir
 
 # This project, alphabetical
-from common import utils
+from common import checksums, utils
 
 # This module, alphabetical
 from . import StorageException
 from .location import Location
+from .space import cached_client
 
 LOGGER = logging.getLogger(__name__)
 
 
+class _FileRange(object):
+    """Read-only view of the next `length` bytes of a file object.
+
+    It has a length, so requests streams it as a request body with the right
+    Content-Length.
+    """
+
+    def __init__(self, fileobj, length):
+        self._fileobj = fileobj
+        self._length = self._remaining = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        return data
+
+
 class Duracloud(models.Model):
     space = models.OneToOneField("Space", to_field="uuid")
     host = models.CharField(
@@ -72,16 +96,19 @@ class Duracloud(models.Model):
     # Size of chunks when reading files from disk to be uploaded - 1 MB (1,000,000 bytes).
     BUFFER_SIZE = 10 ** 6
 
-    def __init__(self, *args, **kwargs):
-        super(Duracloud, self).__init__(*args, **kwargs)
-        self._session = None
+    # Number of chunks of a chunked file transferred at the same time.
+    CHUNK_CONCURRENCY = 4
 
     @property
     def session(self):
-        if self._session is None:
-            self._session = requests.Session()
-            self._session.auth = (self.user, self.password)
-        return self._session
+        """requests session for DuraCloud. Each thread gets its own, kept
+        across instances of the space with the same credentials."""
+        local = cached_client(("duracloud", self.user, self.password), threading.local)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.auth = (self.user, self.password)
+        return session
 
     @property
     def duraspace_url(self):
@@ -208,19 +235,28 @@ class Duracloud(models.Model):
                 url = self.duraspace_url + urllib.quote(d)
                 response = self.session.delete(url)
 
-    def _download_file(self, url, download_path, expected_size=0, checksum=None):
+    def _download_file(
+        self, url, download_path, expected_size=0, checksum=None, package=None
+    ):
         """
         Helper to download files from DuraCloud.
 
+        The file is hashed while it is written, to verify it against the
+        expected checksum.
+
         :param url: URL to fetch the file from.
         :param download_path: Absolute path to store the downloaded file at.
+        :param package: (Optional) Package being downloaded, to record its
+            checksums on.
         :return: True on success, False if file not found
         :raises: StorageException if response code not 200 or 404
         """
+        hasher = checksums.hasher_for(package, "md5")
         LOGGER.debug("URL: %s", url)
-        response = self.session.get(url)
+        response = self.session.get(url, stream=True)
         LOGGER.debug("Response: %s", response)
         if response.status_code == 404:
+            response.close()
             # Check if chunked by looking for a .dura-manifest
             manifest_url = url + self.MANIFEST_SUFFIX
             LOGGER.debug("Manifest URL: %s", manifest_url)
@@ -234,27 +270,20 @@ class Duracloud(models.Model):
             root = etree.fromstring(response.content)
             expected_size = int(root.findtext("header/sourceContent/byteSize"))
             checksum = root.findtext("header/sourceContent/md5")
-            chunk_elements = [e for e in root.findall("chunks/chunk")]
-            # Download each chunk and append to original file
+            # Parse chunk elements into (URL, offset, size, checksum)
+            chunks = []
+            offset = 0
+            for e in root.findall("chunks/chunk"):
+                chunk_url = self.duraspace_url + urllib.quote(e.attrib["chunkId"])
+                size = int(e.findtext("byteSize"))
+                chunks.append((chunk_url, offset, size, e.findtext("md5")))
+                offset += size
             self.space.create_local_directory(download_path)
             LOGGER.debug("Writing to %s", download_path)
-            with open(download_path, "wb") as output_f:
-                for e in chunk_elements:
-                    # Parse chunk element
-                    chunk = e.attrib["chunkId"]
-                    size = int(e.findtext("byteSize"))
-                    md5 = e.findtext("md5")
-                    # Download
-                    chunk_url = self.duraspace_url + urllib.quote(chunk)
-                    LOGGER.debug("Chunk URL: %s", chunk_url)
-                    chunk_path = chunk_url.replace(url, download_path)
-                    LOGGER.debug("Chunk path: %s", chunk_path)
-                    self._download_file(chunk_url, chunk_path, size, md5)
-                    # Append to output
-                    with open(chunk_path, "rb") as chunk_f:
-                        shutil.copyfileobj(chunk_f, output_f)
-                    # Delete chunk_path
-                    os.remove(chunk_path)
+            # Allocate the file, each chunk is written at its offset
+            with open(download_path, "wb") as f:
+                f.truncate(offset)
+            self._download_chunks(chunks, download_path, hasher)
         elif response.status_code != 200:
             LOGGER.warning("Response: %s when fetching %s", response, url)
             LOGGER.warning("Response text: %s", response.text)
@@ -263,7 +292,9 @@ class Duracloud(models.Model):
             self.space.create_local_directory(download_path)
             LOGGER.debug("Writing to %s", download_path)
             with open(download_path, "wb") as f:
-                f.write(response.content)
+                writer = checksums.HashingWriter(f, hasher)
+                for data in response.iter_content(self.BUFFER_SIZE):
+                    writer.write(data)
 
         # Verify file, if size or checksum is known
         if expected_size and os.path.getsize(download_path) != expected_size:
@@ -277,17 +308,75 @@ class Duracloud(models.Model):
                     "actual_size": os.path.getsize(download_path),
                 },
             )
-        calculated_checksum = utils.generate_checksum(download_path, "md5")
-        if checksum and checksum != calculated_checksum.hexdigest():
+        if checksum and checksum != hasher.hexdigest("md5"):
             raise StorageException(
                 "File %s does not match expected checksum of %s, but was actually %s",
                 download_path,
                 checksum,
-                calculated_checksum.hexdigest(),
+                hasher.hexdigest("md5"),
             )
 
+        checksums.record_transfer_checksums(package, hasher)
         return True
 
+    def _download_chunks(self, chunks, download_path, hasher):
+        """
+        Download the chunks of a chunked file concurrently into download_path.
+
+        The file is hashed in order with hasher as the chunks complete, while
+        the following ones are still downloading.
+
+        :param chunks: List of (URL, offset, size, checksum) of the chunks.
+        :param download_path: Absolute path of the file, at least as big as
+            the chunks.
+        :raises: StorageException if a chunk can't be fetched or is corrupted
+        """
+        with ThreadPoolExecutor(max_workers=self.CHUNK_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(self._download_chunk, download_path, *chunk)
+                for chunk in chunks
+            ]
+            try:
+                with open(download_path, "rb") as f:
+                    for future in futures:
+                        remaining = future.result()
+                        while remaining > 0:
+                            data = f.read(min(self.BUFFER_SIZE, remaining))
+                            hasher.update(data)
+                            remaining -= len(data)
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _download_chunk(self, download_path, url, offset, size, checksum):
+        """
+        Download one chunk of a chunked file into download_path at offset.
+
+        :return: Size of the chunk
+        :raises: StorageException if the chunk can't be fetched, or doesn't
+            match size and checksum
+        """
+        LOGGER.debug("Chunk URL: %s", url)
+        response = self.session.get(url, stream=True)
+        if response.status_code != 200:
+            LOGGER.warning("Response: %s when fetching %s", response, url)
+            raise StorageException(_("Unable to fetch %(url)s") % {"url": url})
+        chunk_hasher = checksums.MultiHash("md5")
+        with open(download_path, "r+b") as f:
+            f.seek(offset)
+            writer = checksums.HashingWriter(f, chunk_hasher)
+            for data in response.iter_content(self.BUFFER_SIZE):
+                writer.write(data)
+        if writer.bytes_written != size or chunk_hasher.hexdigest("md5") != checksum:
+            raise StorageException(
+                _(
+                    "Chunk %(url)s does not match expected size of %(size)s bytes and checksum %(checksum)s"
+                )
+                % {"url": url, "size": size, "checksum": checksum}
+            )
+        return size
+
     def move_to_storage_service(self, src_path, dest_path, dest_space, package=None):
         """ Moves src_path to dest_space.staging_path/dest_path. """
         # Convert unicode strings to byte strings
@@ -296,7 +385,7 @@ class Duracloud(models.Model):
         dest_path = utils.coerce_str(dest_path)
         # Try to fetch if it's a file
         url = self.duraspace_url + urllib.quote(src_path)
-        success = self._download_file(url, dest_path)
+        success = self._download_file(url, dest_path, package=package)
         if not success:
             LOGGER.debug("%s not found, trying as folder", src_path)
             # File cannot be found - this may be a folder
@@ -313,20 +402,16 @@ class Duracloud(models.Model):
                 dest = entry.replace(src_path, dest_path, 1)
                 self._download_file(url, dest)
 
-    def _process_chunk(self, f, chunk_path):
-        bytes_read = 0
-
-        with open(chunk_path, "w") as fchunk:
-            while bytes_read < self.CHUNK_SIZE:
-                data = f.read(self.BUFFER_SIZE)
-                fchunk.write(data)
-
-                length = len(data)
-
-                if length < self.BUFFER_SIZE:
-                    raise StopIteration(_("End of file reached"))
-                else:
-                    bytes_read += length
+    def _hash_chunk(self, f, size, hashers):
+        """Read the next size bytes of f, hashing them with each of hashers."""
+        remaining = size
+        while remaining > 0:
+            data = f.read(min(self.BUFFER_SIZE, remaining))
+            if not data:
+                break
+            for hasher in hashers:
+                hasher.update(data)
+            remaining -= len(data)
 
     def _upload_file(self, url, upload_file, resume=False):
         """
@@ -357,8 +442,6 @@ class Duracloud(models.Model):
                 url.replace(self.duraspace_url, "", 1)
             ).lstrip("/")
             LOGGER.debug("File name: %s", relative_path)
-            checksum = utils.generate_checksum(upload_file, "md5")
-            LOGGER.debug("Checksum for %s: %s", upload_file, checksum.hexdigest())
             root = etree.Element(
                 "{duracloud.org}chunksManifest", nsmap={"dur": "duracloud.org"}
             )
@@ -366,53 +449,59 @@ class Duracloud(models.Model):
             content = etree.SubElement(header, "sourceContent", contentId=relative_path)
             etree.SubElement(content, "mimetype").text = "application/octet-stream"
             etree.SubElement(content, "byteSize").text = str(filesize)
-            etree.SubElement(content, "md5").text = checksum.hexdigest()
+            md5 = etree.SubElement(content, "md5")
             chunks = etree.SubElement(root, "chunks")
-            # Split file into chunks
-            with open(upload_file, "rb") as f:
-                # If resume, check if chunks already exists
-                if resume:
-                    chunklist = set(self._get_files_list(relative_path))
-                    LOGGER.debug("Chunklist %s", chunklist)
-                file_complete = False
-                i = 0
-                while not file_complete:
+            # If resume, check if chunks already exists
+            if resume:
+                chunklist = set(self._get_files_list(relative_path))
+                LOGGER.debug("Chunklist %s", chunklist)
+            # Hash the whole file and each chunk in order, and upload the
+            # chunks straight from the file concurrently as they are hashed
+            file_hasher = checksums.MultiHash("md5")
+            with ThreadPoolExecutor(
+                max_workers=self.CHUNK_CONCURRENCY
+            ) as executor, open(upload_file, "rb") as f:
+                futures = []
+                for i, offset in enumerate(range(0, filesize, self.CHUNK_SIZE)):
+                    size = min(self.CHUNK_SIZE, filesize - offset)
                     # Setup chunk info
                     chunk_suffix = ".dura-chunk-" + str(i).zfill(4)
-                    chunk_path = upload_file + chunk_suffix
-                    LOGGER.debug("Chunk path: %s", chunk_path)
                     chunk_url = url + chunk_suffix
                     LOGGER.debug("Chunk URL: %s", chunk_url)
                     chunkid = relative_path + chunk_suffix
                     LOGGER.debug("Chunk ID: %s", chunkid)
-                    try:
-                        self._process_chunk(f, chunk_path)
-                    except StopIteration:
-                        file_complete = True
+                    chunk_hasher = checksums.MultiHash("md5")
+                    self._hash_chunk(f, size, [file_hasher, chunk_hasher])
                     # Make chunk element
                     # <chunk chunkId="chunked/chunked_image.jpg.dura-chunk-0000" index="0">
                     #   <byteSize>2097152</byteSize>
                     #   <md5>ddbb227beaac5a9dc34eb49608997abf</md5>
                     # </chunk>
-                    checksum = utils.generate_checksum(chunk_path)
                     chunk_e = etree.SubElement(
                         chunks, "chunk", chunkId=chunkid, index=str(i)
                     )
-                    etree.SubElement(chunk_e, "byteSize").text = str(
-                        os.path.getsize(chunk_path)
+                    etree.SubElement(chunk_e, "byteSize").text = str(size)
+                    etree.SubElement(chunk_e, "md5").text = chunk_hasher.hexdigest(
+                        "md5"
                     )
-                    etree.SubElement(chunk_e, "md5").text = checksum.hexdigest()
                     # Upload chunk
                     # Check if chunk exists already
                     if resume and chunkid in chunklist:
-                        LOGGER.info(
-                            "%s already in Duracloud, skipping upload", chunk_path
-                        )
+                        LOGGER.info("%s already in Duracloud, skipping upload", chunkid)
                     else:
-                        self._upload_chunk(chunk_url, chunk_path)
-                    # Delete chunk
-                    os.remove(chunk_path)
-                    i += 1
+                        futures.append(
+                            executor.submit(
+                                self._upload_chunk,
+                                chunk_url,
+                                upload_file,
+                                offset=offset,
+                                length=size,
+                            )
+                        )
+            for future in futures:
+                future.result()
+            md5.text = file_hasher.hexdigest("md5")
+            LOGGER.debug("Checksum for %s: %s", upload_file, md5.text)
             # Write .dura-manifest
             manifest_path = upload_file + self.MANIFEST_SUFFIX
             manifest_url = url + self.MANIFEST_SUFFIX
@@ -430,29 +519,34 @@ class Duracloud(models.Model):
             # Example URL: https://trial.duracloud.org/durastore/trial261//ts/test.txt
             self._upload_chunk(url, upload_file)
 
-    def _upload_chunk(self, url, upload_file, retry_attempts=3):
+    def _upload_chunk(self, url, upload_file, retry_attempts=3, offset=0, length=None):
         """
-        Upload a single file to Duracloud.
+        Upload a single file, or part of a file, to Duracloud.
 
-        The file size must be less than self.CHUNK_SIZE.
-        Call _upload_file_check_chunking if the file might be larger.
+        The size uploaded must be less than self.CHUNK_SIZE.
+        Call _upload_file if the file might be larger.
 
         :param url: URL to upload the file to.
         :param upload_file: Absolute path to the file to upload.
         :param int retry_attempts: Number of retry attempts left.
+        :param int offset: Position in upload_file to upload from.
+        :param int length: Number of bytes to upload, or None to upload until
+            the end of the file.
         :returns: None
         :raises: StorageException if error storing file
         """
         try:
             LOGGER.debug("PUT URL: %s", url)
             with open(upload_file, "rb") as f:
-                response = self.session.put(url, data=f)
+                f.seek(offset)
+                data = f if length is None else _FileRange(f, length)
+                response = self.session.put(url, data=data)
             LOGGER.debug("Response: %s", response)
         except Exception:
             LOGGER.exception("Error in PUT to %s", url)
             if retry_attempts > 0:
                 LOGGER.info("Retrying %s", upload_file)
-                self._upload_chunk(url, upload_file, retry_attempts - 1)
+                self._upload_chunk(url, upload_file, retry_attempts - 1, offset, length)
             else:
                 raise
         else:
@@ -460,7 +554,9 @@ class Duracloud(models.Model):
                 LOGGER.warning("%s: Response: %s", response, response.text)
                 if retry_attempts > 0:
                     LOGGER.info("Retrying %s", upload_file)
-                    self._upload_chunk(url, upload_file, retry_attempts - 1)
+                    self._upload_chunk(
+                        url, upload_file, retry_attempts - 1, offset, length
+                    )
                 else:
                     raise StorageException(
                         _("Unable to store %(filename)s") % {"filename": upload_file}
@@ -1,20 +1,29 @@
 from __future__ import absolute_import
 
 # stdlib, alphabetical
+import collections
 import datetime
+import hashlib
+import io
+import json
 import logging
 import os
 import shutil
+import struct
 import subprocess
 import tarfile
+import tempfile
 
 # Core Django, alphabetical
 from django.conf import settings
+from django.core import validators
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils import six
 
 # Third party dependencies, alphabetical
+from concurrent.futures import ThreadPoolExecutor
+import scandir
 
 # This project, alphabetical
 from common import gpgutils, premis, utils
@@ -22,7 +31,6 @@ from common import gpgutils, premis, utils
 # This module, alphabetical
 from .location import Location
 from .package import Package
-from . import space
 
 
 LOGGER = logging.getLogger(__name__)
@@ -32,6 +40,24 @@ METS_BNS = "{" + utils.NSMAP["mets"] + "}"
 PREMIS_BNS = "{" + utils.NSMAP["premis"] + "}"
 
 
+# Size of the reads done when streaming decrypted data
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+# Suffix of the encrypted index of a package, see ``_package_index``
+INDEX_SUFFIX = ".index.gpg"
+
+# Packages encrypted in segments are stored in a container file starting
+# with this line, see ``_gpg_encrypt_container``. OpenPGP data never starts
+# with an ASCII character.
+CONTAINER_MAGIC = b"ARCHIVEMATICA-GPG-CONTAINER 1\n"
+
+# Largest segment size (in MiB) of a space. Each segment being encrypted or
+# decrypted is held in memory, settings.GPG_SEGMENTS_IN_FLIGHT at a time.
+MAX_SEGMENT_SIZE = 256
+
+MiB = 1024 * 1024
+
+
 class GPGException(Exception):
     pass
 
@@ -54,8 +80,13 @@ class GPG(models.Model):
     - re-encryption with a different key must be explicit (although this is not
       implemented yet; TODO (?))
 
-    Note: this space has does not (currently) implement the ``delete_path``
-    method.
+    Browsing a package does not decrypt it: when a package is encrypted, the
+    paths, types and sizes of its contents are recorded in an index, which is
+    itself encrypted with the same key and stored next to the package.
+
+    If the space has a ``segment_size``, packages are tarred and split into
+    segments that are encrypted separately, in parallel, and stored in a
+    single container file, see ``_gpg_encrypt_container``.
     """
 
     # package.py looks up this class attribute to determine if a package is
@@ -76,6 +107,17 @@ class GPG(models.Model):
             " decrypt packages stored in this space."
         ),
     )
+    segment_size = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[validators.MaxValueValidator(MAX_SEGMENT_SIZE)],
+        verbose_name=_("Segment size (MiB)"),
+        help_text=_(
+            "If set, packages are split into segments of this size (at most "
+            "256 MiB), which are encrypted in parallel and can be decrypted "
+            "separately. Leave blank to encrypt each package as a whole."
+        ),
+    )
 
     class Meta:
         verbose_name = _("GPG encryption on Local Filesystem")
@@ -99,12 +141,20 @@ class GPG(models.Model):
         # somewhere on the storage service. In this case, we decrypt at the
         # destination.
         if os.path.exists(src_path):
+            key_fingerprint = None
+            if _is_container(src_path):
+                key_fingerprint = (
+                    package.encryption_key_fingerprint
+                    if package is not None
+                    else _encr_path2key_fingerprint(src_path)
+                )
             self.space.move_rsync(src_path, dst_path)
-            _gpg_decrypt(dst_path)
+            _gpg_decrypt(dst_path, key_fingerprint)
         # When the source path does NOT exist, we are copying a single file or
         # directory from within an encrypted package, e.g., during SIP arrange.
-        # Here we must decrypt, copy, and then re-encrypt. This seems like it
-        # would be terribly inefficient when dealing with large transfers.
+        # Here we stream the decrypted package to ``tar``, which extracts only
+        # that member next to the destination. The encrypted package is left
+        # as it is.
         else:
             encr_path = _get_encrypted_path(src_path)
             if not encr_path:
@@ -114,23 +164,28 @@ class GPG(models.Model):
                         " nor is it in an encrypted directory." % {"src_path": src_path}
                     )
                 )
-            _gpg_decrypt(encr_path)
-            try:
-                if os.path.exists(src_path):
-                    self.space.move_rsync(src_path, dst_path)
-                else:
-                    raise GPGException(
-                        _(
-                            "Unable to move %(src_path)s; this file/dir does not"
-                            " exist, not even in encrypted directory"
-                            " %(encr_path)s."
-                            % {"src_path": src_path, "encr_path": encr_path}
-                        )
+            relpath = src_path[len(encr_path) :]
+            index = _read_index(encr_path)
+            if index is not None and _index_lookup(index, relpath) is None:
+                raise GPGException(
+                    _(
+                        "Unable to move %(src_path)s; this file/dir does not"
+                        " exist, not even in encrypted directory"
+                        " %(encr_path)s."
+                        % {"src_path": src_path, "encr_path": encr_path}
                     )
+                )
+            member = os.path.basename(encr_path) + relpath.rstrip("/")
+            decr_path = dst_path.rstrip("/") + ".decrypted"
+            try:
+                _gpg_extract_member(encr_path, member, decr_path)
+                decr_src_path = os.path.join(decr_path, member)
+                # Keep the trailing / of ``src_path``, which rsync cares about.
+                if src_path.endswith("/"):
+                    decr_src_path += "/"
+                self.space.move_rsync(decr_src_path, dst_path, try_mv_local=True)
             finally:
-                # Re-encrypt the decrypted package at source after copy, no
-                # matter what happens.
-                _gpg_encrypt(encr_path, _encr_path2key_fingerprint(encr_path))
+                _remove_if_exists(decr_path)
 
     def move_from_storage_service(self, src_path, dst_path, package=None):
         """Move AIP in SS at path ``src_path`` to GPG space at ``dst_path``,
@@ -150,12 +205,17 @@ class GPG(models.Model):
         key_fingerprint = self.key
         self.space.create_local_directory(dst_path)
         self.space.move_rsync(src_path, dst_path, try_mv_local=True)
+        index = _package_index(dst_path)
+        segment_size = self.segment_size * MiB if self.segment_size else None
         try:
-            __, encr_result = _gpg_encrypt(dst_path, key_fingerprint)
+            encr_path, encr_result = _gpg_encrypt(
+                dst_path, key_fingerprint, segment_size
+            )
         except GPGException:
             # If we fail to encrypt, then we send it back to where it came from.
             self.space.move_rsync(dst_path, src_path, try_mv_local=True)
             raise
+        _write_index(encr_path, index, key_fingerprint)
         # Update the GPG key fingerprint in db, if necessary.
         if package.encryption_key_fingerprint != key_fingerprint:
             package.encryption_key_fingerprint = key_fingerprint
@@ -208,20 +268,32 @@ class GPG(models.Model):
                 path,
             )
             return {"directories": [], "entries": [], "properties": {}}
-        # Decrypt and de-tar
-        _gpg_decrypt(encr_path)
-        key_fingerprint = _encr_path2key_fingerprint(encr_path)
-        # After decryption, ``path`` should exist if it is valid.
-        if not os.path.exists(path):
+        index = _read_index(encr_path)
+        if index is None:
+            # Packages encrypted before indexes were recorded are decrypted
+            # once to index them.
+            LOGGER.info(
+                "Package %s has no index, decrypting it to create one.", encr_path
+            )
+            key_fingerprint = _encr_path2key_fingerprint(encr_path)
+            decr_dir = _gpg_decrypt_copy(encr_path, key_fingerprint)
+            try:
+                index = _package_index(
+                    os.path.join(decr_dir, os.path.basename(encr_path))
+                )
+            finally:
+                shutil.rmtree(decr_dir)
+            _write_index(encr_path, index, key_fingerprint)
+        node = _index_lookup(index, path[len(encr_path) :])
+        if node is None or node["type"] != "directory":
             LOGGER.warning("Path %s in %s does not exist.", path, encr_path)
-            _gpg_encrypt(encr_path, key_fingerprint)
             return {"directories": [], "entries": [], "properties": {}}
-        try:
-            ret = space.path2browse_dict(path)
-        finally:
-            # No matter what happens, re-encrypt the decrypted package.
-            _gpg_encrypt(encr_path, key_fingerprint)
-        return ret
+        return _index2browse_dict(node)
+
+    def delete_path(self, delete_path):
+        """Deletes the package at ``delete_path`` and its index."""
+        _remove_if_exists(_index_path(delete_path.rstrip("/")))
+        self.space._delete_path_local(delete_path)
 
     def verify(self):
         """Verify that the space is accessible to the storage service."""
@@ -233,26 +305,35 @@ class GPG(models.Model):
         self.space.last_verified = datetime.datetime.now()
 
 
-def _gpg_encrypt(path, key_fingerprint):
+def _gpg_encrypt(path, key_fingerprint, segment_size=None):
     """Use GnuPG to encrypt the package at ``path`` using the GPG key
     matching the fingerprint ``key_fingerprint``. Returns the path to the
     encrypted file as well as a Python-GnuPG encryption result object with
     ``ok`` and ``status`` attributes, see
     https://pythonhosted.org/python-gnupg/.
+
+    A directory is archived by ``tar`` and its output piped to GnuPG, so the
+    encrypted file is written in a single pass without an intermediate
+    tarfile. The package is only replaced once it has been encrypted.
+
+    If ``segment_size`` is given, the package is encrypted in segments of
+    that many bytes, see ``_gpg_encrypt_container``.
     """
-    tar_created = False
-    if os.path.isdir(path):
-        _create_tar(path)
-        tar_created = True
-    encr_path, result = gpgutils.gpg_encrypt_file(path, key_fingerprint)
-    if os.path.isfile(encr_path) and result.ok:
+    path = path.rstrip("/")
+    remove = shutil.rmtree if os.path.isdir(path) else os.remove
+    if segment_size:
+        encr_path, result = _gpg_encrypt_container(path, key_fingerprint, segment_size)
+    elif os.path.isdir(path):
+        encr_path, result = _gpg_encrypt_dir(path, key_fingerprint)
+    else:
+        encr_path, result = gpgutils.gpg_encrypt_file(path, key_fingerprint)
+    if os.path.isfile(encr_path) and result is not None and result.ok:
         LOGGER.info("Successfully encrypted %s at %s", path, encr_path)
-        os.remove(path)
+        remove(path)
         os.rename(encr_path, path)
         return path, result
     else:
-        if tar_created:
-            _extract_tar(path)
+        _remove_if_exists(encr_path)
         fail_msg = _(
             "An error occured when attempting to encrypt" " %(path)s" % {"path": path}
         )
@@ -260,38 +341,8 @@ def _gpg_encrypt(path, key_fingerprint):
         raise GPGException(fail_msg)
 
 
-def _db_engine():
-    if "sqlite" in settings.DATABASES["default"]["ENGINE"]:
-        return "sqlite"
-    if "mysql" in settings.DATABASES["default"]["ENGINE"]:
-        return "mysql"
-    return "other"
-
-
-def _encr_path2key_fingerprint(encr_path):
-    """Given an encrypted path, return the fingerprint of the GPG key
-    used to encrypt the package. Since it was already encrypted, its
-    model must have a GPG fingerprint.
-    """
-    sql = (
-        "SELECT * FROM locations_package WHERE %s LIKE CONCAT('%%',"
-        " current_path, '%%')"
-    )
-    if _db_engine() == "sqlite":
-        sql = (
-            'SELECT * FROM locations_package WHERE %s LIKE "%" ||'
-            ' current_path || "%"'
-        )
-    matches = list(Package.objects.raw(sql, [encr_path]))
-    try:
-        return matches[0].encryption_key_fingerprint
-    except IndexError:
-        fail_msg = "Unable to find package matching encrypted path {}".format(encr_path)
-        LOGGER.error(fail_msg)
-        raise GPGException(fail_msg)
-
-
 def _abort_create_tar(path, tarpath):
+    _remove_if_exists(tarpath)
     fail_msg = _(
         "Failed to create a tarfile at %(tarpath)s for dir at %(path)s"
         % {"tarpath": tarpath, "path": path}
@@ -300,58 +351,594 @@ def _abort_create_tar(path, tarpath):
     raise GPGException(fail_msg)
 
 
-def _create_tar(path):
-    """Create a tarfile from the directory at ``path`` and overwrite ``path``
-    with that tarfile.
+def _gpg_encrypt_dir(path, key_fingerprint):
+    """Encrypt the directory at ``path`` to a tarfile at ``path`` + ".gpg",
+    piping the output of ``tar`` to GnuPG. Returns the same as
+    ``gpgutils.gpg_encrypt_file``.
     """
-    path = path.rstrip("/")
-    tarpath = "{}.tar".format(path)
-    changedir = os.path.dirname(tarpath)
+    encr_path = path + ".gpg"
+    changedir = os.path.dirname(path)
     source = os.path.basename(path)
-    cmd = ["tar", "-C", changedir, "-cf", tarpath, source]
+    cmd = ["tar", "-C", changedir, "-cf", "-", source]
     LOGGER.info(
-        "creating archive of %s at %s, relative to %s", source, tarpath, changedir
+        "creating encrypted archive of %s at %s, relative to %s",
+        source,
+        encr_path,
+        changedir,
     )
     try:
-        subprocess.check_output(cmd)
-    except (OSError, subprocess.CalledProcessError):
-        _abort_create_tar(path, tarpath)
-    if os.path.isfile(tarpath) and tarfile.is_tarfile(tarpath):
-        shutil.rmtree(path)
-        os.rename(tarpath, path)
-    else:
-        _abort_create_tar(path, tarpath)
+        tar = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except OSError:
+        _abort_create_tar(path, encr_path)
     try:
-        assert tarfile.is_tarfile(path)
-        assert not os.path.exists(tarpath)
-    except AssertionError:
-        _abort_create_tar(path, tarpath)
+        result = gpgutils.gpg_encrypt_stream(tar.stdout, key_fingerprint, encr_path)
+    finally:
+        # If GnuPG stopped reading, this makes tar fail instead of blocking.
+        tar.stdout.close()
+        returncode = tar.wait()
+    if returncode != 0:
+        _abort_create_tar(path, encr_path)
+    return encr_path, result
 
 
-def _abort_extract_tar(tarpath, newtarpath):
-    fail_msg = _(
-        "Failed to extract %(tarpath)s to a directory at the same"
-        " location." % {"tarpath": tarpath}
+def _index_path(encr_path):
+    """Return the path of the index of the package at ``encr_path``. It is
+    a hidden file, so it isn't listed with the packages of the location.
+    """
+    dirname, basename = os.path.split(encr_path)
+    return os.path.join(dirname, "." + basename + INDEX_SUFFIX)
+
+
+def _text(name):
+    if isinstance(name, six.binary_type):
+        return name.decode("utf8")
+    return name
+
+
+def _package_index(path):
+    """Return the index of the (decrypted) package at ``path``. It is a tree
+    of dicts describing each file and directory, with the recursive count of
+    files in each directory, which is all that ``GPG.browse`` needs.
+    """
+    if not os.path.isdir(path):
+        return {"type": "file", "size": os.path.getsize(path)}
+    children = {}
+    objects = 0
+    for entry in scandir.scandir(path):
+        child = children[_text(entry.name)] = _package_index(entry.path)
+        objects += child.get("objects", 1)
+    return {"type": "directory", "objects": objects, "children": children}
+
+
+def _write_index(encr_path, index, key_fingerprint):
+    """Encrypt ``index`` to the index of the package at ``encr_path``.
+    Failing to do so isn't fatal: the package is indexed again when browsed.
+    """
+    index_path = _index_path(encr_path)
+    data = json.dumps(index, sort_keys=True).encode("utf8")
+    try:
+        result = gpgutils.gpg_encrypt_stream(
+            io.BytesIO(data), key_fingerprint, index_path
+        )
+    except (IOError, OSError) as err:
+        result = None
+        LOGGER.warning("Failed to write the index of %s: %s", encr_path, err)
+    if not (result and result.ok):
+        LOGGER.warning("Failed to encrypt the index of %s", encr_path)
+        _remove_if_exists(index_path)
+
+
+def _read_index(encr_path):
+    """Return the index of the package at ``encr_path``, or None if it
+    doesn't have one or it can't be read.
+    """
+    index_path = _index_path(encr_path)
+    if not os.path.isfile(index_path):
+        return None
+    fd, decr_path = tempfile.mkstemp(dir=os.path.dirname(index_path), prefix=".")
+    os.close(fd)
+    try:
+        result = gpgutils.gpg_decrypt_file(index_path, decr_path)
+        if not result.ok:
+            LOGGER.warning(
+                "Failed to decrypt the index of %s: %s", encr_path, result.status
+            )
+            return None
+        with open(decr_path, "rb") as index_file:
+            return json.loads(index_file.read().decode("utf8"))
+    except (IOError, OSError, ValueError) as err:
+        LOGGER.warning("Failed to read the index of %s: %s", encr_path, err)
+        return None
+    finally:
+        _remove_if_exists(decr_path)
+
+
+def _index_lookup(index, relpath):
+    """Return the node of ``index`` at ``relpath``, relative to the package,
+    or None if there isn't one.
+    """
+    node = index
+    for name in _text(relpath).split("/"):
+        if not name:
+            continue
+        node = node.get("children", {}).get(name)
+        if node is None:
+            return None
+    return node
+
+
+def _index2browse_dict(node):
+    """Given the index of a directory, return the same dict as
+    ``space.path2browse_dict`` would for it.
+    """
+    should_count = not utils.get_setting("object_counting_disabled", False)
+
+    entries = []
+    directories = []
+    properties = {}
+
+    for name in sorted(node["children"], key=lambda name: name.lower()):
+        if name.startswith("."):
+            continue
+        child = node["children"][name]
+        name = name.encode("utf8")
+        entries.append(name)
+        if child["type"] != "directory":
+            properties[name] = {"size": child["size"]}
+        else:
+            directories.append(name)
+            if should_count:
+                objects = child["objects"]
+                properties[name] = {
+                    "object count": objects if objects < 5000 else "5000+"
+                }
+
+    return {"directories": directories, "entries": entries, "properties": properties}
+
+
+class _SegmentWriter(object):
+    """Write-only file object cutting the data written to it in segments of
+    ``segment_size`` bytes, which are passed to ``add_segment``.
+    """
+
+    def __init__(self, segment_size, add_segment):
+        self.segment_size = segment_size
+        self.add_segment = add_segment
+        self.size = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.segment_size:
+            self.add_segment(bytes(self._buffer[: self.segment_size]))
+            del self._buffer[: self.segment_size]
+
+    def finish(self):
+        if self._buffer:
+            self.add_segment(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+class _SegmentEncrypter(object):
+    """Encrypt segments with ``executor`` and append them to the file object
+    ``container`` in order. To bound the memory used, at most
+    ``settings.GPG_SEGMENTS_IN_FLIGHT`` segments are held at a time: those
+    waiting to be appended, and the next one being cut.
+    """
+
+    def __init__(self, executor, container, segments_dir, key_fingerprint):
+        self.executor = executor
+        self.container = container
+        self.segments_dir = segments_dir
+        self.key_fingerprint = key_fingerprint
+        self.segments = []
+        self._pending = collections.deque()
+
+    def add(self, data):
+        encr_path = os.path.join(
+            self.segments_dir,
+            "{:08d}.gpg".format(len(self.segments) + len(self._pending)),
+        )
+        future = self.executor.submit(
+            gpgutils.gpg_encrypt_stream,
+            io.BytesIO(data),
+            self.key_fingerprint,
+            encr_path,
+        )
+        self._pending.append((encr_path, future))
+        while len(self._pending) >= settings.GPG_SEGMENTS_IN_FLIGHT:
+            self._append(*self._pending.popleft())
+
+    def finish(self):
+        while self._pending:
+            self._append(*self._pending.popleft())
+        return self.segments
+
+    def _append(self, encr_path, future):
+        result = future.result()
+        if not (result.ok and os.path.isfile(encr_path)):
+            raise GPGException(
+                _("Failed to encrypt segment: %(status)s") % {"status": result.status}
+            )
+        offset = self.container.tell()
+        checksum = hashlib.sha256()
+        with open(encr_path, "rb") as segment:
+            for data in iter(lambda: segment.read(STREAM_BUFFER_SIZE), b""):
+                checksum.update(data)
+                self.container.write(data)
+        os.remove(encr_path)
+        self.segments.append(
+            {
+                "offset": offset,
+                "size": self.container.tell() - offset,
+                "sha256": checksum.hexdigest(),
+            }
+        )
+
+
+def _write_plaintext(path, fileobj):
+    """Write the package at ``path`` to ``fileobj``: a directory as a
+    tarfile and a file as it is. For a tarfile, returns the range of bytes
+    that each member takes, including the members of a directory, so it can
+    be extracted alone. Otherwise returns None.
+    """
+    if not os.path.isdir(path):
+        with open(path, "rb") as package:
+            shutil.copyfileobj(package, fileobj, STREAM_BUFFER_SIZE)
+        return None
+    ranges = {}
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        # os.walk is top-down, so the members of a directory are contiguous.
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            # Symbolic links to directories aren't walked, so they are added
+            # along with the files.
+            names = sorted(filenames) + [
+                name for name in dirnames if os.path.islink(os.path.join(dirpath, name))
+            ]
+            for member_path in [dirpath] + [
+                os.path.join(dirpath, name) for name in names
+            ]:
+                arcname = os.path.normpath(
+                    os.path.join(
+                        os.path.basename(path), os.path.relpath(member_path, path)
+                    )
+                )
+                start = tar.offset
+                tarinfo = tar.gettarinfo(member_path, arcname)
+                if tarinfo.isreg():
+                    with open(member_path, "rb") as member:
+                        tar.addfile(tarinfo, member)
+                else:
+                    tar.addfile(tarinfo)
+                ranges[_text(arcname)] = [start, tar.offset]
+    for name, (__, end) in list(ranges.items()):
+        parent = os.path.dirname(name)
+        while parent:
+            ranges[parent][1] = max(ranges[parent][1], end)
+            parent = os.path.dirname(parent)
+    return ranges
+
+
+def _gpg_encrypt_container(path, key_fingerprint, segment_size):
+    """Encrypt the package at ``path`` to a container at ``path`` + ".gpg".
+
+    The package, tarred if it is a directory, is split in segments of
+    ``segment_size`` bytes, encrypted separately by concurrent GnuPG
+    processes. The container holds ``CONTAINER_MAGIC``, the encrypted
+    segments, and a manifest listing their offsets and checksums and the
+    ranges of the members of the tarfile. The manifest is encrypted and
+    signed with the key, and the container ends with its offset. Returns
+    the same as ``gpgutils.gpg_encrypt_file``, with the result of the
+    encryption of the manifest.
+    """
+    encr_path = path + ".gpg"
+    segments_dir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=".")
+    LOGGER.info(
+        "creating encrypted container of %s at %s, in segments of %s bytes",
+        path,
+        encr_path,
+        segment_size,
     )
-    LOGGER.error(fail_msg)
-    os.rename(newtarpath, tarpath)
-    raise GPGException(fail_msg)
+    try:
+        with open(encr_path, "wb") as container, ThreadPoolExecutor(
+            max_workers=settings.GPG_SEGMENTS_IN_FLIGHT
+        ) as executor:
+            container.write(CONTAINER_MAGIC)
+            encrypter = _SegmentEncrypter(
+                executor, container, segments_dir, key_fingerprint
+            )
+            writer = _SegmentWriter(segment_size, encrypter.add)
+            ranges = _write_plaintext(path, writer)
+            writer.finish()
+            manifest = {
+                "version": 1,
+                "segment_size": segment_size,
+                "size": writer.size,
+                "segments": encrypter.finish(),
+                "members": ranges,
+            }
+            manifest_path = os.path.join(segments_dir, "manifest.gpg")
+            result = gpgutils.gpg_encrypt_stream(
+                io.BytesIO(json.dumps(manifest, sort_keys=True).encode("utf8")),
+                key_fingerprint,
+                manifest_path,
+                sign=key_fingerprint,
+            )
+            if result.ok:
+                offset = container.tell()
+                with open(manifest_path, "rb") as manifest_file:
+                    shutil.copyfileobj(manifest_file, container, STREAM_BUFFER_SIZE)
+                container.write(struct.pack(">Q", offset))
+    except (GPGException, EnvironmentError, tarfile.TarError) as err:
+        LOGGER.error("Failed to create encrypted container of %s: %s", path, err)
+        result = None
+    finally:
+        shutil.rmtree(segments_dir)
+    return encr_path, result
 
 
-def _extract_tar(tarpath):
-    """Extract tarfile at ``path`` to a directory at ``path``."""
-    newtarpath = "{}.tar".format(tarpath)
-    os.rename(tarpath, newtarpath)
-    changedir = os.path.dirname(newtarpath)
-    cmd = ["tar", "-xf", newtarpath, "-C", changedir]
+def _is_container(path):
     try:
-        subprocess.check_output(cmd)
-    except (OSError, subprocess.CalledProcessError):
-        _abort_extract_tar(tarpath, newtarpath)
-    if os.path.isdir(tarpath):
-        os.remove(newtarpath)
-    else:
-        _abort_extract_tar(tarpath, newtarpath)
+        with open(path, "rb") as package:
+            return package.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+    except EnvironmentError:
+        return False
+
+
+def _read_manifest(path, key_fingerprint):
+    """Return the manifest of the container at ``path`` and the result of
+    its decryption, checking that it was signed with ``key_fingerprint``,
+    the key the package was encrypted with.
+    """
+    with open(path, "rb") as container:
+        container.seek(-8, os.SEEK_END)
+        end = container.tell()
+        (offset,) = struct.unpack(">Q", container.read(8))
+        container.seek(offset)
+        result = gpgutils.gpg_decrypt_stream(io.BytesIO(container.read(end - offset)))
+    if not result.ok:
+        raise GPGException(
+            _("Failed to decrypt the manifest of %(path)s: %(status)s")
+            % {"path": path, "status": result.status}
+        )
+    # The signature may be made by a subkey of the package's key
+    if not (
+        result.valid
+        and key_fingerprint in (result.fingerprint, result.pubkey_fingerprint)
+    ):
+        raise GPGException(
+            _("The manifest of %(path)s is not signed with the key %(fingerprint)s")
+            % {"path": path, "fingerprint": key_fingerprint}
+        )
+    return json.loads(result.data.decode("utf8")), result
+
+
+def _decrypt_segment(path, segment):
+    """Return the decrypted data of ``segment`` of the container at ``path``,
+    after checking its checksum.
+    """
+    with open(path, "rb") as container:
+        container.seek(segment["offset"])
+        data = container.read(segment["size"])
+    if hashlib.sha256(data).hexdigest() != segment["sha256"]:
+        raise GPGException(
+            _("Checksum mismatch for the segment at offset %(offset)s of %(path)s")
+            % {"offset": segment["offset"], "path": path}
+        )
+    result = gpgutils.gpg_decrypt_stream(io.BytesIO(data))
+    if not result.ok:
+        raise GPGException(
+            _("Failed to decrypt the segment at offset %(offset)s of %(path)s")
+            % {"offset": segment["offset"], "path": path}
+        )
+    return result.data
+
+
+def _container_data(path, manifest, start, end):
+    """Generate the decrypted data of the container at ``path`` from byte
+    ``start`` to ``end``, decrypting only the segments needed, in parallel.
+    """
+    segment_size = manifest["segment_size"]
+
+    def segment_data(offset, future):
+        return future.result()[max(start - offset, 0) : end - offset]
+
+    with ThreadPoolExecutor(max_workers=settings.GPG_SEGMENTS_IN_FLIGHT) as executor:
+        pending = collections.deque()
+        for index in range(start // segment_size, -(-end // segment_size)):
+            future = executor.submit(
+                _decrypt_segment, path, manifest["segments"][index]
+            )
+            pending.append((index * segment_size, future))
+            if len(pending) >= settings.GPG_SEGMENTS_IN_FLIGHT:
+                yield segment_data(*pending.popleft())
+        while pending:
+            yield segment_data(*pending.popleft())
+
+
+def _gpg_decrypt_container(path, decr_path, key_fingerprint, member=None):
+    """Decrypt the container at ``path``, encrypted with ``key_fingerprint``,
+    to ``decr_path``: a directory to which its tarfile is extracted, or a
+    file. If ``member`` is given, only that member of the tarfile is
+    decrypted and extracted. Returns the decryption result of the manifest
+    and whether the data was extracted.
+    """
+    manifest, result = _read_manifest(path, key_fingerprint)
+    ranges = manifest["members"]
+    start, end = 0, manifest["size"]
+    if member is not None:
+        if ranges is None:
+            raise GPGException(_("The decrypted data is not a tarfile"))
+        try:
+            start, end = ranges[_text(member)]
+        except KeyError:
+            raise GPGException(
+                _("%(member)s is not in %(path)s") % {"member": member, "path": path}
+            )
+    data = _container_data(path, manifest, start, end)
+    try:
+        if ranges is None:
+            with open(decr_path, "wb") as decr_file:
+                for chunk in data:
+                    decr_file.write(chunk)
+        else:
+            os.mkdir(decr_path)
+            cmd = ["tar", "-xf", "-", "-C", decr_path]
+            if member is not None:
+                cmd.append(member)
+            tar = subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=True)
+            try:
+                for chunk in data:
+                    tar.stdin.write(chunk)
+                if member is not None:
+                    # The range of a member doesn't include the end of the
+                    # archive.
+                    tar.stdin.write(b"\0" * tarfile.BLOCKSIZE * 2)
+            finally:
+                tar.stdin.close()
+                returncode = tar.wait()
+            if returncode != 0:
+                raise GPGException(
+                    _("tar exited with status %(code)s") % {"code": returncode}
+                )
+    except Exception:
+        data.close()
+        _remove_if_exists(decr_path)
+        raise
+    return result, ranges is not None
+
+
+def _remove_if_exists(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _encr_path2package(encr_path):
+    """Return the package at the encrypted path ``encr_path``, or containing
+    it. The path is split into the path of a location and ``current_path``
+    candidates, which are looked up exactly in the packages of that location.
+    """
+    encr_path = _text(encr_path)
+    locations = [
+        location
+        for location in Location.objects.select_related("space")
+        if encr_path.startswith(location.full_path.rstrip("/") + "/")
+    ]
+    for location in locations:
+        relpath = os.path.relpath(encr_path, location.full_path)
+        current_paths = []
+        while relpath:
+            current_paths.extend([relpath, relpath + "/"])
+            relpath = os.path.dirname(relpath)
+        matches = Package.objects.filter(
+            current_location=location, current_path__in=current_paths
+        )
+        if matches:
+            # The longest path is the innermost package.
+            return max(matches, key=lambda package: len(package.current_path))
+    return None
+
+
+def _encr_path2key_fingerprint(encr_path):
+    """Given an encrypted path, return the fingerprint of the GPG key
+    used to encrypt the package. Since it was already encrypted, its
+    model must have a GPG fingerprint.
+    """
+    package = _encr_path2package(encr_path)
+    if package is None or not package.encryption_key_fingerprint:
+        fail_msg = "Unable to find package matching encrypted path {}".format(encr_path)
+        LOGGER.error(fail_msg)
+        raise GPGException(fail_msg)
+    return package.encryption_key_fingerprint
+
+
+def _is_tar_header(block):
+    """Return True if ``block``, the first block of a file, is the header of
+    a POSIX or GNU tarfile (as created by ``_gpg_encrypt_dir``).
+    """
+    return len(block) == tarfile.BLOCKSIZE and block[257:262] == b"ustar"
+
+
+def _decrypts_to_tarfile(path):
+    """Return whether GnuPG decrypts the file at ``path`` to a tarfile.
+
+    Only the first block is decrypted: GnuPG stops when we close its output.
+    """
+    with tempfile.TemporaryFile() as status:
+        gpg = gpgutils.gpg_decrypt_process(path, status)
+        try:
+            head = gpg.stdout.read(tarfile.BLOCKSIZE)
+        finally:
+            gpg.stdout.close()
+            gpg.wait()
+    return _is_tar_header(head)
+
+
+def _gpg_decrypt_stream(path, decr_path, members=None):
+    """Use GnuPG to decrypt the file at ``path`` to ``decr_path``.
+
+    If the data is a tarfile, GnuPG's output is piped to ``tar`` and
+    extracted to the directory ``decr_path``, otherwise it is written to the
+    file ``decr_path``. If ``members`` is given, the data must be a tarfile
+    and only those members are extracted. Returns the Python-GnuPG
+    decryption result and whether the data was extracted.
+    """
+    if not _decrypts_to_tarfile(path):
+        if members is not None:
+            raise GPGException(_("The decrypted data is not a tarfile"))
+        return gpgutils.gpg_decrypt_file(path, decr_path), False
+    LOGGER.info("Decrypted data is a tarfile, extracting it to %s", decr_path)
+    os.mkdir(decr_path)
+    with tempfile.TemporaryFile() as status:
+        gpg = gpgutils.gpg_decrypt_process(path, status)
+        tar = subprocess.Popen(
+            ["tar", "-xf", "-", "-C", decr_path] + list(members or []),
+            stdin=gpg.stdout,
+            close_fds=True,
+        )
+        # Only tar reads GnuPG's output, so GnuPG stops if tar exits early.
+        gpg.stdout.close()
+        returncode = tar.wait()
+        gpg.wait()
+        result = gpgutils.gpg_decrypt_result(status)
+    if returncode != 0:
+        _remove_if_exists(decr_path)
+        fail_msg = _(
+            "Failed to decrypt %(path)s. Reason: %(reason)s"
+            % {
+                "path": path,
+                "reason": _("tar exited with status %(code)s") % {"code": returncode},
+            }
+        )
+        LOGGER.error(fail_msg)
+        raise GPGException(fail_msg)
+    return result, True
+
+
+def _gpg_extract_member(encr_path, member, decr_path):
+    """Use GnuPG to decrypt the package at ``encr_path``, a tarfile, and
+    extract only its file or directory ``member`` to the directory
+    ``decr_path``. The package is read once and left untouched.
+    """
+    if _is_container(encr_path):
+        _gpg_decrypt_container(
+            encr_path, decr_path, _encr_path2key_fingerprint(encr_path), member
+        )
+        return
+    decr_result, __ = _gpg_decrypt_stream(encr_path, decr_path, [member])
+    if not decr_result.ok:
+        _remove_if_exists(decr_path)
+        fail_msg = _(
+            "Failed to decrypt %(path)s. Reason: %(reason)s"
+            % {"path": encr_path, "reason": decr_result.status}
+        )
+        LOGGER.info(fail_msg)
+        raise GPGException(fail_msg)
+    LOGGER.info("Extracted %s from %s to %s.", member, encr_path, decr_path)
 
 
 def _parse_gpg_version(raw_gpg_version):
@@ -367,35 +954,71 @@ def _get_gpg_version():
     return _parse_gpg_version(gpgutils.gpg().version)
 
 
-def _gpg_decrypt(path):
+def _gpg_decrypt(path, key_fingerprint=None):
     """Use GnuPG to decrypt the file at ``path`` and then delete the
-    encrypted file.
+    encrypted file. ``key_fingerprint``, the key the package was encrypted
+    with, is required for containers, whose manifest must be signed by it.
+
+    A file without an extension may be a tarfile that we created in this
+    space using an uncompressed AIP as input. Those are decrypted through a
+    pipe to ``tar`` and extracted in a single pass.
     """
     if not os.path.isfile(path):
         fail_msg = _("Cannot decrypt file at %(path)s; no such file." % {"path": path})
         LOGGER.error(fail_msg)
         raise GPGException(fail_msg)
     decr_path = path + ".decrypted"
-    decr_result = gpgutils.gpg_decrypt_file(path, decr_path)
-    if decr_result.ok and os.path.isfile(decr_path):
+    extracted = False
+    if _is_container(path):
+        decr_result, extracted = _gpg_decrypt_container(
+            path, decr_path, key_fingerprint
+        )
+    elif os.path.splitext(path)[1] == "":
+        decr_result, extracted = _gpg_decrypt_stream(path, decr_path)
+    else:
+        decr_result = gpgutils.gpg_decrypt_file(path, decr_path)
+    if decr_result.ok and os.path.exists(decr_path):
         LOGGER.info("Successfully decrypted %s to %s.", path, decr_path)
         os.remove(path)
-        os.rename(decr_path, path)
+        if extracted:
+            # The tarfile contains a single directory, named like ``path``.
+            os.rename(os.path.join(decr_path, os.path.basename(path)), path)
+            os.rmdir(decr_path)
+        else:
+            os.rename(decr_path, path)
     else:
+        _remove_if_exists(decr_path)
         fail_msg = _(
             "Failed to decrypt %(path)s. Reason: %(reason)s"
             % {"path": path, "reason": decr_result.status}
         )
         LOGGER.info(fail_msg)
         raise GPGException(fail_msg)
-    # A tarfile without an extension is one that we created in this space
-    # using an uncompressed AIP as input. We extract those here.
-    if tarfile.is_tarfile(path) and os.path.splitext(path)[1] == "":
-        LOGGER.info("%s is a tarfile so we are extracting it", path)
-        _extract_tar(path)
     return path
 
 
+def _gpg_decrypt_copy(encr_path, key_fingerprint):
+    """Decrypt a copy of the package at ``encr_path``, encrypted with
+    ``key_fingerprint``, leaving the package itself encrypted. Returns the temporary directory, next to the package,
+    that contains the decrypted copy under the same name. The caller must
+    delete it.
+    """
+    decr_dir = tempfile.mkdtemp(dir=os.path.dirname(encr_path), prefix=".")
+    copy_path = os.path.join(decr_dir, os.path.basename(encr_path))
+    try:
+        try:
+            # ``_gpg_decrypt`` removes the encrypted file it decrypts, which
+            # is only this link to the package.
+            os.link(encr_path, copy_path)
+        except OSError:
+            shutil.copyfile(encr_path, copy_path)
+        _gpg_decrypt(copy_path, key_fingerprint)
+    except Exception:
+        shutil.rmtree(decr_dir)
+        raise
+    return decr_dir
+
+
 def _get_encrypted_path(encr_path):
     """Attempt to return the existing file path that is ``encr_path`` or
     one of its ancestor paths. This is needed when we are asked to move a
@@ -52,7 +52,9 @@ class LocalFilesystem(models.Model):
     def move_from_storage_service(self, source_path, destination_path, package=None):
         """ Moves self.staging_path/src_path to dest_path. """
         self.space.create_local_directory(destination_path)
-        return self.space.move_rsync(source_path, destination_path, try_mv_local=True)
+        return self.space.move_rsync(
+            source_path, destination_path, try_mv_local=True, try_link_local=True
+        )
 
     def verify(self):
         """ Verify that the space is accessible to the storage service. """
@@ -7,26 +7,169 @@ import logging
 from lxml import etree
 import math
 import os
+import select
 import shutil
 import subprocess
+import tempfile
 
 # Core Django, alphabetical
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.utils.six.moves import shlex_quote
 from django.utils.translation import ugettext_lazy as _
 
 # Third party dependencies, alphabetical
 import sword2
 
 # This project, alphabetical
-from common import utils
+from common import checksums, utils
 
 # This module, alphabetical
+from . import StorageException
 from .location import Location
 from .package import Package
 
 LOGGER = logging.getLogger(__name__)
 
+# Seconds between checks that tar is still running, while waiting for it to
+# open the next volume.
+POLL_INTERVAL = 0.1
+
+
+def _hash_byte_ranges(file_path, au_size, checksum_type):
+    """Divide ``file_path`` into byte ranges of ``au_size``, hashing each
+    range in a single pass over the file.
+
+    :returns: A list of ``(begin, end, checksum)``, one for each range, where
+        ``end`` is the last byte of the range.
+    """
+    ranges = []
+    begin = 0
+    with open(file_path, "rb") as f:
+        while True:
+            hasher = checksums.MultiHash(checksum_type)
+            remaining = au_size
+            while remaining:
+                buf = f.read(min(remaining, checksums.BUFFER_SIZE))
+                if not buf:
+                    break
+                hasher.update(buf)
+                remaining -= len(buf)
+            size = au_size - remaining
+            if not size:
+                return ranges
+            ranges.append((begin, begin + size - 1, hasher.hexdigest(checksum_type)))
+            begin += size
+
+
+def _volume_paths(name):
+    """Return the paths of the existing volumes ``<name>-1``, ``<name>-2``,
+    etc., in order."""
+    paths = []
+    while os.path.exists("{}-{}".format(name, len(paths) + 1)):
+        paths.append("{}-{}".format(name, len(paths) + 1))
+    return paths
+
+
+def _read_volume(fifo_path, path, tar, checksum_type):
+    """Copy the tar volume written to the FIFO ``fifo_path`` to ``path``,
+    hashing it as it is written.
+
+    The FIFO is opened without blocking and waited on with select, checking
+    that ``tar`` is still running, so nothing blocks on a FIFO tar never
+    opens (which would hang the worker under gevent).
+
+    :returns: ``(size, checksum)`` of the volume, or None if tar exited
+        without writing one.
+    """
+    hasher = checksums.MultiHash(checksum_type)
+    size = 0
+    dst = None
+    fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while True:
+            select.select([fd], [], [], POLL_INTERVAL)
+            try:
+                data = os.read(fd, checksums.BUFFER_SIZE)
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+                # tar has opened the volume, but not written to it yet
+                continue
+            if data:
+                if dst is None:
+                    dst = open(path, "wb")
+                dst.write(data)
+                hasher.update(data)
+                size += len(data)
+            elif size:
+                # tar has closed the volume
+                return size, hasher.hexdigest(checksum_type)
+            elif tar.poll() is not None:
+                return None
+    finally:
+        os.close(fd)
+        if dst is not None:
+            dst.close()
+
+
+def _split_file(file_path, name, au_size, checksum_type):
+    """Split ``file_path`` into a multi-volume tar, with volumes of
+    ``au_size`` named ``<name>-1``, ``<name>-2``, etc.
+
+    tar writes each volume to its own FIFO (the new volume script names the
+    next one), and ``_read_volume`` copies it to its chunk, so the chunks
+    are hashed as they are written instead of being read again.
+
+    :returns: A list of ``(path, size, checksum)``, one for each chunk.
+    """
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(name))
+    fifo_prefix = os.path.join(temp_dir, "volume")
+    os.mkfifo(fifo_prefix + "-1")
+    command = [
+        "tar",
+        "--create",
+        "--multi-volume",
+        "--tape-length",
+        str(au_size),
+        "--new-volume-script",
+        "echo {}-$TAR_VOLUME >&$TAR_FD".format(shlex_quote(fifo_prefix)),
+        "-f",
+        fifo_prefix + "-1",
+        file_path,
+    ]
+    LOGGER.info("LOCKSS split command: %s", command)
+    chunks = []
+    try:
+        tar = subprocess.Popen(command, close_fds=True)
+        try:
+            while True:
+                number = len(chunks) + 1
+                # Ready before tar asks for it
+                os.mkfifo("{}-{}".format(fifo_prefix, number + 1))
+                path = "{}-{}".format(name, number)
+                volume = _read_volume(
+                    "{}-{}".format(fifo_prefix, number), path, tar, checksum_type
+                )
+                if volume is None:
+                    break
+                chunks.append((path,) + volume)
+            if tar.wait() != 0:
+                raise subprocess.CalledProcessError(tar.returncode, command)
+        finally:
+            if tar.poll() is None:
+                tar.kill()
+                tar.wait()
+    except Exception:
+        LOGGER.exception("Split of %s failed with command %s", file_path, command)
+        # Don't leave incomplete chunks behind
+        for path in _volume_paths(name):
+            os.remove(path)
+        raise
+    finally:
+        shutil.rmtree(temp_dir)
+    return chunks
+
 
 class Lockssomatic(models.Model):
     """ Spaces that store their contents in LOCKSS, via LOCKSS-o-matic. """
@@ -84,6 +227,14 @@ class Lockssomatic(models.Model):
             "If checked, keep a local copy even after the AIP is stored in the LOCKSS network."
         ),
     )
+    virtual_chunks = models.BooleanField(
+        blank=True,
+        default=False,
+        verbose_name=_("Virtual chunks?"),
+        help_text=_(
+            "If checked, large AIPs are sent to LOCKSS as byte ranges of the stored AIP instead of being split into separate files."
+        ),
+    )
 
     class Meta:
         verbose_name = _("LOCKSS-o-matic")
@@ -108,7 +259,9 @@ class Lockssomatic(models.Model):
     def move_from_storage_service(self, source_path, destination_path, package=None):
         """ Moves self.staging_path/source_path to destination_path. """
         self.space.create_local_directory(destination_path)
-        return self.space.move_rsync(source_path, destination_path)
+        self.space.move_rsync(source_path, destination_path)
+        if package is not None:
+            self._record_dublin_core(package)
 
     def post_move_from_storage_service(self, staging_path, destination_path, package):
         # LOCKSS can only save packages in the storage service, since it needs
@@ -474,46 +627,39 @@ class Lockssomatic(models.Model):
             LOGGER.info("LOCKSS: after splitting: %s", output_files)
             return output_files
 
-        # Split file
-        # Strip extension, add .tar-1 ('-1' to make rename script happy)
-        output_path = os.path.splitext(file_path)[0] + ".tar-1"
-        command = [
-            "tar",
-            "--create",
-            "--multi-volume",
-            "--tape-length",
-            str(self.au_size),
-            "--new-volume-script",
-            "common/tar_new_volume.sh",
-            "-f",
-            output_path,
-            file_path,
-        ]
-        # TODO reserve space in quota for extra files
-        LOGGER.info("LOCKSS split command: %s", command)
-        try:
-            subprocess.check_call(command)
-        except Exception:
-            LOGGER.exception("Split of %s failed with command %s", file_path, command)
-            raise
-        output_path = output_path[:-2]  # Remove '-1'
-        dirname, basename = os.path.split(output_path)
-        output_files = sorted(
-            [
-                os.path.join(dirname, entry)
-                for entry in os.listdir(dirname)
-                if entry.startswith(basename)
+        checksum_type = self._checksum_algorithm()
+        if self.virtual_chunks:
+            # Each chunk is a byte range of the AIP, served from the AIP itself
+            basename = os.path.basename(file_path)
+            ranges = _hash_byte_ranges(file_path, self.au_size, checksum_type)
+            chunks = [
+                ("{}.au-{}".format(basename, idx + 1), end - begin + 1, checksum)
+                for idx, (begin, end, checksum) in enumerate(ranges)
             ]
-        )
+            event_detail = _("Byte ranges of %(size)s bytes") % {"size": self.au_size}
+        else:
+            # Split file, hashing the chunks as tar writes them
+            # Strip extension, add .tar ('-N' is added for each volume)
+            # TODO reserve space in quota for extra files
+            chunks = _split_file(
+                file_path,
+                os.path.splitext(file_path)[0] + ".tar",
+                self.au_size,
+                checksum_type,
+            )
+            ranges = None
+            try:
+                event_detail = subprocess.check_output(["tar", "--version"])
+            except subprocess.CalledProcessError as e:
+                event_detail = e.output or _(
+                    "Error: getting tool info; probably GNU tar"
+                )
+        output_files = [chunk[0] for chunk in chunks]
 
         # Update pointer file
         amdsec = self.pointer_root.find("mets:amdSec", namespaces=utils.NSMAP)
 
         # Add 'division' PREMIS:EVENT
-        try:
-            event_detail = subprocess.check_output(["tar", "--version"])
-        except subprocess.CalledProcessError as e:
-            event_detail = e.output or _("Error: getting tool info; probably GNU tar")
         utils.mets_add_event(
             amdsec,
             event_type="division",
@@ -544,8 +690,10 @@ class Lockssomatic(models.Model):
             )
             div.append(local_ftpr)  # This moves local_fptr
 
+        checksum_name = checksum_type.upper().replace("SHA", "SHA-")
+
         # Add each split chunk to structMap & fileSec
-        for idx, out_path in enumerate(output_files):
+        for idx, (out_path, size, checksum) in enumerate(chunks):
             # Add div to structMap
             div = etree.SubElement(
                 aip_div,
@@ -556,22 +704,23 @@ class Lockssomatic(models.Model):
             etree.SubElement(
                 div, utils.PREFIX_NS["mets"] + "fptr", FILEID=os.path.basename(out_path)
             )
-            # Get checksum and size for fileSec
-            try:
-                checksum = utils.generate_checksum(out_path, self.checksum_type)
-            except ValueError:  # Invalid checksum type
-                checksum = utils.generate_checksum(out_path, "md5")
-            checksum_name = checksum.name.upper().replace("SHA", "SHA-")
-            size = os.path.getsize(out_path)
             # Add file & FLocat to fileSec
             file_e = etree.SubElement(
                 filegrp,
                 utils.PREFIX_NS["mets"] + "file",
                 ID=os.path.basename(out_path),
                 SIZE=str(size),
-                CHECKSUM=checksum.hexdigest(),
+                CHECKSUM=checksum,
                 CHECKSUMTYPE=checksum_name,
             )
+            if ranges:
+                # The chunk's bytes are in the local copy of the AIP, so it
+                # has no FLocat of its own (which would be deleted)
+                begin, end = ranges[idx][:2]
+                file_e.set("BEGIN", str(begin))
+                file_e.set("END", str(end))
+                file_e.set("BETYPE", "BYTE")
+                continue
             flocat = etree.SubElement(
                 file_e,
                 utils.PREFIX_NS["mets"] + "FLocat",
@@ -593,6 +742,38 @@ class Lockssomatic(models.Model):
 
         return output_files
 
+    def chunk_byte_range(self, package, index):
+        """Return ``(name, begin, end)`` for LOCKSS chunk number ``index`` of
+        ``package`` if it is the byte range ``begin`` to ``end`` (inclusive)
+        of the AIP, or None if the chunk is a separate file."""
+        if not self.pointer_root:
+            self.pointer_root = etree.parse(package.full_pointer_file_path)
+        fptr = self.pointer_root.find(
+            ".//mets:div[@TYPE='LOCKSS chunk'][@ORDER='{}']/mets:fptr".format(index),
+            namespaces=utils.NSMAP,
+        )
+        if fptr is None:
+            return None
+        file_e = self.pointer_root.find(
+            ".//mets:fileGrp[@USE='LOCKSS chunk']/mets:file[@ID='{}']".format(
+                fptr.get("FILEID")
+            ),
+            namespaces=utils.NSMAP,
+        )
+        if file_e is None or file_e.get("BETYPE") != "BYTE":
+            return None
+        return file_e.get("ID"), int(file_e.get("BEGIN")), int(file_e.get("END"))
+
+    def _checksum_algorithm(self):
+        """Return the hashlib name of the checksum algorithm to use for
+        files sent to LOCKSS, falling back to md5 if checksum_type is not
+        supported."""
+        try:
+            hasher = checksums.MultiHash(self.checksum_type)
+        except (TypeError, ValueError):  # Invalid checksum type
+            return "md5"
+        return hasher[self.checksum_type].name
+
     def _download_url(self, uuid, index=None):
         """
         Returns externally available download URL for a file.
@@ -619,49 +800,94 @@ class Lockssomatic(models.Model):
         download_url = self.external_domain + download_url
         return download_url
 
-    def _create_resource(self, package, output_files):
-        """ Given a package, create an Atom resource entry to send to LOCKSS.
+    def _record_dublin_core(self, package):
+        """Record the Dublin Core title and description (and the organization
+        agent) of ``package``, from its AIP METS, in the package's
+        ``misc_attributes``.
 
-        Parses metadata for the Atom entry from the METS file, uses
-        LOCKSS-o-matic-specific tags to describe size and checksums.
+        This is done when the AIP is stored, so depositing it in LOCKSS (and
+        retrying the deposit) doesn't extract the METS from the AIP again.
         """
-
-        # Parse METS to get information for atom entry
         relative_mets_path = os.path.join(
             os.path.splitext(os.path.basename(package.current_path))[0],
             "data",
             "METS.{}.xml".format(package.uuid),
         )
-        (mets_path, temp_dir) = package.extract_file(relative_mets_path)
-        mets = etree.parse(mets_path)
-        # Delete temp dir if created
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-
-        # Parse out name and description if found
-        slug = str(package.uuid)
-        title = os.path.basename(package.current_path)
-        summary = "AIP generated by Archivematica with uuid {}".format(package.uuid)
-        dublincore = mets.find(
+        try:
+            (mets_path, temp_dir) = package.extract_file(relative_mets_path)
+            try:
+                mets = etree.parse(mets_path)
+            finally:
+                # Delete temp dir if created
+                if os.path.exists(temp_dir):
+                    shutil.rmtree(temp_dir)
+        except (EnvironmentError, etree.XMLSyntaxError, StorageException):
+            LOGGER.warning(
+                "Unable to read the METS of %s for LOCKSS", package.uuid, exc_info=True
+            )
+            return
+
+        dublincore = {}
+        dc = mets.find(
             'mets:dmdSec/mets:mdWrap[@MDTYPE="DC"]/mets:xmlData/dcterms:dublincore',
             namespaces=utils.NSMAP,
         )
-        if dublincore is not None:
-            title = dublincore.findtext(
-                "dcterms:title", namespaces=utils.NSMAP, default=title
-            )
-            slug = dublincore.findtext(
-                "dcterms:title", namespaces=utils.NSMAP, default=slug
-            )
-            summary = dublincore.findtext(
-                "dcterms:description", namespaces=utils.NSMAP, default=summary
-            )
-        # Parse out Agent for author
+        if dc is not None:
+            for term in ("title", "description"):
+                value = dc.findtext("dcterms:" + term, namespaces=utils.NSMAP)
+                if value is not None:
+                    dublincore[term] = value
         authors = mets.xpath(
             ".//mets:mdWrap[@MDTYPE='PREMIS:AGENT']//mets:agentType[text()='organization']/ancestor::mets:agent/*/mets:agentIdentifierValue",
             namespaces=utils.NSMAP,
         )
-        author = authors[0].text if authors else None
+        if authors:
+            dublincore["author"] = authors[0].text
+
+        package.misc_attributes["dublincore"] = dublincore
+
+    def _dublin_core(self, package):
+        """Return the Dublin Core of ``package`` recorded when it was stored,
+        see ``_record_dublin_core``.
+
+        Packages stored before it was recorded, or whose METS couldn't be
+        read then, have it recorded now.
+        """
+        if "dublincore" not in package.misc_attributes:
+            self._record_dublin_core(package)
+            if "dublincore" in package.misc_attributes:
+                package.save(update_fields=["misc_attributes"])
+        return package.misc_attributes.get("dublincore", {})
+
+    def _pointer_author(self):
+        """Return the organization agent recorded in the pointer file when
+        the AIP was stored, if there is one."""
+        authors = self.pointer_root.xpath(
+            ".//mets:mdWrap[@MDTYPE='PREMIS:AGENT']//premis:agent[premis:agentType='organization']/premis:agentIdentifier/premis:agentIdentifierValue",
+            namespaces=utils.NSMAP,
+        )
+        return authors[0].text if authors else None
+
+    def _create_resource(self, package, output_files):
+        """ Given a package, create an Atom resource entry to send to LOCKSS.
+
+        Takes metadata for the Atom entry from the pointer file and the
+        Dublin Core of the METS file, uses LOCKSS-o-matic-specific tags to
+        describe size and checksums.
+        """
+        if not self.pointer_root:
+            self.pointer_root = etree.parse(package.full_pointer_file_path)
+        dublincore = self._dublin_core(package)
+
+        # Use name and description if found
+        slug = dublincore.get("title", str(package.uuid))
+        title = dublincore.get("title", os.path.basename(package.current_path))
+        summary = dublincore.get(
+            "description",
+            "AIP generated by Archivematica with uuid {}".format(package.uuid),
+        )
+        # The organization agent is the author
+        author = self._pointer_author() or dublincore.get("author")
 
         # Create atom entry
         entry = sword2.Entry(
@@ -672,8 +898,6 @@ class Lockssomatic(models.Model):
         )
 
         # Add each chunk to the atom entry
-        if not self.pointer_root:
-            self.pointer_root = etree.parse(package.full_pointer_file_path)
         entry.register_namespace("lom", utils.NSMAP["lom"])
         for index, file_path in enumerate(output_files):
             # Get external URL
@@ -695,12 +919,11 @@ class Lockssomatic(models.Model):
                 size = int(file_e.get("SIZE"))
             else:
                 # Not split, generate
-                try:
-                    checksum = utils.generate_checksum(file_path, self.checksum_type)
-                except ValueError:  # Invalid checksum type
-                    checksum = utils.generate_checksum(file_path, "md5")
-                checksum_name = checksum.name.upper().replace("SHA", "SHA-")
-                checksum_value = checksum.hexdigest()
+                checksum_type = self._checksum_algorithm()
+                checksum_name = checksum_type.upper().replace("SHA", "SHA-")
+                checksum_value = utils.generate_checksum(
+                    file_path, checksum_type
+                ).hexdigest()
                 size = os.path.getsize(file_path)
 
             # Convert size to kB
@@ -36,13 +36,13 @@ import requests
 import scandir
 
 # This project, alphabetical
-from common import premis, utils
+from common import fastcopy, premis, utils
 from locations import signals
 
 # This module, alphabetical
 from . import StorageException
 from .location import Location
-from .space import Space, PosixMoveUnsupportedError
+from .space import Space, PosixMoveUnsupportedError, ServerSideCopyUnsupportedError
 from .event import Callback, CallbackError, File
 from .fixity_log import FixityLog
 
@@ -173,6 +173,11 @@ class Package(models.Model):
         self.local_path_location = None
         self.origin_location = None
 
+        # Temporary attributes to track checksums of the package computed by
+        # spaces while it was being moved (see common.checksums)
+        self.transfer_checksum_algorithms = [Package.DEFAULT_CHECKSUM_ALGORITHM]
+        self.transfer_checksums = {}
+
     def __unicode__(self):
         return u"{uuid}: {path}".format(uuid=self.uuid, path=self.full_path)
         # return "File: {}".format(self.uuid)
@@ -275,14 +280,30 @@ class Package(models.Model):
             path = full_path
         elif self.current_location.space.access_protocol == Space.LOM:
             # Only LOCKSS breaks files into AUs
-            # TODO Get path from pointer file
-            # self.pointer_root.find("mets:structMap/*/mets:div[@ORDER='{}']".format(lockss_au_number), namespaces=NSMAP)
-            path = os.path.splitext(full_path)[0] + ".tar-" + str(lockss_au_number)
+            if self.get_download_range(lockss_au_number) is not None:
+                # The AU is a byte range of the package itself
+                path = full_path
+            else:
+                # TODO Get path from pointer file
+                path = os.path.splitext(full_path)[0] + ".tar-" + str(lockss_au_number)
         else:  # LOCKSS AU number specified, but not a LOCKSS package
             LOGGER.warning("Trying to download LOCKSS chunk for a non-LOCKSS package.")
             path = full_path
         return path
 
+    def get_download_range(self, lockss_au_number=None):
+        """Return ``(name, begin, end)`` if LOCKSS AU ``lockss_au_number`` is
+        the byte range ``begin`` to ``end`` (inclusive) of this package rather
+        than a file of its own, otherwise None."""
+        if (
+            lockss_au_number is None
+            or self.current_location.space.access_protocol != Space.LOM
+        ):
+            return None
+        return self.current_location.space.get_child_space().chunk_byte_range(
+            self, lockss_au_number
+        )
+
     def get_local_path(self):
         """Return a locally accessible path to this Package if available.
 
@@ -438,23 +459,31 @@ class Package(models.Model):
             )
 
         except PosixMoveUnsupportedError:
-            origin_space.move_to_storage_service(
-                source_path=source_path,
-                destination_path=destination_path,
-                destination_space=destination_space,
-                package=None,
-            )
+            try:
+                origin_space.server_side_copy(
+                    source_path=source_path,
+                    destination_path=destination_path,
+                    destination_space=destination_space,
+                    package=None,
+                )
+            except ServerSideCopyUnsupportedError:
+                origin_space.move_to_storage_service(
+                    source_path=source_path,
+                    destination_path=destination_path,
+                    destination_space=destination_space,
+                    package=None,
+                )
 
-            origin_space.post_move_to_storage_service()
-            destination_space.move_from_storage_service(
-                source_path=destination_path,
-                destination_path=destination_path,
-                package=None,
-            )
+                origin_space.post_move_to_storage_service()
+                destination_space.move_from_storage_service(
+                    source_path=destination_path,
+                    destination_path=destination_path,
+                    package=None,
+                )
 
-            destination_space.post_move_from_storage_service(
-                destination_path, destination_path
-            )
+                destination_space.post_move_from_storage_service(
+                    destination_path, destination_path
+                )
 
         # If we get here everything went well, update with new location
         self.current_location = to_location
@@ -592,7 +621,28 @@ class Package(models.Model):
         replica_package.status = Package.PENDING
         replica_package.save()
 
+        # Get the master AIP's pointer file and extract the checksum details
+        master_ptr = self.get_pointer_instance()
+        if not master_ptr and self._replicate_server_side(
+            replica_package, replica_destination_path
+        ):
+            LOGGER.info(
+                "Finished replicating package %s as replica package %s",
+                replicandum_uuid,
+                replica_package.uuid,
+            )
+            return
+        if master_ptr:
+            master_ptr_aip_fsentry = master_ptr.get_file(file_uuid=self.uuid)
+            master_premis_object = master_ptr_aip_fsentry.get_premis_objects()[0]
+            master_checksum_algorithm = master_premis_object.message_digest_algorithm
+            master_checksum = master_premis_object.message_digest
+            # Ask the source space to hash the AIP while it is copied
+            if master_checksum_algorithm not in self.transfer_checksum_algorithms:
+                self.transfer_checksum_algorithms.append(master_checksum_algorithm)
+
         # Copy replicandum AIP from its source location to the SS
+        self.transfer_checksums = {}
         src_space.move_to_storage_service(
             source_path=os.path.join(
                 replicandum_location.relative_path, replicandum_path
@@ -605,21 +655,13 @@ class Package(models.Model):
         replica_package.save()
         src_space.post_move_to_storage_service()
 
-        # Get the master AIP's pointer file and extract the checksum details
-        master_ptr = self.get_pointer_instance()
         if master_ptr:
-            master_ptr_aip_fsentry = master_ptr.get_file(file_uuid=self.uuid)
-            master_premis_object = master_ptr_aip_fsentry.get_premis_objects()[0]
-            master_checksum_algorithm = master_premis_object.message_digest_algorithm
-            master_checksum = master_premis_object.message_digest
-
-            # Calculate the checksum of the replica while we have it locally,
-            # compare it to the master's checksum and create a PREMIS validation
-            # event out of the result.
-            replica_local_path = self.get_local_path()
-            replica_checksum = utils.generate_checksum(
-                replica_local_path, master_checksum_algorithm
-            ).hexdigest()
+            # Use the checksum of the replica computed while it was copied, or
+            # calculate it while we have it locally, compare it to the master's
+            # checksum and create a PREMIS validation event out of the result.
+            replica_checksum = self._transfer_checksum(
+                master_checksum_algorithm, self.get_local_path()
+            )
             checksum_report = _get_checksum_report(
                 master_checksum,
                 self.uuid,
@@ -693,6 +735,46 @@ class Package(models.Model):
             replica_package.uuid,
         )
 
+    def _replicate_server_side(self, replica_package, replica_destination_path):
+        """Copy this package to ``replica_package``'s location without going
+        through the storage service, if both spaces support it.
+
+        Only used for packages without a pointer file: the checksum of a
+        replica recorded in the pointer files has to be computed by reading
+        the copy, so those are staged locally.
+
+        :returns: True if the package was copied, False if the spaces don't
+            support server side copies.
+        """
+        src_space = self.current_location.space
+        dest_space = replica_package.current_location.space
+        try:
+            src_space.server_side_copy(
+                source_path=os.path.join(
+                    self.current_location.relative_path, self.current_path
+                ),
+                destination_path=replica_destination_path,
+                destination_space=dest_space,
+                package=replica_package,
+            )
+        except ServerSideCopyUnsupportedError:
+            return False
+        replica_package.status = Package.UPLOADED
+        replica_package.save()
+        self._update_quotas(dest_space, replica_package.current_location)
+        return True
+
+    def _transfer_checksum(self, algorithm, local_path):
+        """Return the ``algorithm`` checksum of this package.
+
+        Uses the checksum computed by the space while the package was last
+        moved, if there is one, otherwise reads ``local_path`` to compute it.
+        """
+        checksum = self.transfer_checksums.get(algorithm)
+        if checksum is None:
+            checksum = utils.generate_checksum(local_path, algorithm).hexdigest()
+        return checksum
+
     def should_have_pointer_file(self, package_full_path=None, package_type=None):
         """Returns ``True`` if the package is both an AIP/AIC and is a file.
         Note: because storage in certain locations (e.g., GPG encrypted
@@ -915,6 +997,7 @@ class Package(models.Model):
             # 8. call ``post_move_from_storage_service`` on the destination space,
             # 9. update quotas on the destination space, and
             # 10. persist the package to the database.
+            self.transfer_checksums = {}
             v.src_space.move_to_storage_service(
                 source_path=os.path.join(
                     self.origin_location.relative_path, self.origin_path
@@ -928,9 +1011,9 @@ class Package(models.Model):
             local_aip_path = os.path.join(v.dest_space.staging_path, self.current_path)
             checksum = None
             if v.should_have_pointer and (not v.already_generated_ptr_exists):
-                checksum = utils.generate_checksum(
-                    local_aip_path, Package.DEFAULT_CHECKSUM_ALGORITHM
-                ).hexdigest()
+                checksum = self._transfer_checksum(
+                    Package.DEFAULT_CHECKSUM_ALGORITHM, local_aip_path
+                )
             self.status = Package.STAGING
             self.save()
             v.src_space.post_move_to_storage_service()
@@ -942,8 +1025,16 @@ class Package(models.Model):
                 package=self,
             )
             # Update package status once transferred to SS
-            if v.dest_space.access_protocol not in (Space.LOM, Space.ARKIVUM):
+            if v.dest_space.access_protocol not in (
+                Space.LOM,
+                Space.ARKIVUM,
+                Space.WELLCOME,
+            ):
                 self.status = Package.UPLOADED
+            else:
+                # These spaces complete the upload themselves, maybe already
+                # (e.g. a Wellcome callback), so keep the status they saved.
+                self.refresh_from_db(fields=["status"])
             if related_package_uuid is not None:
                 related_package = Package.objects.get(uuid=related_package_uuid)
                 self.related_packages.add(related_package)
@@ -997,7 +1088,8 @@ class Package(models.Model):
         else:  # This package should not have a pointer file
             self.pointer_file_location = None
             self.pointer_file_path = None
-        self.save()
+        # Only save the pointer file, the status may have been updated since
+        self.save(update_fields=["pointer_file_location", "pointer_file_path"])
 
     def _create_pointer_file_write_to_disk(
         self,
@@ -1554,10 +1646,10 @@ class Package(models.Model):
                 head, tail = os.path.split(full_path)
                 src = os.path.join(head, relative_path)
                 os.mkdir(os.path.join(extract_path, basename))
-                shutil.copy(src, output_path)
+                fastcopy.copy(src, output_path)
             else:
                 src = full_path
-                shutil.copytree(full_path, output_path)
+                fastcopy.copytree(full_path, output_path)
 
             LOGGER.info("Copying from: %s to %s", src, output_path)
 
@@ -2,29 +2,49 @@
 from __future__ import absolute_import
 
 # stdlib, alphabetical
+import hashlib
 import logging
 import os
-import pprint
 from functools import wraps
+import threading
 
 # Core Django, alphabetical
+from django.core.cache import cache
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 # Third party dependencies, alphabetical
 import boto3
+from boto3.s3.transfer import TransferConfig
 import botocore
-import re
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 import scandir
 
 # This project, alphabetical
+from common import checksums, fixity
 
 # This module, alphabetical
 from . import StorageException
 from .location import Location
+from .space import ServerSideCopyUnsupportedError, cached_client
 
 LOGGER = logging.getLogger(__name__)
 
+MiB = 1024 * 1024
+
+# boto3 defaults, used when the space doesn't override them
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Maximum number of keys S3 returns in a single listing
+LIST_PAGE_SIZE = 1000
+
+# Maximum number of keys S3 deletes in a single request
+DELETE_BATCH_SIZE = 1000
+
+# Number of seconds a browse listing is cached
+BROWSE_CACHE_TIMEOUT = 15
+
 
 def boto_exception(fn):
     @wraps(fn)
@@ -71,28 +91,80 @@ class S3SpaceModelMixin(models.Model):
         blank=True,
         help_text=_("S3 Bucket Name"),
     )
+    s3_part_size = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Multipart part size (MiB)"),
+        help_text=_(
+            "Objects bigger than this are transferred in parts of this size. "
+            "Leave blank for the default (8 MiB)."
+        ),
+    )
+    s3_max_concurrency = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Maximum concurrency"),
+        help_text=_(
+            "Number of parts or objects transferred at the same time. Leave "
+            "blank for the default (10)."
+        ),
+    )
 
     @property
     def bucket_name(self):
         return self.s3_bucket or self.space_id
 
     @property
-    def s3_resource(self):
-        if not hasattr(self, "_s3_resource"):
-            boto_args = {
-                "service_name": "s3",
-                "endpoint_url": self.s3_endpoint_url,
-                "region_name": self.s3_region,
-            }
-            if self.aws_access_key_id and self.aws_secret_access_key:
-                boto_args.update(
-                    aws_access_key_id=self.aws_access_key_id,
-                    aws_secret_access_key=self.aws_secret_access_key,
-                )
+    def max_concurrency(self):
+        return self.s3_max_concurrency or DEFAULT_MAX_CONCURRENCY
 
-            self._s3_resource = boto3.resource(**boto_args)
+    @property
+    def transfer_config(self):
+        """TransferConfig for transfers of single, possibly large, objects:
+        they are split in parts transferred concurrently."""
+        options = {"max_concurrency": self.max_concurrency}
+        if self.s3_part_size:
+            options.update(
+                multipart_threshold=self.s3_part_size * MiB,
+                multipart_chunksize=self.s3_part_size * MiB,
+            )
+        return TransferConfig(**options)
 
-        return self._s3_resource
+    @property
+    def object_transfer_config(self):
+        """TransferConfig for objects transferred by
+        ``_transfer_concurrently``, which already runs them in threads."""
+        config = self.transfer_config
+        config.use_threads = False
+        return config
+
+    @property
+    def s3_resource(self):
+        """boto3 S3 resource for this space. Resources aren't thread safe, so
+        each thread gets its own, kept across instances of the space with the
+        same settings."""
+        boto_args = {
+            "service_name": "s3",
+            "endpoint_url": self.s3_endpoint_url,
+            "region_name": self.s3_region,
+        }
+        if self.aws_access_key_id and self.aws_secret_access_key:
+            boto_args.update(
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+            )
+        local = cached_client(
+            ("s3", self.max_concurrency) + tuple(sorted(boto_args.items())),
+            threading.local,
+        )
+        resource = getattr(local, "resource", None)
+        if resource is None:
+            resource = local.resource = boto3.resource(
+                # Share enough connections between the transfer threads
+                config=Config(max_pool_connections=self.max_concurrency),
+                **boto_args
+            )
+        return resource
 
     @boto_exception
     def _ensure_bucket_exists(self):
@@ -129,6 +201,20 @@ class S3SpaceModelMixin(models.Model):
                     CreateBucketConfiguration={"LocationConstraint": self.s3_region},
                 )
 
+    def _transfer_concurrently(self, transfer, items):
+        """Call ``transfer(*item)`` for each of ``items`` using a pool of
+        ``max_concurrency`` threads and return the results.
+
+        The pool threads only live for the call, so ``transfer`` must use a
+        client captured in the caller's thread (boto3 clients, unlike
+        resources, are thread safe) rather than ``s3_resource``.
+        ``items`` can be a generator, transfers start while it is consumed.
+        The first error raised by a transfer is raised once all are finished.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(transfer, *item) for item in items]
+        return [future.result() for future in futures]
+
 
 class S3(S3SpaceModelMixin):
     space = models.OneToOneField("Space", to_field="uuid")
@@ -142,7 +228,39 @@ class S3(S3SpaceModelMixin):
         Location.TRANSFER_SOURCE,
     ]
 
-    def browse(self, path):
+    # Browse lists one page at a time (see Space.browse)
+    paged_browse = True
+
+    def _browse_cache_key(self, *args):
+        """Return a cache key for a listing of this space.
+
+        The key includes a generation number that is incremented whenever
+        the space is written to (see ``_invalidate_browse_cache``), so
+        listings cached before a write are not used after it.
+        """
+        generation = cache.get(self._browse_generation_key, 0)
+        key = repr((self.space_id, self.bucket_name, generation) + args)
+        return "s3-browse:" + hashlib.md5(key.encode("utf8")).hexdigest()
+
+    @property
+    def _browse_generation_key(self):
+        return "s3-browse-generation:{}".format(self.space_id)
+
+    def _invalidate_browse_cache(self):
+        key = self._browse_generation_key
+        cache.set(key, cache.get(key, 0) + 1, None)
+
+    def browse(self, path, limit=None, marker=None):
+        """List the objects in the directory ``path``.
+
+        Only the objects directly in ``path`` are listed, using S3's
+        delimiter support to roll up the subdirectories, and at most
+        ``limit`` entries are returned. Listings are cached for
+        BROWSE_CACHE_TIMEOUT seconds.
+
+        :param marker: ``next_marker`` of the previous page, an opaque S3
+            continuation token.
+        """
         LOGGER.debug("Browsing s3://%s/%s on S3 storage", self.bucket_name, path)
         path = path.lstrip("/")
 
@@ -159,38 +277,69 @@ class S3(S3SpaceModelMixin):
         if path != "":
             path = path.rstrip("/") + "/"
 
-        objects = self.s3_resource.Bucket(self.bucket_name).objects.filter(Prefix=path)
+        cache_key = self._browse_cache_key(path, limit, marker)
+        objects = cache.get(cache_key)
+        if objects is None:
+            objects = self._list_directory(path, limit, marker)
+            cache.set(cache_key, objects, BROWSE_CACHE_TIMEOUT)
+        return objects
 
-        directories = set()
-        entries = set()
+    @boto_exception
+    def _list_directory(self, prefix, limit=None, marker=None):
+        client = self.s3_resource.meta.client
+        params = {"Bucket": self.bucket_name, "Prefix": prefix, "Delimiter": "/"}
+        if marker:
+            params["ContinuationToken"] = marker
+
+        directories = []
+        entries = []
         properties = {}
+        next_marker = None
 
-        for objectSummary in objects:
-            relative_key = objectSummary.key.replace(path, "", 1).lstrip("/")
+        while limit is None or len(entries) < limit:
+            if limit is not None:
+                params["MaxKeys"] = min(limit - len(entries), LIST_PAGE_SIZE)
+            response = client.list_objects_v2(**params)
 
-            if "/" in relative_key:
-                directory_name = re.sub("/.*", "", relative_key)
+            for common_prefix in response.get("CommonPrefixes", []):
+                directory_name = common_prefix["Prefix"][len(prefix) :].strip("/")
                 if directory_name:
-                    directories.add(directory_name)
-                    entries.add(directory_name)
-            elif relative_key != "":
-                entries.add(relative_key)
+                    directories.append(directory_name)
+                    entries.append(directory_name)
+            for objectSummary in response.get("Contents", []):
+                relative_key = objectSummary["Key"][len(prefix) :]
+                # Skip the object marking the directory itself, if any
+                if relative_key == "":
+                    continue
+                entries.append(relative_key)
                 properties[relative_key] = {
-                    "size": objectSummary.size,
-                    "timestamp": objectSummary.last_modified,
-                    "e_tag": objectSummary.e_tag,
+                    "size": objectSummary["Size"],
+                    "timestamp": objectSummary["LastModified"],
+                    "e_tag": objectSummary["ETag"],
                 }
 
-        return {
-            "directories": list(directories),
-            "entries": list(entries),
+            next_marker = response.get("NextContinuationToken")
+            if not response.get("IsTruncated") or not next_marker:
+                next_marker = None
+                break
+            params["ContinuationToken"] = next_marker
+
+        objects = {
+            "directories": directories,
+            "entries": entries,
             "properties": properties,
         }
+        if next_marker is not None:
+            objects["next_marker"] = next_marker
+        return objects
 
     def delete_path(self, delete_path):
-        """Delete an object from an S3 bucket. We assume an object exists, if
-        it doesn't then the generator returned by the S3 library (Boto3) cannot
-        be iterated, and we raise a StorageException.
+        """Delete all the objects under ``delete_path`` from the S3 bucket.
+
+        The objects are deleted in batches of up to DELETE_BATCH_SIZE keys
+        with ``delete_objects``, running ``max_concurrency`` batches at the
+        same time. If no object exists under ``delete_path``, or some of the
+        objects could not be deleted, we raise a StorageException.
         """
         if delete_path.startswith(os.sep):
             LOGGER.info(
@@ -199,17 +348,62 @@ class S3(S3SpaceModelMixin):
                 )
             )
             delete_path = delete_path.lstrip(os.sep)
-        obj = self.s3_resource.Bucket(self.bucket_name).objects.filter(Prefix=delete_path)
-        items = False
-        for object_summary in obj:
-            items = True
-            resp = object_summary.delete()
-            LOGGER.debug("S3 response when attempting to delete:")
-            LOGGER.debug(pprint.pformat(resp))
-        if not items:
+        client = self.s3_resource.meta.client
+        pages = client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket_name,
+            Prefix=delete_path,
+            PaginationConfig={"PageSize": DELETE_BATCH_SIZE},
+        )
+        batches = (
+            ([obj["Key"] for obj in page["Contents"]],)
+            for page in pages
+            if page.get("Contents")
+        )
+        results = self._transfer_concurrently(
+            lambda keys: self._delete_objects(client, keys), batches
+        )
+        self._invalidate_browse_cache()
+        if not results:
             err_str = "No packages found in S3 at: {}".format(delete_path)
             LOGGER.warning(err_str)
             raise StorageException(err_str)
+        errors = [error for batch_errors in results for error in batch_errors]
+        if errors:
+            raise StorageException(
+                _(
+                    "Unable to delete %(count)s of the objects in S3 at %(path)s,"
+                    " e.g. %(key)s: %(message)s"
+                )
+                % {
+                    "count": len(errors),
+                    "path": delete_path,
+                    "key": errors[0].get("Key"),
+                    "message": errors[0].get("Message"),
+                }
+            )
+
+    @boto_exception
+    def _delete_objects(self, client, keys):
+        """Delete ``keys`` from the bucket with a single request using
+        ``client`` and return the errors reported for individual keys."""
+        response = client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        errors = response.get("Errors", [])
+        LOGGER.debug(
+            "Deleted %s objects from S3, %s errors",
+            len(keys) - len(errors),
+            len(errors),
+        )
+        for error in errors:
+            LOGGER.warning(
+                "Unable to delete %s from S3: %s (%s)",
+                error.get("Key"),
+                error.get("Message"),
+                error.get("Code"),
+            )
+        return errors
 
     def move_to_storage_service(self, src_path, dest_path, dest_space, package=None):
         self._ensure_bucket_exists()
@@ -220,16 +414,126 @@ class S3(S3SpaceModelMixin):
         dest_path = dest_path.rstrip(".")
 
         objects = self.s3_resource.Bucket(self.bucket_name).objects.filter(Prefix=src_path)
+        config = self.transfer_config
 
+        # Objects smaller than a part are downloaded concurrently, bigger
+        # ones one at a time with their parts downloaded concurrently.
+        small_objects = []
         for objectSummary in objects:
             dest_file = objectSummary.key.replace(src_path, dest_path, 1)
             self.space.create_local_directory(dest_file)
-            if not os.path.isdir(dest_file):
-                bucket.download_file(objectSummary.key, dest_file)
+            if os.path.isdir(dest_file):
+                continue
+            if package is not None and objectSummary.key == src_path:
+                # The package is a single object: hash it while downloading
+                hasher = checksums.hasher_for(package)
+                with open(dest_file, "wb") as f:
+                    bucket.download_fileobj(
+                        objectSummary.key,
+                        checksums.HashingWriter(f, hasher),
+                        Config=config,
+                    )
+                checksums.record_transfer_checksums(package, hasher)
+            elif objectSummary.size < config.multipart_threshold:
+                small_objects.append((objectSummary.key, dest_file))
+            else:
+                bucket.download_file(objectSummary.key, dest_file, Config=config)
+
+        client = self.s3_resource.meta.client
+        object_config = self.object_transfer_config
+        self._transfer_concurrently(
+            lambda key, dest_file: client.download_file(
+                self.bucket_name, key, dest_file, Config=object_config
+            ),
+            small_objects,
+        )
+
+    def server_side_copy(self, src_path, dest_path, dest_space, package=None):
+        """Copy the objects under ``src_path`` to ``dest_path`` in the S3
+        space ``dest_space`` with S3 copy requests (multipart copies for
+        objects bigger than a part), so the data stays in S3.
+
+        Only possible if ``dest_space`` uses the same S3 service and
+        credentials as this space.
+        """
+        dest = dest_space.get_child_space()
+        if not isinstance(dest, S3) or (
+            dest.s3_endpoint_url,
+            dest.s3_region,
+            dest.aws_access_key_id,
+        ) != (self.s3_endpoint_url, self.s3_region, self.aws_access_key_id):
+            raise ServerSideCopyUnsupportedError()
+        dest._ensure_bucket_exists()
+        src_path = src_path.lstrip("/")
+        dest_path = dest_path.lstrip("/")
+
+        client = self.s3_resource.meta.client
+        config = self.transfer_config
+        objects = self.s3_resource.Bucket(self.bucket_name).objects.filter(Prefix=src_path)
+
+        # Objects smaller than a part are copied concurrently, bigger ones one
+        # at a time with their parts copied concurrently.
+        small_objects = []
+        found = False
+        for objectSummary in objects:
+            found = True
+            copy_source = {"Bucket": self.bucket_name, "Key": objectSummary.key}
+            dest_key = objectSummary.key.replace(src_path, dest_path, 1)
+            if objectSummary.size < config.multipart_threshold:
+                small_objects.append((copy_source, dest_key))
+            else:
+                client.copy(copy_source, dest.bucket_name, dest_key, Config=config)
+        object_config = self.object_transfer_config
+        self._transfer_concurrently(
+            lambda copy_source, dest_key: client.copy(
+                copy_source, dest.bucket_name, dest_key, Config=object_config
+            ),
+            small_objects,
+        )
+        dest._invalidate_browse_cache()
+        if not found:
+            raise StorageException(_("%(path)s not found in S3") % {"path": src_path})
+
+    def check_package_fixity(self, package):
+        """Check the fixity of ``package`` by streaming its objects from S3
+        through the hashes, without downloading it to the storage service.
+
+        See ``common.fixity`` for the details and the returned value.
+        """
+        client = self.s3_resource.meta.client
+        key = package.full_path.lstrip("/")
+        prefix = key.rstrip("/") + "/"
+
+        def list_objects():
+            try:
+                response = client.head_object(Bucket=self.bucket_name, Key=key)
+            except botocore.exceptions.ClientError:
+                # Not an object, the package is the objects under the prefix
+                pages = client.get_paginator("list_objects_v2").paginate(
+                    Bucket=self.bucket_name, Prefix=prefix
+                )
+                return {
+                    obj["Key"][len(prefix) :]: obj["Size"]
+                    for page in pages
+                    for obj in page.get("Contents", [])
+                    if not obj["Key"].endswith("/")
+                }
+            return {"": response["ContentLength"]}
+
+        def read_object(path):
+            response = client.get_object(
+                Bucket=self.bucket_name, Key=prefix + path if path else key
+            )
+            return response["Body"].iter_chunks(checksums.BUFFER_SIZE)
+
+        return fixity.check_package_fixity(
+            package, list_objects, read_object, max_workers=self.max_concurrency
+        )
 
     def move_from_storage_service(self, src_path, dest_path, package=None):
         self._ensure_bucket_exists()
         bucket = self.s3_resource.Bucket(self.bucket_name)
+        config = self.transfer_config
 
         if os.path.isdir(src_path):
             # ensure trailing slash on both paths
@@ -239,23 +543,40 @@ class S3(S3SpaceModelMixin):
             # strip leading slash on dest_path
             dest_path = dest_path.lstrip("/")
 
+            # Files smaller than a part are uploaded concurrently, bigger
+            # ones one at a time with their parts uploaded concurrently.
+            small_files = []
             for path, dirs, files in scandir.walk(src_path):
                 for basename in files:
                     entry = os.path.join(path, basename)
                     dest = entry.replace(src_path, dest_path, 1)
 
+                    if os.path.getsize(entry) < config.multipart_threshold:
+                        small_files.append((entry, dest))
+                        continue
                     with open(entry, "rb") as data:
-                        bucket.upload_fileobj(data, dest)
+                        bucket.upload_fileobj(data, dest, Config=config)
+
+            client = self.s3_resource.meta.client
+            object_config = self.object_transfer_config
+            self._transfer_concurrently(
+                lambda entry, dest: client.upload_file(
+                    entry, self.bucket_name, dest, Config=object_config
+                ),
+                small_files,
+            )
 
         elif os.path.isfile(src_path):
             # strip leading slash on dest_path
             dest_path = dest_path.lstrip("/")
 
             with open(src_path, "rb") as data:
-                bucket.upload_fileobj(data, dest_path)
+                bucket.upload_fileobj(data, dest_path, Config=config)
 
         else:
             raise StorageException(
                 _("%(path)s is neither a file nor a directory, may not exist")
                 % {"path": src_path}
             )
+
+        self._invalidate_browse_cache()
@@ -1,6 +1,8 @@
 # stdlib, alphabetical
+import collections
 import datetime
 import errno
+import heapq
 import logging
 import os
 import re
@@ -8,26 +10,29 @@ import shutil
 import stat
 import subprocess
 import tempfile
+import threading
 
 # Core Django, alphabetical
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils import six
 
 # Third party dependencies, alphabetical
+from concurrent.futures import ThreadPoolExecutor
 import scandir
 from django_extensions.db.fields import UUIDField
 
 # This project, alphabetical
-from common import utils
+from common import fastcopy, utils
 
 LOGGER = logging.getLogger(__name__)
 
 # This module, alphabetical
 from . import StorageException  # noqa: E402
 
-__all__ = ("Space", "PosixMoveUnsupportedError")
+__all__ = ("Space", "PosixMoveUnsupportedError", "ServerSideCopyUnsupportedError")
 
 
 def validate_space_path(path):
@@ -121,6 +126,60 @@ def validate_space_path(path):
 #         pass
 
 
+def paginate_browse(objects, limit=None, marker=None):
+    """Return one page of the result of a browse that lists all the entries.
+
+    Entries are sorted by name, and the page starts after the entry
+    `marker`. See `Space.browse`.
+    """
+    entries = sorted(objects["entries"])
+    if marker is not None:
+        entries = [entry for entry in entries if entry > marker]
+    page = entries if limit is None else entries[:limit]
+    names = set(page)
+    result = {
+        "entries": page,
+        "directories": [d for d in objects["directories"] if d in names],
+        "properties": {
+            name: value
+            for name, value in objects.get("properties", {}).items()
+            if name in names
+        },
+    }
+    if len(page) < len(entries):
+        result["next_marker"] = page[-1]
+    return result
+
+
+# Clients of protocol-specific spaces (connection pools, auth tokens), keyed
+# by the settings they were created with. See cached_client.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def cached_client(key, factory):
+    """Return the client cached under `key`, creating it with `factory` if
+    there isn't one.
+
+    This keeps clients across instances of a protocol-specific space, and
+    so across calls and requests. `key` must include every setting the
+    client depends on, so that a changed space gets a new client. Clients
+    that aren't thread safe should be kept in a `threading.local` returned
+    by `factory`.
+    """
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = factory()
+    return client
+
+
+def clear_client_cache():
+    """Forget all the cached clients."""
+    with _clients_lock:
+        _clients.clear()
+
+
 class Space(models.Model):
     """ Common storage space information.
 
@@ -267,16 +326,36 @@ class Space(models.Model):
         'verbose name': Verbose name of the object
         See each Space's browse for details.
 
+        If `limit` or `marker` are given, only one page of entries is
+        returned and, if there are more entries, the dictionary has a
+        'next_marker' key to pass as `marker` to get the next page. Spaces
+        that can list a page without listing the whole directory set
+        `paged_browse = True` and accept these arguments in their browse,
+        for the others the complete listing is split here.
+
         :param str path: Full path to return info for
+        :param int limit: Maximum number of entries to return
+        :param str marker: Value of 'next_marker' from the previous page
         :return: Dictionary of object information detailed above.
         """
         LOGGER.info("path: %s", path)
+        limit = kwargs.pop("limit", None)
+        marker = kwargs.pop("marker", None)
+        paged = limit is not None or marker is not None
         try:
-            return self.get_child_space().browse(path, *args, **kwargs)
+            child_space = self.get_child_space()
+            if paged and getattr(child_space, "paged_browse", False):
+                return child_space.browse(
+                    path, *args, limit=limit, marker=marker, **kwargs
+                )
+            objects = child_space.browse(path, *args, **kwargs)
         except AttributeError as e:
             LOGGER.debug("AttributeError while browsing %s: %r", path, e)
             LOGGER.debug("Falling back to default browse local", exc_info=False)
-            return self.browse_local(path)
+            objects = self.browse_local(path)
+        if paged:
+            objects = paginate_browse(objects, limit, marker)
+        return objects
 
     def delete_path(self, delete_path, *args, **kwargs):
         """
@@ -328,6 +407,39 @@ class Space(models.Model):
             source_path, abs_destination_path, destination_space, package
         )
 
+    def server_side_copy(
+        self, source_path, destination_path, destination_space, package=None
+    ):
+        """
+        Copy self.path/source_path to destination_space.path/destination_path
+        without the data going through the storage service, e.g. between two
+        object storage spaces in the same service.
+
+        Child spaces implement ``server_side_copy(source_path,
+        destination_path, destination_space, package)`` and raise
+        ServerSideCopyUnsupportedError if they can't copy to
+        ``destination_space``, e.g. because it is in another service.
+        """
+        child_space = self.get_child_space()
+        if not hasattr(child_space, "server_side_copy"):
+            LOGGER.debug("server_side_copy: not supported by %s", type(child_space))
+            raise ServerSideCopyUnsupportedError()
+
+        source_path = os.path.join(self.path, source_path)
+        if os.path.isabs(destination_path):
+            destination_path = destination_path.lstrip(os.sep)
+        abs_destination_path = os.path.join(destination_space.path, destination_path)
+        LOGGER.debug(
+            "server_side_copy: %s to %s in %s",
+            source_path,
+            abs_destination_path,
+            destination_space.uuid,
+        )
+
+        return child_space.server_side_copy(
+            source_path, abs_destination_path, destination_space, package
+        )
+
     def move_to_storage_service(
         self, source_path, destination_path, destination_space, *args, **kwargs
     ):
@@ -530,10 +642,12 @@ class Space(models.Model):
         try_mv_local=False,
         assume_rsync_daemon=False,
         rsync_password=None,
+        try_link_local=False,
     ):
         """ Moves a file from source to destination.
 
-        By default, uses rsync to move files.
+        By default, uses rsync to move files.  Between local paths, files
+        are copied with fastcopy instead, unless the parallel rsync is used.
         All directories leading to destination must exist; Space.create_local_directory may be useful.
 
         If try_mv_local is True, will attempt to use os.rename, which only works on the same device.
@@ -544,6 +658,7 @@ class Space(models.Model):
         :param bool try_mv_local: If true, try moving/renaming instead of copying.  Should be False if source or destination specify a user@host.  Warning: this will not leave a copy at the source.
         :param bool assume_rsync_daemon: If true, will use rsync daemon-style commands instead of the default rsync with remote shell transport
         :param rsync_password: used if assume_rsync_daemon is true, to specify value of RSYNC_PASSWORD environment variable
+        :param bool try_link_local: If true, and source and destination are on the same device, hardlink the files instead of copying them.  The files are shared with the source, so their permissions aren't changed, and the source must be removed afterwards: the result isn't an independent copy.
         """
         source = utils.coerce_str(source)
         destination = utils.coerce_str(destination)
@@ -576,29 +691,55 @@ class Space(models.Model):
                     dest_norm,
                 )
 
-        # Rsync file over
-        # TODO Do this asyncronously, with restarting failed attempts
-        command = [
+        if try_link_local and _same_device(source, destination):
+            try:
+                _copy_local(source, destination, _link_local_file)
+                return
+            except EnvironmentError:
+                LOGGER.debug(
+                    "Hardlinking %s to %s failed, copying instead",
+                    source,
+                    destination,
+                    exc_info=True,
+                )
+
+        parallel = settings.RSYNC_WORKERS > 1 and os.path.isdir(source)
+        if (
+            not parallel
+            and not assume_rsync_daemon
+            and not _is_remote(source)
+            and not _is_remote(destination)
+            and os.path.exists(source)
+        ):
+            # Both ends are local, so copy without rsync, with a reflink or
+            # in the kernel where the filesystems support it.
+            try:
+                _copy_local(source, destination)
+                return
+            except (EnvironmentError, shutil.Error):
+                LOGGER.warning(
+                    "Local copy of %s to %s failed, falling back to rsync",
+                    source,
+                    destination,
+                    exc_info=True,
+                )
+
+        # Rsync file over.  Partially transferred files are kept, so a
+        # failed rsync is resumed when it's retried (or moved again).
+        options = [
             "rsync",
             "-t",
             "-O",
             "--protect-args",
             "-vv",
+            "--partial",
             "--chmod=Fug+rw,o-rwx,Dug+rwx,o-rwx",
-            "-r",
-            source,
-            destination,
         ]
-        LOGGER.info("rsync command: %s", command)
-        kwargs = {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
-        if assume_rsync_daemon:
-            kwargs["env"] = {"RSYNC_PASSWORD": rsync_password}
-        p = subprocess.Popen(command, **kwargs)
-        stdout, _ = p.communicate()
-        if p.returncode != 0:
-            s = "Rsync failed with status {}: {}".format(p.returncode, stdout)
-            LOGGER.warning(s)
-            raise StorageException(s)
+        env = {"RSYNC_PASSWORD": rsync_password} if assume_rsync_daemon else None
+        if parallel:
+            _parallel_rsync(options, source, destination, settings.RSYNC_WORKERS, env)
+        else:
+            _rsync(options + ["-r", source, destination], env)
 
     def create_local_directory(self, path, mode=None):
         """
@@ -796,11 +937,195 @@ class Space(models.Model):
             raise
 
 
+# rsync exit codes worth retrying: socket I/O, data stream, timeouts, and
+# remote shell (eg. ssh) connection errors.
+RSYNC_RETRY_CODES = (10, 12, 30, 35, 255)
+
+# Number of lines of rsync output included in error messages.
+RSYNC_OUTPUT_LINES = 100
+
+
+def _rsync(command, env=None):
+    """Run the rsync ``command``, retrying it up to ``settings.RSYNC_RETRIES``
+    times if it fails with a network error.
+
+    rsync's output is logged as it's produced, and only the last lines are
+    kept for the error message.
+    """
+    LOGGER.info("rsync command: %s", command)
+    kwargs = {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+    if env is not None:
+        kwargs["env"] = env
+    for attempt in range(settings.RSYNC_RETRIES + 1):
+        p = subprocess.Popen(command, **kwargs)
+        output = collections.deque(maxlen=RSYNC_OUTPUT_LINES)
+        for line in iter(p.stdout.readline, b""):
+            LOGGER.debug("rsync: %s", line.rstrip())
+            output.append(line)
+        p.stdout.close()
+        p.wait()
+        if p.returncode == 0:
+            return
+        s = "Rsync failed with status {}: {}".format(
+            p.returncode, b"".join(output).decode("utf-8", "replace")
+        )
+        LOGGER.warning(s)
+        if p.returncode not in RSYNC_RETRY_CODES:
+            break
+    raise StorageException(s)
+
+
+def _partition_files(path, prefix, workers):
+    """Divide the files under ``path`` into ``workers`` lists of similar
+    total size, with their paths relative to ``path`` and prefixed with
+    ``prefix``."""
+    files = []
+    for dirpath, dirnames, filenames in scandir.walk(path):
+        relpath = os.path.relpath(dirpath, path)
+        for filename in filenames:
+            try:
+                size = os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                size = 0
+            files.append(
+                (size, os.path.normpath(os.path.join(prefix, relpath, filename)))
+            )
+    # Largest first, each to the list with the least so far
+    partitions = [(0, index, []) for index in range(workers)]
+    for size, filename in sorted(files, reverse=True):
+        total, index, filenames = heapq.heappop(partitions)
+        filenames.append(filename)
+        heapq.heappush(partitions, (total + size, index, filenames))
+    return [partition[2] for partition in sorted(partitions, key=lambda p: p[1])]
+
+
+def _parallel_rsync(options, source, destination, workers, env=None):
+    """Copy the local directory ``source`` to ``destination`` like
+    ``rsync -r``, with ``workers`` rsync processes each given a share of
+    its files.
+
+    The directories are synced in a final pass, which also creates the
+    empty ones.
+    """
+    if source.endswith("/"):
+        # Copy the contents of source
+        base, prefix = source, ""
+    else:
+        # Copy source itself
+        base, prefix = os.path.split(source)
+        base = base or "."
+    partitions = [
+        filenames
+        for filenames in _partition_files(source, prefix, workers)
+        if filenames
+    ]
+    LOGGER.info("Moving %s with %s rsync processes", source, len(partitions))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        commands = []
+        for index, filenames in enumerate(partitions):
+            files_from = os.path.join(temp_dir, str(index))
+            with open(files_from, "wb") as f:
+                f.write(b"\0".join(utils.coerce_str(name) for name in filenames))
+            commands.append(
+                options + ["--from0", "--files-from", files_from, base, destination]
+            )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [executor.submit(_rsync, command, env) for command in commands]
+        for result in results:
+            result.result()
+    finally:
+        shutil.rmtree(temp_dir)
+    _rsync(options + ["-r", "--include=*/", "--exclude=*", source, destination], env)
+
+
+def _is_remote(path):
+    """Return whether rsync treats ``path`` as remote (``[user@]host:path``)."""
+    return ":" in path.split("/", 1)[0]
+
+
+def _same_device(source, destination):
+    """Return whether ``source`` and the directory that ``destination`` is
+    (or would be) in are on the same device, so they can be hardlinked."""
+    if _is_remote(source) or _is_remote(destination):
+        return False
+    if not os.path.isdir(destination):
+        destination = os.path.dirname(os.path.normpath(destination))
+    try:
+        return os.stat(source).st_dev == os.stat(destination).st_dev
+    except OSError:
+        return False
+
+
+def _copy_local(source, destination, copy_file=None):
+    """Copy the local ``source`` to ``destination`` like move_rsync's rsync
+    command, with fastcopy, which can use reflinks or in-kernel copies.
+
+    As with rsync, a directory source with a trailing slash has its contents
+    copied, and one without is copied into ``destination``.  Existing
+    directories are merged into, and links and special files are skipped.
+
+    :param copy_file: Function to copy each file with, if not
+        :func:`_copy_local_file`.
+    """
+    copy_file = copy_file or _copy_local_file
+    if os.path.isdir(source):
+        if not source.endswith("/"):
+            destination = os.path.join(destination, os.path.basename(source))
+        _copy_local_directory(source, destination, copy_file)
+    else:
+        if destination.endswith("/") and not os.path.isdir(destination):
+            os.mkdir(destination)
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source))
+        copy_file(source, destination)
+
+
+def _copy_local_directory(source, destination, copy_file):
+    if not os.path.isdir(destination):
+        os.mkdir(destination)
+    # --chmod=Dug+rwx,o-rwx
+    mode = stat.S_IMODE(os.stat(source).st_mode)
+    os.chmod(destination, (mode | 0o770) & ~0o007)
+    for entry in scandir.scandir(source):
+        target = os.path.join(destination, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            _copy_local_directory(entry.path, target, copy_file)
+        elif entry.is_file(follow_symlinks=False):
+            copy_file(entry.path, target)
+        else:
+            LOGGER.debug("Skipping non-regular file %s", entry.path)
+
+
+def _copy_local_file(source, destination):
+    method = fastcopy.copyfile(source, destination)
+    LOGGER.debug("Copied %s to %s with %s", source, destination, method)
+    # --chmod=Fug+rw,o-rwx and -t
+    source_stat = os.stat(source)
+    os.chmod(destination, (stat.S_IMODE(source_stat.st_mode) | 0o660) & ~0o007)
+    os.utime(destination, (source_stat.st_atime, source_stat.st_mtime))
+
+
+def _link_local_file(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        os.remove(destination)
+        os.link(source, destination)
+
+
 # Thrown when posix_move is handed a non POSIX space
 class PosixMoveUnsupportedError(Exception):
     pass
 
 
+# Thrown when server_side_copy can't copy between the spaces it is handed
+class ServerSideCopyUnsupportedError(Exception):
+    pass
+
+
 def _scandir_public(path):
     """Generate all directory entries, excluding hidden files.
     """
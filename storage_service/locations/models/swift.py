@@ -1,26 +1,36 @@
 from __future__ import absolute_import
 
 # stdlib, alphabetical
+import json
 import logging
 import os
+import threading
 
 # Core Django, alphabetical
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 # Third party dependencies, alphabetical
+from concurrent.futures import ThreadPoolExecutor
 import scandir
 import swiftclient
 
 # This project, alphabetical
-from common import utils
+from common import checksums, fixity
 
 # This module, alphabetical
 from . import StorageException
 from .location import Location
+from .space import ServerSideCopyUnsupportedError, cached_client
 
 LOGGER = logging.getLogger(__name__)
 
+# Files bigger than a segment are uploaded as static large objects, with
+# SEGMENT_CONCURRENCY segments uploaded at a time. Swift limits the size of
+# objects (5 GiB by default) but not of large objects.
+SEGMENT_SIZE = 1024 * 1024 * 1024
+SEGMENT_CONCURRENCY = 4
+
 
 class Swift(models.Model):
     space = models.OneToOneField("Space", to_field="uuid")
@@ -75,14 +85,26 @@ class Swift(models.Model):
         Location.BACKLOG,
     ]
 
-    def __init__(self, *args, **kwargs):
-        super(Swift, self).__init__(*args, **kwargs)
-        self._connection = None
-
     @property
     def connection(self):
-        if self._connection is None:
-            self._connection = swiftclient.client.Connection(
+        """Connection to Swift. Connections aren't thread safe, so each thread
+        gets its own, kept (with its auth token) across instances of the
+        space with the same settings."""
+        local = cached_client(
+            (
+                "swift",
+                self.auth_url,
+                self.username,
+                self.password,
+                self.tenant,
+                self.auth_version,
+                self.region,
+            ),
+            threading.local,
+        )
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = local.connection = swiftclient.client.Connection(
                 authurl=self.auth_url,
                 user=self.username,
                 key=self.password,
@@ -90,7 +112,13 @@ class Swift(models.Model):
                 auth_version=self.auth_version,
                 os_options={"region_name": self.region},
             )
-        return self._connection
+        return connection
+
+    @property
+    def segments_container(self):
+        """Container of the segments of the large objects in this space,
+        named like the swift command line client does."""
+        return self.container + "_segments"
 
     def browse(self, path):
         """
@@ -106,7 +134,7 @@ class Swift(models.Model):
         if not path.endswith("/"):
             path += "/"
         _, content = self.connection.get_container(
-            self.container, delimiter="/", prefix=path
+            self.container, delimiter="/", prefix=path, full_listing=True
         )
         # Replace path, strip trailing /, sort
         entries = []
@@ -144,7 +172,7 @@ class Swift(models.Model):
             # items with that prefix to delete.
             try:
                 _, content = self.connection.get_container(
-                    self.container, prefix=delete_path
+                    self.container, prefix=delete_path, full_listing=True
                 )
             except swiftclient.exceptions.ClientException:
                 LOGGER.warning(
@@ -156,43 +184,164 @@ class Swift(models.Model):
             to_delete = [x["name"] for x in content if x.get("name")]
             for d in to_delete:
                 self.connection.delete_object(self.container, d)
+        self._delete_segments(delete_path.rstrip("/") + "/")
 
-    def _download_file(self, remote_path, download_path):
+    def _delete_segments(self, prefix):
+        """Delete the segments of the large objects whose name starts with
+        `prefix`."""
+        try:
+            _, content = self.connection.get_container(
+                self.segments_container, prefix=prefix, full_listing=True
+            )
+        except swiftclient.exceptions.ClientException:
+            # No segments container, no large objects
+            return
+        for entry in content:
+            if entry.get("name"):
+                self.connection.delete_object(self.segments_container, entry["name"])
+
+    def _download_file(self, remote_path, download_path, package=None):
         """
         Download the file from download_path in this Space to remote_path.
 
         :param str remote_path: Full path in Swift
         :param str download_path: Full path to save the file to
+        :param package: (Optional) Package being downloaded, to record its
+            checksums on.
         :raises: swiftclient.exceptions.ClientException may be raised and is not caught
         """
-        # TODO find a way to stream content to dest_path, instead of having to put it in memory
-        headers, content = self.connection.get_object(self.container, remote_path)
+        headers, content = self.connection.get_object(
+            self.container, remote_path, resp_chunk_size=checksums.BUFFER_SIZE
+        )
         self.space.create_local_directory(download_path)
+        # Hash the content as it is written, instead of reading it back
+        hasher = checksums.hasher_for(package, "md5")
         with open(download_path, "wb") as f:
-            f.write(content)
-        # Check ETag matches checksum of this file
-        if "etag" in headers:
-            checksum = utils.generate_checksum(download_path)
-            if checksum.hexdigest() != headers["etag"]:
+            writer = checksums.HashingWriter(f, hasher)
+            for chunk in content:
+                writer.write(chunk)
+        # Check ETag matches checksum of this file. The ETag of a large object
+        # is not the checksum of its content.
+        large_object = (
+            headers.get("x-static-large-object", "").lower() == "true"
+            or "x-object-manifest" in headers
+        )
+        if "etag" in headers and not large_object:
+            if hasher.hexdigest("md5") != headers["etag"]:
                 message = _(
                     "ETag %(remote_path)s for %(etag)s does not match %(checksum)s"
                 ) % {
                     "remote_path": remote_path,
                     "etag": headers["etag"],
-                    "checksum": checksum.hexdigest(),
+                    "checksum": hasher.hexdigest("md5"),
                 }
                 logging.warning(message)
                 raise StorageException(message)
+        return hasher
+
+    def _upload_file(self, source_path, destination_path):
+        """
+        Upload the file at source_path to destination_path in this Space.
+
+        The MD5 of the file is sent with it, so Swift rejects the upload
+        instead of storing data that was corrupted on the way.
+
+        Files bigger than SEGMENT_SIZE are uploaded as static large objects,
+        see _upload_large_file.
+
+        :param str source_path: Full path of the local file
+        :param str destination_path: Full path in Swift
+        :raises: StorageException if the ETag doesn't match
+        """
+        size = os.path.getsize(source_path)
+        if size > SEGMENT_SIZE:
+            return self._upload_large_file(source_path, destination_path, size)
+        self._upload_part(source_path, self.container, destination_path, 0, size)
+
+    def _upload_part(self, source_path, container, destination_path, offset, size):
+        """
+        Upload `size` bytes of the file at source_path, from `offset`, to
+        destination_path in `container`.
+
+        :return: MD5 of the uploaded data
+        :raises: StorageException if the ETag doesn't match
+        """
+        md5 = _md5_of_range(source_path, offset, size)
+        with open(source_path, "rb") as f:
+            f.seek(offset)
+            etag = self.connection.put_object(
+                container,
+                obj=destination_path,
+                contents=f,
+                content_length=size,
+                etag=md5,
+            )
+        if etag is not None and etag.strip('"') != md5:
+            message = _("ETag %(etag)s for %(path)s does not match %(checksum)s") % {
+                "path": destination_path,
+                "etag": etag,
+                "checksum": md5,
+            }
+            LOGGER.warning(message)
+            raise StorageException(message)
+        return md5
+
+    def _upload_large_file(self, source_path, destination_path, size):
+        """
+        Upload the file at source_path to destination_path as a static large
+        object.
+
+        The file is split in segments of SEGMENT_SIZE, uploaded concurrently
+        to the segments container, then the manifest listing them is uploaded
+        to destination_path. Swift checks the segments match the manifest.
+        """
+        self.connection.put_container(self.segments_container)
+        # Segments are named like the swift command line client does
+        prefix = u"{}/slo/{:f}/{}/{}".format(
+            destination_path, os.path.getmtime(source_path), size, SEGMENT_SIZE
+        )
+        segments = [
+            (u"{}/{:08d}".format(prefix, idx), offset, min(SEGMENT_SIZE, size - offset))
+            for idx, offset in enumerate(range(0, size, SEGMENT_SIZE))
+        ]
+
+        def upload(name, offset, length):
+            return self._upload_part(
+                source_path, self.segments_container, name, offset, length
+            )
+
+        with ThreadPoolExecutor(max_workers=SEGMENT_CONCURRENCY) as executor:
+            futures = [executor.submit(upload, *segment) for segment in segments]
+        try:
+            manifest = [
+                {
+                    "path": u"/{}/{}".format(self.segments_container, name),
+                    "etag": future.result(),
+                    "size_bytes": length,
+                }
+                for (name, _offset, length), future in zip(segments, futures)
+            ]
+            self.connection.put_object(
+                self.container,
+                obj=destination_path,
+                contents=json.dumps(manifest),
+                query_string="multipart-manifest=put",
+            )
+        except Exception:
+            self._delete_segments(prefix + "/")
+            raise
 
     def move_to_storage_service(self, src_path, dest_path, dest_space, package=None):
         """ Moves src_path to dest_space.staging_path/dest_path. """
         try:
-            self._download_file(src_path, dest_path)
+            hasher = self._download_file(src_path, dest_path, package)
         except swiftclient.exceptions.ClientException:
             # Swift only stores objects and fakes having folders. If src_path
             # doesn't exist, assume it is supposed to be a folder and fetch all
             # items with that prefix.
-            _, content = self.connection.get_container(self.container, prefix=src_path)
+            _, content = self.connection.get_container(
+                self.container, prefix=src_path, full_listing=True
+            )
             to_get = [x["name"] for x in content if x.get("name")]
             if not to_get:
                 # If nothing found, try normalizing src_path to remove possible
@@ -202,12 +351,138 @@ class Swift(models.Model):
                 src_path = os.path.normpath(src_path)
                 dest_path = os.path.normpath(dest_path)
                 _, content = self.connection.get_container(
-                    self.container, prefix=src_path
+                    self.container, prefix=src_path, full_listing=True
                 )
                 to_get = [x["name"] for x in content if x.get("name")]
             for entry in to_get:
                 dest = entry.replace(src_path, dest_path, 1)
                 self._download_file(entry, dest)
+        else:
+            checksums.record_transfer_checksums(package, hasher)
+
+    def server_side_copy(self, src_path, dest_path, dest_space, package=None):
+        """Copy the object ``src_path``, or the objects under it, to
+        ``dest_path`` in the Swift space ``dest_space`` with COPY requests,
+        so the data stays in Swift.
+
+        Only possible if ``dest_space`` uses the same Swift account as this
+        space. Copying a static large object would copy its joined content,
+        which Swift refuses above 5 GiB, so its segments are copied instead
+        (see _copy_large_object).
+        """
+        dest = dest_space.get_child_space()
+        if not isinstance(dest, Swift) or (
+            dest.auth_url,
+            dest.username,
+            dest.tenant,
+            dest.region,
+        ) != (self.auth_url, self.username, self.tenant, self.region):
+            raise ServerSideCopyUnsupportedError()
+        try:
+            to_copy = [
+                (src_path, self.connection.head_object(self.container, src_path))
+            ]
+        except swiftclient.exceptions.ClientException:
+            # Not an object, copy everything in the "folder"
+            _, content = self.connection.get_container(
+                self.container, prefix=src_path, full_listing=True
+            )
+            to_copy = [
+                (x["name"], self.connection.head_object(self.container, x["name"]))
+                for x in content
+                if x.get("name")
+            ]
+        if not to_copy:
+            raise StorageException(
+                _("%(path)s not found in Swift") % {"path": src_path}
+            )
+        for entry, headers in to_copy:
+            dest_obj = entry.replace(src_path, dest_path, 1)
+            if "x-object-manifest" in headers:
+                # The segments of a dynamic large object can't be listed
+                # reliably, let the caller copy its content
+                raise ServerSideCopyUnsupportedError()
+            if headers.get("x-static-large-object", "").lower() == "true":
+                self._copy_large_object(entry, dest, dest_obj)
+                continue
+            self.connection.copy_object(
+                self.container,
+                entry,
+                destination=u"/{}/{}".format(dest.container, dest_obj),
+            )
+
+    def _copy_large_object(self, src_path, dest, dest_path):
+        """Copy the static large object ``src_path`` to ``dest_path`` in the
+        Swift space ``dest``: its segments are copied to the segments
+        container of ``dest``, and a manifest listing them is uploaded.
+        """
+        _, manifest = self.connection.get_object(
+            self.container, src_path, query_string="multipart-manifest=get"
+        )
+        segments = json.loads(manifest)
+        if any(segment.get("sub_slo") or segment.get("range") for segment in segments):
+            # Copying a nested large object would join its content too
+            raise ServerSideCopyUnsupportedError()
+        self.connection.put_container(dest.segments_container)
+        prefix = u"{}/slo/copy".format(dest_path)
+        try:
+            new_manifest = []
+            for idx, segment in enumerate(segments):
+                container, name = segment["name"].lstrip("/").split("/", 1)
+                new_path = u"/{}/{}/{:08d}".format(dest.segments_container, prefix, idx)
+                self.connection.copy_object(container, name, destination=new_path)
+                new_manifest.append(
+                    {
+                        "path": new_path,
+                        "etag": segment["hash"],
+                        "size_bytes": segment["bytes"],
+                    }
+                )
+            self.connection.put_object(
+                dest.container,
+                obj=dest_path,
+                contents=json.dumps(new_manifest),
+                query_string="multipart-manifest=put",
+            )
+        except Exception:
+            dest._delete_segments(prefix + "/")
+            raise
+
+    def check_package_fixity(self, package):
+        """Check the fixity of ``package`` by streaming its objects from Swift
+        through the hashes, without downloading it to the storage service.
+
+        See ``common.fixity`` for the details and the returned value. The
+        objects are read one at a time, as the connection isn't thread safe.
+        """
+        name = package.full_path
+        prefix = name.rstrip("/") + "/"
+
+        def list_objects():
+            try:
+                headers = self.connection.head_object(self.container, name)
+            except swiftclient.exceptions.ClientException:
+                # Swift only stores objects and fakes having folders. The
+                # package is all the objects under the prefix.
+                _, content = self.connection.get_container(
+                    self.container, prefix=prefix, full_listing=True
+                )
+                return {
+                    x["name"][len(prefix) :]: x["bytes"]
+                    for x in content
+                    if x.get("name") and not x["name"].endswith("/")
+                }
+            return {"": int(headers.get("content-length", 0))}
+
+        def read_object(path):
+            _, content = self.connection.get_object(
+                self.container,
+                prefix + path if path else name,
+                resp_chunk_size=checksums.BUFFER_SIZE,
+            )
+            return content
+
+        return fixity.check_package_fixity(package, list_objects, read_object)
 
     def move_from_storage_service(self, source_path, destination_path, package=None):
         """ Moves self.staging_path/src_path to dest_path. """
@@ -219,27 +494,27 @@ class Swift(models.Model):
                 for basename in files:
                     entry = os.path.join(path, basename)
                     dest = entry.replace(source_path, destination_path, 1)
-                    checksum = utils.generate_checksum(entry)
-                    with open(entry, "rb") as f:
-                        self.connection.put_object(
-                            self.container,
-                            obj=dest,
-                            contents=f,
-                            etag=checksum.hexdigest(),
-                            content_length=os.path.getsize(entry),
-                        )
+                    self._upload_file(entry, dest)
         elif os.path.isfile(source_path):
-            checksum = utils.generate_checksum(source_path)
-            with open(source_path, "rb") as f:
-                self.connection.put_object(
-                    self.container,
-                    obj=destination_path,
-                    contents=f,
-                    etag=checksum.hexdigest(),
-                    content_length=os.path.getsize(source_path),
-                )
+            self._upload_file(source_path, destination_path)
         else:
             raise StorageException(
                 _("%(path)s is neither a file nor a directory, may not exist")
                 % {"path": source_path}
             )
+
+
+def _md5_of_range(path, offset, size):
+    """Return the MD5 of `size` bytes of the file at `path` from `offset`."""
+    if offset == 0 and size == os.path.getsize(path):
+        return checksums.hash_file(path, "md5").hexdigest("md5")
+    hasher = checksums.MultiHash("md5")
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while size > 0:
+            buf = f.read(min(size, checksums.BUFFER_SIZE))
+            if not buf:
+                break
+            hasher.update(buf)
+            size -= len(buf)
+    return hasher.hexdigest("md5")
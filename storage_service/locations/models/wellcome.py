@@ -1,22 +1,36 @@
+import collections
 import errno
-import json
+import hashlib
+import io
+import itertools
 import logging
 import os
+import random
 import re
 import subprocess
+import tarfile
 import tempfile
 import time
 
+from django.conf import settings
 from django.db import models
 from django.core.urlresolvers import reverse
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 from django.utils.six.moves.urllib.parse import urljoin, urlencode
+import bagit
+import botocore
+from concurrent.futures import ThreadPoolExecutor
+import dateutil.parser
 from wellcome_storage_service import BagNotFound, RequestsOAuthStorageServiceClient as StorageServiceClient
 
+from common import checksums, fixity
+
 from . import StorageException
 from . import Package
 from .location import Location
 from .s3 import S3SpaceModelMixin
+from .space import cached_client
 
 
 TOKEN_HELP_TEXT = _('URL of the OAuth token endpoint, e.g. https://auth.wellcomecollection.org/oauth2/token')
@@ -26,20 +40,6 @@ CALLBACK_HELP_TEXT = _('Publicly accessible URL of the Archivematica storage ser
 LOGGER = logging.getLogger(__name__)
 
 
-# The script we use to download a compressed bag from S3.
-# This is run in a subprocess.
-DOWNLOAD_BAG_SCRIPT = '''
-import json, sys
-from wellcome_storage_service import download_compressed_bag
-
-bag = json.load(open(sys.argv[1]))
-dest_path = sys.argv[2]
-top_level_dir=sys.argv[3]
-
-download_compressed_bag(storage_manifest=bag, out_path=dest_path, top_level_dir=top_level_dir)
-'''
-
-
 def handle_ingest(ingest, package):
     """
     Handle an ingest json response
@@ -69,6 +69,159 @@ def handle_ingest(ingest, package):
         LOGGER.info("Unrecognised package status: %s", status)
 
 
+# Storage providers of the Wellcome storage that we can read bags from.
+S3_PROVIDERS = ("amazon-s3", "aws-s3-standard", "aws-s3-ia")
+
+# Size of a downloaded bag file held in memory before it is spooled to disk,
+# while it waits to be written to the tar.gz.
+DOWNLOAD_SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def _checksum_algorithm(manifest):
+    """
+    Return the hashlib name of the checksum algorithm of a manifest in a
+    storage manifest, e.g. "SHA-256" -> "sha256", or None if it has none.
+    """
+    algorithm = manifest.get("checksumAlgorithm")
+    if isinstance(algorithm, dict):
+        algorithm = algorithm.get("id")
+    if not algorithm:
+        return None
+    return algorithm.replace("-", "").lower()
+
+
+def _bag_files(storage_manifest):
+    for key in ("manifest", "tagManifest"):
+        manifest = storage_manifest[key]
+        algorithm = _checksum_algorithm(manifest)
+        for manifest_file in manifest["files"]:
+            yield manifest_file, algorithm
+
+
+def _download_bag_file(s3_client, location, manifest_file, algorithm, spool_dir):
+    """
+    Download a file of a bag to a temporary file, checking its size and
+    checksum against the storage manifest as it streams.
+    """
+    key = os.path.join(location["path"], manifest_file["path"])
+    body = s3_client.get_object(Bucket=location["bucket"], Key=key)["Body"]
+
+    expected = manifest_file.get("checksum") if algorithm else None
+    hasher = checksums.MultiHash([algorithm] if expected else [])
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE, dir=spool_dir)
+    try:
+        size = checksums.copyfileobj(body, spool, hasher)
+        if size != manifest_file.get("size", size):
+            raise StorageException(
+                _("Size mismatch for %(path)s: expected %(expected)s, found %(found)s") %
+                {'path': key, 'expected': manifest_file["size"], 'found': size})
+        if expected and hasher.hexdigest(algorithm) != expected:
+            raise StorageException(
+                _("Checksum mismatch for %(path)s: expected %(expected)s, found %(found)s") %
+                {'path': key, 'expected': expected, 'found': hasher.hexdigest(algorithm)})
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, size
+
+
+def _verify_bag_file(s3_client, location, manifest_file, algorithm):
+    """
+    Return the fixity failures of a file of a bag, checking the object in
+    S3 against its checksum in the storage manifest.
+    """
+    key = os.path.join(location["path"], manifest_file["path"])
+    try:
+        body = s3_client.get_object(Bucket=location["bucket"], Key=key)["Body"]
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return [bagit.FileMissing(manifest_file["name"])]
+        raise
+    hasher = fixity.hash_chunks(body.iter_chunks(checksums.BUFFER_SIZE), algorithm)
+    found = hasher.hexdigest(algorithm)
+    if found == manifest_file["checksum"]:
+        return []
+    return [bagit.ChecksumMismatch(
+        manifest_file["name"], algorithm, manifest_file["checksum"], found)]
+
+
+def _add_parent_directories(tar, name, added):
+    parent = os.path.dirname(name)
+    if not parent or parent in added:
+        return
+    _add_parent_directories(tar, parent, added)
+    info = tarfile.TarInfo(parent)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = time.time()
+    tar.addfile(info)
+    added.add(parent)
+
+
+def download_compressed_bag(s3_client, storage_manifest, out_path, top_level_dir, max_workers):
+    """
+    Download all the files in a bag to the tar.gz at ``out_path``.
+
+    Up to ``max_workers`` files are downloaded at the same time, and each of
+    them is checked against the storage manifest.  They're added to the tar
+    in the order of the manifest, and the tar is compressed by a gzip process:
+    the compression is CPU intensive, and would otherwise make this process
+    unresponsive (see https://github.com/wellcometrust/platform/issues/3954).
+    """
+    location = storage_manifest["location"]
+    if location["provider"]["id"] not in S3_PROVIDERS:
+        raise StorageException(
+            _("Unsupported storage provider: %(provider)s") %
+            {'provider': location["provider"]["id"]})
+
+    spool_dir = os.path.dirname(out_path)
+    with open(out_path, "wb") as out_file:
+        gzip = subprocess.Popen(["gzip", "-c"], stdin=subprocess.PIPE, stdout=out_file)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def download(item):
+                manifest_file, algorithm = item
+                return manifest_file, executor.submit(
+                    _download_bag_file, s3_client, location, manifest_file, algorithm, spool_dir)
+
+            # Keep max_workers downloads running ahead of the file being
+            # written to the tar.
+            files = _bag_files(storage_manifest)
+            pending = collections.deque(download(item) for item in itertools.islice(files, max_workers))
+            try:
+                tar = tarfile.open(fileobj=gzip.stdin, mode="w|", format=tarfile.PAX_FORMAT)
+                added = set()
+                while pending:
+                    manifest_file, future = pending.popleft()
+                    pending.extend(download(item) for item in itertools.islice(files, 1))
+                    spool, size = future.result()
+                    with spool:
+                        info = tarfile.TarInfo(os.path.join(top_level_dir, manifest_file["name"]))
+                        info.size = size
+                        info.mode = 0o644
+                        info.mtime = time.time()
+                        _add_parent_directories(tar, info.name, added)
+                        tar.addfile(info, spool)
+                tar.close()
+            except Exception:
+                for __, future in pending:
+                    future.cancel()
+                raise
+        gzip.stdin.close()
+        if gzip.wait() != 0:
+            raise StorageException(
+                _("Error compressing %(path)s: gzip exited with %(code)s") %
+                {'path': out_path, 'code': gzip.returncode})
+    except Exception:
+        if gzip.poll() is None:
+            gzip.kill()
+            gzip.wait()
+        os.remove(out_path)
+        raise
+
+
 def mkdir_p(dirpath):
     """Create a directory, even if it already exists.
 
@@ -85,9 +238,6 @@ def mkdir_p(dirpath):
             raise
 
 
-FNULL = open(os.devnull, 'w')
-
-
 class WellcomeIdentifier(object):
     def __init__(self, space, external_identifier, internal_identifier):
         self.space = space
@@ -117,86 +267,153 @@ class NoWellcomeIdentifierFound(ValueError):
         )
 
 
-def _find_transfer_mets_path(bag_dir):
-    # The transfer METS path is written into the bag at something like
-    #
-    #       data/objects/submissionDocumentation/WT_1234-{uuid}/METS.xml
-    #
-    # We don't know what that directory name will be, so guess and find it
-    # that way.
-    submission_docs_dir = os.path.join(bag_dir, "data/objects/submissionDocumentation")
-
-    if len(os.listdir(submission_docs_dir)) == 1:
-        return os.path.join(
-            submission_docs_dir,
-            os.listdir(submission_docs_dir)[0],
-            "METS.xml"
-        )
-    else:
-        return None
+SUBMISSION_DOCS_DIR = "data/objects/submissionDocumentation"
 
+DC_IDENTIFIER_PREFIX = "<dc:identifier>"
+ACCESSION_ID_PREFIX = '<mets:altRecordID TYPE="Accession ID">'
 
-def get_wellcome_identifier(src_path, package_uuid, space):
+
+class _LineScanner(object):
     """
-    By default, Archivematica will use the UUID as the External-Identifier
-    when calling the Wellcome Storage.
+    Wraps a file object, and keeps the lines read through it that start
+    with ``prefix``.  This lets us search a METS file while it's being
+    copied, without reading it twice or holding it all in memory.
+    """
+    def __init__(self, fileobj, prefix):
+        self.fileobj = fileobj
+        self.prefix = prefix.encode("utf-8")
+        self._lines = []
+        self._partial = b""
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._keep(line)
+        return data
+
+    def _keep(self, line):
+        if line.strip().startswith(self.prefix):
+            self._lines.append(line.decode("utf-8", "replace"))
+
+    def matching_lines(self):
+        lines = list(self._lines)
+        if self._partial.strip().startswith(self.prefix):
+            lines.append(self._partial.decode("utf-8", "replace"))
+        return lines
+
+
+class _StreamedBag(object):
+    """
+    What we learn about a bag while copying it from one tar.gz to another.
+    """
+    def __init__(self):
+        self.roots = set()
 
-    This is somewhat unpleasant -- if you're browsing the storage without
-    Archivematica references, it's hard to know where to find a given archive.
-    For example, if you're looking for PPMIA/1/2, what UUID is that?
+        # The tag files we rewrite, as {relative path: (TarInfo, contents)}.
+        # These are small, so we hold them in memory and write them at the
+        # end of the new tar.gz, once we know the Wellcome identifier.
+        self.tag_files = {}
+
+        self.mets = None
+
+        # The transfer METS files, as {directory name: _LineScanner}, and
+        # every directory name under the submission documentation.
+        self.transfer_mets = {}
+        self.submission_docs = set()
+
+    @property
+    def root(self):
+        return next(iter(self.roots))
+
+    @property
+    def transfer_mets_lines(self):
+        # The transfer METS path is written into the bag at something like
+        #
+        #       data/objects/submissionDocumentation/WT_1234-{uuid}/METS.xml
+        #
+        # We don't know what that directory name will be, so we only use
+        # it if it's unambiguous.
+        if len(self.submission_docs) != 1:
+            return None
+        scanner = self.transfer_mets.get(next(iter(self.submission_docs)))
+        if scanner is None:
+            return None
+        return scanner.matching_lines()
+
+
+def _is_rewritten_tag_file(relpath):
+    return relpath == "bag-info.txt" or (
+        relpath.startswith("tagmanifest-") and relpath.endswith(".txt")
+    )
 
-    If all the objects in the bag have a common value in the dc.identifier field,
-    which should be a catalogue reference, use that in preference to the
-    Archivematica external identifier.
 
+def _copy_bag(src, dest, package_uuid):
     """
-    LOGGER.debug("Trying to find Wellcome identifier in %s", src_path)
+    Copy the members of the ``src`` tar to ``dest``, except for the tag
+    files that we rewrite.  The METS files are searched for identifiers as
+    they're copied.
+    """
+    bag = _StreamedBag()
+    mets_relpath = "data/METS.%s.xml" % package_uuid
 
-    # If we're not looking at a tar.gz compressed bag, stop.
-    if not src_path.endswith(".tar.gz"):
-        raise NoWellcomeIdentifierFound()
+    for member in src:
+        path = os.path.normpath(member.name)
+        if path == ".":
+            dest.addfile(member)
+            continue
 
-    # Unpack the tar.gz to a temporary directory.  We run tar in a subprocess
-    # because it's CPU intensive and we don't want to hang the main Archivematica
-    # thread.
-    temp_dir = tempfile.mkdtemp()
+        root, __, relpath = path.partition("/")
+        bag.roots.add(root)
 
-    try:
-        subprocess.check_call(
-            ["tar", "-xzf", src_path, "-C", temp_dir],
-            stdout=FNULL,
-            stderr=FNULL
-        )
-    except subprocess.CalledProcessError as err:
-        LOGGER.debug("Error uncompressing tar.gz bag: %r", err)
-        raise NoWellcomeIdentifierFound()
+        if relpath.startswith(SUBMISSION_DOCS_DIR + "/"):
+            bag.submission_docs.add(
+                relpath[len(SUBMISSION_DOCS_DIR) + 1:].split("/")[0]
+            )
 
-    # There should be a single directory in the temporary directory -- the
-    # uncompressed bag.
-    if len(os.listdir(temp_dir)) != 1:
-        LOGGER.debug(
-            "Unable to identify root of bag in: os.listdir(%r) = %r",
-            temp_dir, os.listdir(temp_dir)
-        )
-        raise NoWellcomeIdentifierFound()
+        if not member.isfile():
+            dest.addfile(member)
+            continue
 
-    # Inside the bag, we look for the METS.xml file that contains information
-    # about the package.  If we can't find it unambiguously, give up.
-    bag_dir = os.path.join(temp_dir, os.listdir(temp_dir)[0])
-    assert os.path.exists(bag_dir)
-    LOGGER.debug("Expanded bag into directory %s" % bag_dir)
+        fileobj = src.extractfile(member)
+
+        if _is_rewritten_tag_file(relpath):
+            bag.tag_files[relpath] = (member, fileobj.read())
+            continue
 
-    mets_path = os.path.join(bag_dir, "data/METS.%s.xml" % package_uuid)
+        if relpath == mets_relpath:
+            fileobj = bag.mets = _LineScanner(fileobj, DC_IDENTIFIER_PREFIX)
+        elif os.path.basename(relpath) == "METS.xml":
+            transfer_dir = os.path.dirname(relpath)
+            if os.path.dirname(transfer_dir) == SUBMISSION_DOCS_DIR:
+                fileobj = _LineScanner(fileobj, ACCESSION_ID_PREFIX)
+                bag.transfer_mets[os.path.basename(transfer_dir)] = fileobj
 
-    transfer_mets_path = _find_transfer_mets_path(bag_dir)
+        dest.addfile(member, fileobj)
 
-    if not os.path.isfile(mets_path):
-        LOGGER.warn("Unable to find METS file in bag at path: %r", mets_path)
+    return bag
+
+
+def _identify_bag(bag, package_uuid, space):
+    # There should be a single directory in the tar.gz -- the bag.
+    if len(bag.roots) != 1:
+        LOGGER.debug("Unable to identify root of bag in: %r", sorted(bag.roots))
         raise NoWellcomeIdentifierFound()
 
-    if not os.path.isfile(transfer_mets_path):
+    # Inside the bag, we look for the METS.xml file that contains information
+    # about the package.  If we can't find it unambiguously, give up.
+    if bag.mets is None:
         LOGGER.warn(
-            "Unable to find transfer METS file in bag at path: %r", transfer_mets_path)
+            "Unable to find METS file in bag at path: %r",
+            "data/METS.%s.xml" % package_uuid)
+        raise NoWellcomeIdentifierFound()
+
+    transfer_mets_lines = bag.transfer_mets_lines
+    if transfer_mets_lines is None:
+        LOGGER.warn(
+            "Unable to find transfer METS file in bag at path: %r",
+            SUBMISSION_DOCS_DIR)
         raise NoWellcomeIdentifierFound()
 
     # Try to get some identifiers from the METS files.  We try to use the
@@ -206,16 +423,16 @@ def get_wellcome_identifier(src_path, package_uuid, space):
         LOGGER.debug("Looking for Dublin-Core identifiers in the METS")
         wellcome_identifier = WellcomeIdentifier(
             space=space,
-            external_identifier=get_common_prefix(extract_dc_identifiers(mets_path)),
+            external_identifier=get_common_prefix(
+                _dc_identifiers(bag.mets.matching_lines())
+            ),
             internal_identifier=package_uuid
         )
-    except NoCommonPrefix as err:
+    except NoCommonPrefix:
         LOGGER.debug("No common prefix in the Dublin-Core identifiers")
         LOGGER.debug("Looking for accession numbers in the transfer METS")
         try:
-            accession_numbers = list(
-                extract_accession_identifiers(transfer_mets_path)
-            )
+            accession_numbers = list(_accession_identifiers(transfer_mets_lines))
             LOGGER.debug("Found accession numbers: %r", accession_numbers)
             external_identifier = get_common_prefix(accession_numbers)
 
@@ -237,54 +454,143 @@ def get_wellcome_identifier(src_path, package_uuid, space):
     if wellcome_identifier.external_identifier.startswith("archivematica-dev/TEST"):
         wellcome_identifier = wellcome_identifier.with_space("testing")
 
-    LOGGER.debug("Detected Wellcome identifier as %s", wellcome_identifier)
+    return wellcome_identifier
 
-    # At this point, we've found a common prefix and it's non-empty.
-    # Write it back into the bag, then compress the bag back up under
-    # the original path.
-    #
-    # Recreate the checksums in the manifests, because we've edited
-    # the bag-info.txt.  Note: we run this in a subprocess to avoid
-    # locking up the main thread.
-    script = (
-        "import sys, bagit; "
-        "bag = bagit.Bag(sys.argv[1]); "
-        "bag.info['External-Identifier'] = sys.argv[2]; "
-        "bag.info['Internal-Sender-Identifier'] = sys.argv[3]; "
-        "bag.save(manifests=True)"
-    )
-    subprocess.check_call(
-        [
-            "python",
-            "-c",
-            script,
-            bag_dir,
-            wellcome_identifier.external_identifier,
-            wellcome_identifier.internal_identifier
-        ],
-        stdout=FNULL,
-        stderr=FNULL
-    )
 
-    # Recompress the bag.  We write it to a temporary path first, so if we
-    # corrupt something, the original tar.gz is preserved.
+def update_bag_info(content, values):
+    """
+    Set the tags in ``values`` in the contents of a bag-info.txt, replacing
+    any existing values (including their continuation lines).
+    """
+    lines = []
+    skipping = False
+    for line in content.decode("utf-8").splitlines():
+        if line[:1] in (" ", "\t"):
+            if not skipping:
+                lines.append(line)
+            continue
+        skipping = line.split(":", 1)[0].strip() in values
+        if not skipping:
+            lines.append(line)
+    for key, value in sorted(values.items()):
+        lines.append(u"%s: %s" % (key, value))
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+def update_tag_manifest(content, algorithm, tag_files):
+    """
+    Update the checksums of ``tag_files``, a dict of {path: contents}, in
+    the contents of a tagmanifest-{algorithm}.txt.
+    """
+    checksums = {
+        path: hashlib.new(algorithm, data).hexdigest()
+        for path, data in tag_files.items()
+    }
+    lines = []
+    for line in content.decode("utf-8").splitlines():
+        entry = line.strip().split(None, 1)
+        if len(entry) == 2 and entry[1].lstrip("*") in checksums:
+            path = entry[1].lstrip("*")
+            line = u"%s  %s" % (checksums.pop(path), path)
+        lines.append(line)
+    for path, checksum in sorted(checksums.items()):
+        lines.append(u"%s  %s" % (checksum, path))
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+def _write_tag_files(dest, bag, wellcome_identifier):
     try:
-        subprocess.check_call([
-            "tar",
+        info_member, info = bag.tag_files["bag-info.txt"]
+    except KeyError:
+        info_member, info = tarfile.TarInfo(bag.root + "/bag-info.txt"), b""
+        info_member.mtime = time.time()
+        info_member.mode = 0o644
+    info = update_bag_info(info, {
+        "External-Identifier": wellcome_identifier.external_identifier,
+        "Internal-Sender-Identifier": wellcome_identifier.internal_identifier,
+    })
+
+    tag_files = {"bag-info.txt": (info_member, info)}
+    for relpath, (member, content) in bag.tag_files.items():
+        if relpath.startswith("tagmanifest-"):
+            algorithm = relpath[len("tagmanifest-"):-len(".txt")]
+            content = update_tag_manifest(content, algorithm, {"bag-info.txt": info})
+            tag_files[relpath] = (member, content)
+
+    for relpath, (member, content) in sorted(tag_files.items()):
+        member.size = len(content)
+        dest.addfile(member, io.BytesIO(content))
+
+
+def get_wellcome_identifier(src_path, package_uuid, space):
+    """
+    By default, Archivematica will use the UUID as the External-Identifier
+    when calling the Wellcome Storage.
+
+    This is somewhat unpleasant -- if you're browsing the storage without
+    Archivematica references, it's hard to know where to find a given archive.
+    For example, if you're looking for PPMIA/1/2, what UUID is that?
 
-            # Compress to /src_path.tmp using gzip compression (-z)
-            "-czvf", src_path + ".tmp",
+    If all the objects in the bag have a common value in the dc.identifier field,
+    which should be a catalogue reference, use that in preference to the
+    Archivematica external identifier.
 
-            # cd into temp_dir first, then compress everything it contains.
-            # This means all the files in the tar.gz are relative, not
-            # absolute paths to /tmp/...
-            "-C", temp_dir, "."
-        ], stdout=FNULL, stderr=FNULL)
-    except subprocess.CalledProcessError as err:
-        LOGGER.debug("Error repacking bag as tar.gz: %r" % err)
+    The identifier is written back into the bag-info.txt of the tar.gz in a
+    single pass: every other member is copied through unchanged, and only
+    bag-info.txt and the tag manifests are rewritten.  The payload doesn't
+    change, so its manifests don't need to be recomputed.  The tar.gz is
+    decompressed and compressed again by gunzip and gzip processes, like in
+    download_compressed_bag.
+
+    """
+    LOGGER.debug("Trying to find Wellcome identifier in %s", src_path)
+
+    # If we're not looking at a tar.gz compressed bag, stop.
+    if not src_path.endswith(".tar.gz"):
+        raise NoWellcomeIdentifierFound()
+
+    # Write the new bag to a temporary path first, so if we corrupt
+    # something, the original tar.gz is preserved.
+    tmp_path = src_path + ".tmp"
+    with open(src_path, "rb") as src_file:
+        gunzip = subprocess.Popen(["gunzip", "-c"], stdin=src_file, stdout=subprocess.PIPE)
+    with open(tmp_path, "wb") as tmp_file:
+        gzip = subprocess.Popen(["gzip", "-c"], stdin=subprocess.PIPE, stdout=tmp_file)
+    try:
+        with tarfile.open(fileobj=gzip.stdin, mode="w|", format=tarfile.PAX_FORMAT) as dest:
+            try:
+                src = tarfile.open(fileobj=gunzip.stdout, mode="r|")
+                bag = _copy_bag(src, dest, package_uuid)
+            except (tarfile.TarError, EOFError) as err:
+                LOGGER.debug("Error reading tar.gz bag: %r", err)
+                raise NoWellcomeIdentifierFound()
+            wellcome_identifier = _identify_bag(bag, package_uuid, space)
+            LOGGER.debug("Detected Wellcome identifier as %s", wellcome_identifier)
+            _write_tag_files(dest, bag, wellcome_identifier)
+        # Read the padding after the end of the tar, so gunzip can finish
+        while gunzip.stdout.read(tarfile.RECORDSIZE):
+            pass
+        gunzip.stdout.close()
+        gzip.stdin.close()
+        if gunzip.wait() != 0:
+            raise StorageException(
+                _("Error decompressing %(path)s: gunzip exited with %(code)s") %
+                {'path': src_path, 'code': gunzip.returncode})
+        if gzip.wait() != 0:
+            raise StorageException(
+                _("Error compressing %(path)s: gzip exited with %(code)s") %
+                {'path': tmp_path, 'code': gzip.returncode})
+    except Exception:
+        for process in (gunzip, gzip):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
     # This rename should be atomic.
-    os.rename(src_path + ".tmp", src_path)
+    os.rename(tmp_path, src_path)
     return wellcome_identifier
 
 
@@ -311,16 +617,91 @@ class WellcomeStorageService(S3SpaceModelMixin):
 
     @property
     def wellcome_client(self):
-        return StorageServiceClient(
-            api_url=self.api_root_url,
-            token_url=self.token_url,
-            client_id=self.app_client_id,
-            client_secret=self.app_client_secret,
+        """
+        The client for the Wellcome storage API of this space.
+
+        The client is cached by the process: it reuses its OAuth token until
+        it expires, and its session keeps the connections to the API open.
+        """
+        return cached_client(
+            ('wellcome', self.api_root_url, self.token_url, self.app_client_id, self.app_client_secret),
+            lambda: StorageServiceClient(
+                api_url=self.api_root_url,
+                token_url=self.token_url,
+                client_id=self.app_client_id,
+                client_secret=self.app_client_secret,
+            ),
         )
 
     def delete_path(self, delete_path):
         LOGGER.debug('Deleting %s from Wellcome storage', delete_path)
 
+    def check_package_fixity(self, package):
+        """
+        Check the fixity of a package stored in this space from its storage
+        manifest.  See Package.check_fixity for the return value.
+
+        The Wellcome Storage verifies the checksums of every file of a bag
+        when it's ingested, and records them in the storage manifest, so this
+        doesn't move any bytes.  If settings.WELLCOME_FIXITY_SAMPLE_SIZE is
+        set, that many files picked at random are also read from S3 and
+        checked against the manifest.
+
+        :return: Tuple of (success, [errors], message, timestamp)
+        """
+        try:
+            space = package.misc_attributes["wellcome.space"]
+            external_identifier = package.misc_attributes["wellcome.external_identifier"]
+        except KeyError:
+            raise NotImplementedError(
+                _("Package %(uuid)s has no Wellcome identifier") % {'uuid': package.uuid})
+        version = package.misc_attributes.get("wellcome.version")
+
+        try:
+            bag = self.wellcome_client.get_bag(
+                space=space,
+                external_identifier=external_identifier,
+                version=version
+            )
+        except BagNotFound:
+            return (False, [], _("Package not found: %(identifier)s") % {
+                'identifier': "%s/%s" % (space, external_identifier)}, None)
+
+        timestamp = bag.get("createdDate")
+        if timestamp:
+            timestamp = dateutil.parser.parse(timestamp).isoformat()
+
+        if version and bag.get("version") != version:
+            return (False, [], _("Expected version %(expected)s of the bag, found %(found)s") % {
+                'expected': version, 'found': bag.get("version")}, timestamp)
+
+        files = list(_bag_files(bag))
+        unverified = [
+            manifest_file["name"] for manifest_file, algorithm in files
+            if not algorithm or not manifest_file.get("checksum")
+        ]
+        if not files or unverified:
+            return (False, [], _("Files without checksum in the storage manifest: %(files)s") % {
+                'files': ", ".join(unverified)}, timestamp)
+
+        sample_size = min(settings.WELLCOME_FIXITY_SAMPLE_SIZE, len(files))
+        if sample_size > 0:
+            s3_client = self.s3_resource.meta.client
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                futures = [
+                    executor.submit(_verify_bag_file, s3_client, bag["location"], manifest_file, algorithm)
+                    for manifest_file, algorithm in random.sample(files, sample_size)
+                ]
+            failures = [failure for future in futures for failure in future.result()]
+            if failures:
+                message = "%s: %s" % (
+                    _("Bag validation failed"),
+                    "; ".join(force_text(failure) for failure in failures),
+                )
+                return (False, failures, message, timestamp)
+
+        return (True, [], "", timestamp)
+
     def move_to_storage_service(self, src_path, dest_path, dest_space, package=None):
         """
         Download an AIP from Wellcome Storage to Archivematica.
@@ -347,40 +728,24 @@ class WellcomeStorageService(S3SpaceModelMixin):
         )
 
         src_filename = os.path.basename(src_path)
-        src_name, _ = src_filename.split(".", 1)
-
-        # We use a subprocess here because the compression of the download
-        # is CPU-intensive, especially for larger files, and can render the
-        # main process unresponsive. This can cause problems (a) for server
-        # responsiveness (b) because the server may stop responding to health
-        # checks, resulting in it being terminated before it can finish
-        # building the archive.
-        # See https://github.com/wellcometrust/platform/issues/3954
-        #
-        # We write to a separate file, because otherwise we get the error:
-        #
-        #     OSError: [Errno 7] Argument list too long: 'python'
-        #
-        _, manifest_path = tempfile.mkstemp(suffix=".json", prefix="manifest")
-        _, script_path = tempfile.mkstemp(suffix=".py", prefix="download_bag")
-
-        with open(manifest_path, "w") as out_file:
-            out_file.write(json.dumps(bag))
-
-        with open(script_path, "w") as out_file:
-            out_file.write(DOWNLOAD_BAG_SCRIPT)
-
-        try:
-            subprocess.check_call(
-                ["python", script_path, manifest_path, dest_path, src_name],
-                stderr=subprocess.STDOUT
-            )
-        finally:
-            os.unlink(script_path)
+        src_name, __ = src_filename.split(".", 1)
+
+        download_compressed_bag(
+            s3_client=self.s3_resource.meta.client,
+            storage_manifest=bag,
+            out_path=dest_path,
+            top_level_dir=src_name,
+            max_workers=self.max_concurrency,
+        )
 
     def move_from_storage_service(self, src_path, dest_path, package=None):
         """
         Upload an AIP from Archivematica to the Wellcome Storage.
+
+        This only submits the ingest, and leaves the package in the STAGING
+        status. The ingest is completed when the Wellcome Storage calls back
+        (see the wellcome_callback endpoint), or by update_package_status if
+        the callback is missed.
         """
         LOGGER.debug('Moving %s to %s on Wellcome storage', src_path, dest_path)
 
@@ -415,7 +780,9 @@ class WellcomeStorageService(S3SpaceModelMixin):
         # because that might modify the External-Identifier in the bag-info.txt.
         try:
             with open(src_path, "rb") as data:
-                bucket.upload_fileobj(data, s3_temporary_path)
+                bucket.upload_fileobj(
+                    data, s3_temporary_path, Config=self.transfer_config
+                )
         except Exception as err:
             LOGGER.warn("Error uploading %s to S3: %r", src_path, err)
             raise StorageException(
@@ -464,8 +831,9 @@ class WellcomeStorageService(S3SpaceModelMixin):
 
         # For reingests, the package status will still be 'uploaded'
         # We use the status to detect when upload is complete,
-        # so it is explicitly reset here.
+        # so it is explicitly reset here, and the previous ingest forgotten.
         package.status = Package.STAGING
+        package.misc_attributes.pop("wellcome.ingest_location", None)
         package.save()
 
         # Either create or update a bag on the storage service
@@ -481,35 +849,30 @@ class WellcomeStorageService(S3SpaceModelMixin):
         )
         LOGGER.info('Ingest_location: %s', location)
 
-        LOGGER.debug('Current package status is %s', package.status)
-        while package.status == Package.STAGING:
-            # Wait for callback to have been called
-            for i in range(6):
-                package.refresh_from_db()
-                LOGGER.debug('Polled package; status is %s', package.status)
-                time.sleep(10)
-                if package.status != Package.STAGING:
-                    break
-
-            if package.status == Package.STAGING:
-                LOGGER.info("Callback wasn't called yet - let's check the ingest URL")
-
-                # It wasn't. Query the ingest URL to see if anything happened.
-                # It's possible we missed the callback (e.g. Archivematica was unavailable?)
-                # because the storage service won't retry.
-                ingest = self.wellcome_client.get_ingest_from_location(location)
-                if ingest['callback']['status']['id'] == 'processing':
-                    # Just keep waiting for the callback
-                    LOGGER.info("Still waiting for callback")
-                else:
-                    # We missed the callback. Take results from the ingest body
-                    LOGGER.info("Ingest result found")
-                    handle_ingest(ingest, package)
-
-        if package.status == Package.FAIL:
-            raise StorageException(
-                _("Failed to store package %(path)s") %
-                {'path': src_path})
+        # Record the ingest, so update_package_status can check on it. Only
+        # save it, the callback may already have completed the ingest.
+        package.misc_attributes["wellcome.ingest_location"] = location
+        package.save(update_fields=["misc_attributes"])
+
+    def update_package_status(self, package):
+        """
+        Complete the ingest of `package` if the Wellcome Storage has finished
+        it. The callback normally does this, but the Wellcome Storage doesn't
+        retry it, e.g. if Archivematica was unavailable.
+
+        See Space.update_package_status, and the reconcile_wellcome_ingests
+        management command which calls this for all the pending ingests.
+        """
+        location = package.misc_attributes.get("wellcome.ingest_location")
+        if package.status != Package.STAGING or not location:
+            return (package.status, _("No ingest in progress"))
+
+        ingest = self.wellcome_client.get_ingest_from_location(location)
+        status = ingest['status']['id']
+        LOGGER.debug('Ingest %s of package %s is %s', location, package.uuid, status)
+        if status in ('succeeded', 'failed'):
+            handle_ingest(ingest, package)
+        return (package.status, _("Ingest status: %(status)s") % {'status': status})
 
     class Meta(S3SpaceModelMixin.Meta):
         verbose_name = _("Wellcome Storage Service")
@@ -573,20 +936,25 @@ def extract_dc_identifiers(mets_path):
     # we rely on it not doing that!
     #
     with open(mets_path) as mets_file:
-        for line in mets_file:
-            if not line.strip().startswith("<dc:identifier>"):
-                continue
+        for identifier in _dc_identifiers(mets_file):
+            yield identifier
 
-            LOGGER.debug("Found line that looks like a dc:identifier: %r", line)
 
-            match = re.match(
-                r"^<dc:identifier>(?P<identifier>[^<]+)</dc:identifier>$", line.strip()
-            )
+def _dc_identifiers(lines):
+    for line in lines:
+        if not line.strip().startswith(DC_IDENTIFIER_PREFIX):
+            continue
 
-            if match is None:
-                LOGGER.debug("Line didn't match regex: %r", line)
-            else:
-                yield match.group("identifier")
+        LOGGER.debug("Found line that looks like a dc:identifier: %r", line)
+
+        match = re.match(
+            r"^<dc:identifier>(?P<identifier>[^<]+)</dc:identifier>$", line.strip()
+        )
+
+        if match is None:
+            LOGGER.debug("Line didn't match regex: %r", line)
+        else:
+            yield match.group("identifier")
 
 
 def extract_accession_identifiers(transfer_mets_path):
@@ -606,18 +974,23 @@ def extract_accession_identifiers(transfer_mets_path):
     # we rely on it not doing that!
     #
     with open(transfer_mets_path) as mets_file:
-        for line in mets_file:
-            if not line.strip().startswith('<mets:altRecordID TYPE="Accession ID">'):
-                continue
+        for identifier in _accession_identifiers(mets_file):
+            yield identifier
 
-            LOGGER.debug("Found line that looks like a mets:altRecordID: %r", line)
 
-            match = re.match(
-                r'^<mets:altRecordID TYPE="Accession ID">(?P<identifier>[^<]+)</mets:altRecordID>$',
-                line.strip()
-            )
+def _accession_identifiers(lines):
+    for line in lines:
+        if not line.strip().startswith(ACCESSION_ID_PREFIX):
+            continue
 
-            if match is None:
-                LOGGER.debug("Line didn't match regex: %r", line)
-            else:
-                yield match.group("identifier")
+        LOGGER.debug("Found line that looks like a mets:altRecordID: %r", line)
+
+        match = re.match(
+            r'^<mets:altRecordID TYPE="Accession ID">(?P<identifier>[^<]+)</mets:altRecordID>$',
+            line.strip()
+        )
+
+        if match is None:
+            LOGGER.debug("Line didn't match regex: %r", line)
+        else:
+            yield match.group("identifier")
@@ -1,12 +1,15 @@
+import hashlib
 from lxml import etree
 import os
 import shutil
 import requests
 
 from django.test import TestCase
+import mock
 import vcr
 
 from locations import models
+from locations.models.space import clear_client_cache
 from . import TempDirMixin
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -19,6 +22,9 @@ class TestDuracloud(TempDirMixin, TestCase):
 
     def setUp(self):
         super(TestDuracloud, self).setUp()
+        # Each cassette needs new sessions
+        clear_client_cache()
+        self.addCleanup(clear_client_cache)
         self.ds_object = models.Duracloud.objects.first()
         self.auth = requests.auth.HTTPBasicAuth(
             self.ds_object.user, self.ds_object.password
@@ -578,22 +584,81 @@ class TestDuracloud(TempDirMixin, TestCase):
         assert testfile.is_file()
         assert testfile.open().read() == "test file\n"
 
-    @vcr.use_cassette(
-        os.path.join(
-            FIXTURES_DIR, "vcr_cassettes", "duracloud_move_to_ss_chunked_file.yaml"
-        )
-    )
     def test_move_to_ss_chunked_file(self):
         testdir = self.tmpdir / "move_to_ss_chunked"
         testfile = testdir / "chunked #image.jpg"
-        # chunked #image.jpg is actually chunked
-        self.ds_object.move_to_storage_service(
-            "chunked/chunked #image.jpg", str(testfile), None
+        chunks = [b"a" * 4096, b"b" * 4096, b"c" * 100]
+        content = b"".join(chunks)
+        url = self.ds_object.duraspace_url + "chunked/chunked%20%23image.jpg"
+        manifest = etree.Element("manifest")
+        source = etree.SubElement(etree.SubElement(manifest, "header"), "sourceContent")
+        etree.SubElement(source, "byteSize").text = str(len(content))
+        etree.SubElement(source, "md5").text = hashlib.md5(content).hexdigest()
+        chunks_element = etree.SubElement(manifest, "chunks")
+        for i, chunk in enumerate(chunks):
+            element = etree.SubElement(
+                chunks_element,
+                "chunk",
+                chunkId="chunked/chunked #image.jpg.dura-chunk-000{}".format(i),
+            )
+            etree.SubElement(element, "byteSize").text = str(len(chunk))
+            etree.SubElement(element, "md5").text = hashlib.md5(chunk).hexdigest()
+        responses = {
+            url: mock.Mock(status_code=404),
+            url
+            + ".dura-manifest": mock.Mock(ok=True, content=etree.tostring(manifest)),
+        }
+        for i, chunk in enumerate(chunks):
+            responses[url + ".dura-chunk-000{}".format(i)] = mock.Mock(
+                status_code=200, **{"iter_content.return_value": [chunk]}
+            )
+        session = mock.Mock(**{"get.side_effect": lambda url, **kw: responses[url]})
+
+        with mock.patch.object(models.Duracloud, "session", session):
+            self.ds_object.move_to_storage_service(
+                "chunked/chunked #image.jpg", str(testfile), None
+            )
+
+        assert sorted(os.listdir(str(testdir))) == ["chunked #image.jpg"]
+        data = testfile.read_bytes()
+        assert data[:4096] == chunks[0]
+        assert data[4096:8192] == chunks[1]
+        assert data[8192:] == chunks[2]
+
+    def test_move_from_ss_chunked_file_streams_chunks(self):
+        shutil.copy(os.path.join(FIXTURES_DIR, "chunk_file.txt"), str(self.tmpdir))
+        file_path = str(self.tmpdir / "chunk_file.txt")
+        self.ds_object.CHUNK_SIZE = 4 * 1024
+        uploaded = {}
+
+        def put(url, data):
+            uploaded[url] = data.read()
+            return mock.Mock(status_code=201)
+
+        session = mock.Mock(**{"put.side_effect": put})
+        with mock.patch.object(models.Duracloud, "session", session):
+            self.ds_object.move_from_storage_service(
+                file_path, "chunked/chunk_file.txt"
+            )
+
+        url = self.ds_object.duraspace_url + "chunked/chunk_file.txt"
+        with open(file_path, "rb") as f:
+            content = f.read()
+        chunks = [content[:4096], content[4096:8192], content[8192:]]
+        for i, chunk in enumerate(chunks):
+            assert uploaded[url + ".dura-chunk-000{}".format(i)] == chunk
+        root = etree.fromstring(uploaded[url + ".dura-manifest"])
+        assert (
+            root.findtext("header/sourceContent/md5")
+            == hashlib.md5(content).hexdigest()
         )
-        # Verify
-        assert testdir.is_dir()
-        assert not (testdir / "chunked #image.jpg.dura-manifest").exists()
-        assert not (testdir / "chunked #image.jpg.dura-chunk-0000").exists()
-        assert not (testdir / "chunked #image.jpg.dura-chunk-0001").exists()
-        assert testfile.is_file()
-        assert testfile.stat().st_size == 158131
+        assert [e.findtext("byteSize") for e in root.findall("chunks/chunk")] == [
+            "4096",
+            "4096",
+            "2845",
+        ]
+        assert [e.findtext("md5") for e in root.findall("chunks/chunk")] == [
+            hashlib.md5(chunk).hexdigest() for chunk in chunks
+        ]
+        # No chunk files are written
+        assert os.listdir(str(self.tmpdir)) == ["chunk_file.txt"]
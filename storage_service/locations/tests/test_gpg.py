@@ -8,6 +8,7 @@ import shutil
 import subprocess
 import tarfile
 
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from metsrw.plugins import premisrw
 import pytest
@@ -42,21 +43,54 @@ TEST_AGENTS = [
     )
 ]
 BROWSE_FAIL_DICT = {"directories": [], "entries": [], "properties": {}}
+SOME_INDEX = {
+    "type": "directory",
+    "objects": 3,
+    "children": {
+        "bagit.txt": {"type": "file", "size": 5},
+        "data": {
+            "type": "directory",
+            "objects": 2,
+            "children": {
+                "file.txt": {"type": "file", "size": 8},
+                u"\u00e9t\u00e9.txt": {"type": "file", "size": 4},
+                ".hidden": {"type": "file", "size": 1},
+                "empty": {"type": "directory", "objects": 0, "children": {}},
+            },
+        },
+    },
+}
+BROWSE_ROOT_DICT = {
+    "directories": [b"data"],
+    "entries": [b"bagit.txt", b"data"],
+    "properties": {b"bagit.txt": {"size": 5}, b"data": {"object count": 2}},
+}
+BROWSE_DATA_DICT = {
+    "directories": [b"empty"],
+    "entries": [b"empty", b"file.txt", u"\u00e9t\u00e9.txt".encode("utf8")],
+    "properties": {
+        b"empty": {"object count": 0},
+        b"file.txt": {"size": 8},
+        u"\u00e9t\u00e9.txt".encode("utf8"): {"size": 4},
+    },
+}
+DECR_DIR = "/a/b/.decrypted"
 
 
 FakeGPGRet = namedtuple("FakeGPGRet", "ok status stderr")
-ExTarCase = namedtuple("ExTarCase", "path isdir raises expected")
-CrTarCase = namedtuple("CrTarCase", "path isfile istar raises expected")
+FakeDecryptRet = namedtuple(
+    "FakeDecryptRet", "ok status stderr data valid fingerprint pubkey_fingerprint"
+)
 DecryptCase = namedtuple(
     "DecryptCase", "path isfile createsdecryptfile decryptret expected"
 )
 EncryptCase = namedtuple("EncryptCase", "path isdir encrpathisfile encryptret expected")
-BrowseCase = namedtuple("BrowseCase", "path encrpath existsafter expect")
+BrowseCase = namedtuple("BrowseCase", "path encrpath expect")
 MoveFromCase = namedtuple(
     "MoveFromCase", "src_path dst_path package encrypt_ret expect"
 )
 MoveToCase = namedtuple(
-    "MoveToCase", "src_path dst_path src_exists1 src_exists2 encr_path expect"
+    "MoveToCase", "src_path dst_path src_exists in_index encr_path expect"
 )
 
 
@@ -82,55 +116,63 @@ class MockPackage(object):
 
 
 @pytest.mark.parametrize(
-    "src_path, dst_path, src_exists1, src_exists2, encr_path, expect",
+    "src_path, dst_path, src_exists, in_index, encr_path, expect",
     [
         MoveToCase(
             src_path="/a/b/c",
             dst_path="/x/y/z",
-            src_exists1=True,
-            src_exists2=True,
+            src_exists=True,
+            in_index=True,
             encr_path="/a/b/c",
             expect="success",
         ),
         MoveToCase(
-            src_path="/a/b/c/somefile.jpg",
-            dst_path="/x/y/z/somefile.jpg",
-            src_exists1=False,
-            src_exists2=True,
+            src_path="/a/b/c/data/file.txt",
+            dst_path="/x/y/z/file.txt",
+            src_exists=False,
+            in_index=True,
+            encr_path="/a/b/c",
+            expect="success",
+        ),
+        MoveToCase(
+            src_path="/a/b/c/data/",
+            dst_path="/x/y/z/data/",
+            src_exists=False,
+            in_index=True,
             encr_path="/a/b/c",
             expect="success",
         ),
         MoveToCase(
             src_path="/a/b/c/somefile.jpg",
             dst_path="/x/y/z/somefile.jpg",
-            src_exists1=False,
-            src_exists2=True,
+            src_exists=False,
+            in_index=True,
             encr_path=None,
             expect="fail",
         ),
         MoveToCase(
             src_path="/a/b/c/somefile.jpg",
             dst_path="/x/y/z/somefile.jpg",
-            src_exists1=False,
-            src_exists2=False,
+            src_exists=False,
+            in_index=False,
             encr_path="/a/b/c",
             expect="fail",
         ),
     ],
 )
 def test_move_to_storage_service(
-    mocker, src_path, dst_path, src_exists1, src_exists2, encr_path, expect
+    mocker, src_path, dst_path, src_exists, in_index, encr_path, expect
 ):
     gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space())
     mocker.patch.object(gpg_space.space, "create_local_directory")
     mocker.patch.object(gpg_space.space, "move_rsync")
     mocker.patch.object(gpg, "_gpg_decrypt")
     mocker.patch.object(gpg, "_gpg_encrypt")
-    mocker.patch.object(
-        gpg, "_encr_path2key_fingerprint", return_value=SOME_FINGERPRINT
-    )
+    mocker.patch.object(gpg, "_gpg_extract_member")
+    mocker.patch.object(gpg, "_remove_if_exists")
+    mocker.patch.object(gpg, "_read_index", return_value=SOME_INDEX)
     mocker.patch.object(gpg, "_get_encrypted_path", return_value=encr_path)
-    mocker.patch.object(os.path, "exists", side_effect=(src_exists1, src_exists2))
+    mocker.patch.object(os.path, "exists", return_value=src_exists)
     if expect == "success":
         ret = gpg_space.move_to_storage_service(src_path, dst_path, None)
         assert ret is None
@@ -143,24 +185,32 @@ def test_move_to_storage_service(
             ) == str(
                 excinfo.value
             )
-        if not src_exists2:
+        if not in_index:
             assert (
                 "Unable to move {}; this file/dir does not"
                 " exist, not even in encrypted directory"
                 " {}.".format(src_path, encr_path) == str(excinfo.value)
             )
-    if src_exists2 and encr_path:
+    # The encrypted package is never re-encrypted
+    assert not gpg._gpg_encrypt.called
+    if src_exists:
+        gpg._gpg_decrypt.assert_called_once_with(dst_path, None)
         gpg_space.space.move_rsync.assert_called_once_with(src_path, dst_path)
+    elif expect == "success":
+        # Only the member is extracted, next to the destination
+        member = "c" + src_path[len(encr_path) :].rstrip("/")
+        decr_path = dst_path.rstrip("/") + ".decrypted"
+        gpg._gpg_extract_member.assert_called_once_with(encr_path, member, decr_path)
+        gpg_space.space.move_rsync.assert_called_once_with(
+            os.path.join(decr_path, member) + ("/" if src_path.endswith("/") else ""),
+            dst_path,
+            try_mv_local=True,
+        )
+        gpg._remove_if_exists.assert_called_once_with(decr_path)
+        assert not gpg._gpg_decrypt.called
     else:
+        assert not gpg._gpg_extract_member.called
         assert not gpg_space.space.move_rsync.called
-    if src_exists1:
-        gpg._gpg_decrypt.assert_called_once_with(dst_path)
-        assert not gpg._gpg_encrypt.called
-    else:
-        gpg._get_encrypted_path.assert_called_once_with(src_path)
-        if encr_path:
-            gpg._gpg_encrypt.assert_called_once_with(encr_path, SOME_FINGERPRINT)
-            gpg._gpg_decrypt.assert_called_once_with(encr_path)
     gpg_space.space.create_local_directory.assert_called_once_with(dst_path)
 
 
@@ -213,6 +263,8 @@ def test_move_from_storage_service(
         mocker.patch.object(gpg, "_gpg_encrypt", side_effect=encrypt_ret)
     else:
         mocker.patch.object(gpg, "_gpg_encrypt", return_value=encrypt_ret)
+    mocker.patch.object(gpg, "_package_index", return_value=SOME_INDEX)
+    mocker.patch.object(gpg, "_write_index")
     gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space())
     mocker.patch.object(gpg_space.space, "create_local_directory")
     mocker.patch.object(gpg_space.space, "move_rsync")
@@ -232,9 +284,13 @@ def test_move_from_storage_service(
         if orig_pkg_key != gpg_space.key:
             assert package.encryption_key_fingerprint == gpg_space.key
             assert package.save_called == 1
+        gpg._write_index.assert_called_once_with(
+            encrypt_ret[0], SOME_INDEX, gpg_space.key
+        )
     else:
         with pytest.raises(gpg.GPGException) as excinfo:
             gpg_space.move_from_storage_service(src_path, dst_path, package=package)
+        assert not gpg._write_index.called
         if package:
             assert excinfo.value == encrypt_ret
         else:
@@ -248,47 +304,36 @@ def test_move_from_storage_service(
             gpg_space.space.move_rsync.assert_any_call(
                 dst_path, src_path, try_mv_local=True
             )
-        gpg._gpg_encrypt.assert_called_once_with(dst_path, gpg_space.key)
+        gpg._gpg_encrypt.assert_called_once_with(dst_path, gpg_space.key, None)
 
 
 @pytest.mark.parametrize(
-    "path, encr_path, exists_after_decrypt, expect",
+    "path, encr_path, expect",
     [
+        BrowseCase(path="/a/b/c/", encrpath="/a/b/c", expect=BROWSE_ROOT_DICT),
+        BrowseCase(path="/a/b/c/data", encrpath="/a/b/c", expect=BROWSE_DATA_DICT),
+        BrowseCase(path="/a/b/c/data/", encrpath="/a/b/c", expect=BROWSE_DATA_DICT),
         BrowseCase(
-            path="/a/b/c/", encrpath="/a/b/c", existsafter=True, expect="success"
-        ),
-        BrowseCase(
-            path="/a/b/c/somefile.jpg",
-            encrpath="/a/b/c",
-            existsafter=True,
-            expect="success",
-        ),
-        BrowseCase(
-            path="/a/b/c/somefile.jpg", encrpath=None, existsafter=False, expect="fail"
+            path="/a/b/c/data/file.txt", encrpath="/a/b/c", expect=BROWSE_FAIL_DICT
         ),
-        BrowseCase(path="/a/b/c/", encrpath="/a/b/c", existsafter=False, expect="fail"),
+        BrowseCase(path="/a/b/c/nothing", encrpath="/a/b/c", expect=BROWSE_FAIL_DICT),
+        BrowseCase(path="/a/b/c/somefile.jpg", encrpath=None, expect=BROWSE_FAIL_DICT),
     ],
 )
-def test_browse(mocker, path, encr_path, exists_after_decrypt, expect):
+def test_browse(mocker, path, encr_path, expect):
     mocker.patch.object(gpg, "_get_encrypted_path", return_value=encr_path)
+    mocker.patch.object(gpg, "_read_index", return_value=SOME_INDEX)
     mocker.patch.object(gpg, "_gpg_decrypt")
     mocker.patch.object(gpg, "_gpg_encrypt")
-    mocker.patch.object(
-        gpg, "_encr_path2key_fingerprint", return_value=SOME_FINGERPRINT
-    )
-    mocker.patch.object(os.path, "exists", return_value=exists_after_decrypt)
-    mocker.patch.object(space, "path2browse_dict", return_value=expect)
+    mocker.patch("common.utils.get_setting", return_value=False)
     fixed_path = path.rstrip("/")
-    ret = gpg.GPG().browse(path)
-    if expect == "success":
-        assert ret == expect
-    else:
-        assert ret == BROWSE_FAIL_DICT
+    assert gpg.GPG().browse(path) == expect
     gpg._get_encrypted_path.assert_called_once_with(fixed_path)
     if encr_path:
-        gpg._gpg_decrypt.assert_called_once_with(encr_path)
-        gpg._encr_path2key_fingerprint.assert_called_once_with(encr_path)
-        gpg._gpg_encrypt.assert_called_once_with(encr_path, SOME_FINGERPRINT)
+        gpg._read_index.assert_called_once_with(encr_path)
+    # The package is neither decrypted nor re-encrypted to browse it
+    assert not gpg._gpg_decrypt.called
+    assert not gpg._gpg_encrypt.called
 
 
 @pytest.mark.parametrize(
@@ -326,33 +371,43 @@ def test_browse(mocker, path, encr_path, exists_after_decrypt, expect):
 )
 def test__gpg_encrypt(mocker, path, isdir, encr_path_is_file, encrypt_ret, expected):
     encr_path = "{}.gpg".format(path)
-    mocker.patch.object(os.path, "isdir", return_value=isdir)
+    mocker.patch.object(
+        os.path, "isdir", side_effect=lambda path_: isdir and path_ == path
+    )
+    mocker.patch.object(os.path, "lexists", return_value=False)
     mocker.patch.object(os, "remove")
     mocker.patch.object(os, "rename")
-    mocker.patch.object(gpg, "_create_tar")
-    mocker.patch.object(gpg, "_extract_tar")
+    mocker.patch.object(shutil, "rmtree")
+    mocker.patch.object(gpg, "_gpg_encrypt_dir", return_value=(encr_path, encrypt_ret))
     mocker.patch.object(
         gpgutils, "gpg_encrypt_file", return_value=(encr_path, encrypt_ret)
     )
     mocker.patch.object(os.path, "isfile", return_value=encr_path_is_file)
     if expected == "success":
         ret = gpg._gpg_encrypt(path, SOME_FINGERPRINT)
-        os.remove.assert_called_once_with(path)
+        if isdir:
+            shutil.rmtree.assert_called_once_with(path)
+            assert not os.remove.called
+        else:
+            os.remove.assert_called_once_with(path)
         os.rename.assert_called_once_with(encr_path, path)
         assert ret == (path, encrypt_ret)
-        assert not gpg._extract_tar.called
     else:
         with pytest.raises(gpg.GPGException) as excinfo:
             gpg._gpg_encrypt(path, SOME_FINGERPRINT)
         assert "An error occured when attempting to encrypt {}".format(path) == str(
             excinfo.value
         )
-        if isdir:
-            gpg._extract_tar.assert_called_once_with(path)
-    os.path.isdir.assert_called_once_with(path)
+        # The package is left untouched
+        assert not os.remove.called
+        assert not shutil.rmtree.called
+        assert not os.rename.called
     os.path.isfile.assert_called_once_with(encr_path)
     if isdir:
-        gpg._create_tar.assert_called_once_with(path)
+        gpg._gpg_encrypt_dir.assert_called_once_with(path, SOME_FINGERPRINT)
+        assert not gpgutils.gpg_encrypt_file.called
+    else:
+        gpgutils.gpg_encrypt_file.assert_called_once_with(path, SOME_FINGERPRINT)
 
 
 def test__get_encrypted_path(monkeypatch):
@@ -371,21 +426,21 @@ def test__get_encrypted_path(monkeypatch):
     "path, isfile, will_create_decrypt_file, decrypt_ret, expected",
     [
         DecryptCase(
-            path="/a/b/c",
+            path="/a/b/c.7z",
             isfile=True,
             createsdecryptfile=True,
             decryptret=DECRYPT_RET_SUCCESS,
             expected="success",
         ),
         DecryptCase(
-            path="/x/y/z",
+            path="/x/y/z.7z",
             isfile=False,
             createsdecryptfile=False,
             decryptret=DECRYPT_RET_FAIL,
             expected="fail",
         ),
         DecryptCase(
-            path="/a/b/c",
+            path="/a/b/c.7z",
             isfile=True,
             createsdecryptfile=False,
             decryptret=DECRYPT_RET_FAIL,
@@ -398,24 +453,20 @@ def test__gpg_decrypt(
 ):
     mocker.patch("os.remove")
     mocker.patch("os.rename")
-    mocker.patch.object(tarfile, "is_tarfile", return_value=True)
     mocker.patch.object(gpgutils, "gpg_decrypt_file", return_value=decrypt_ret)
-    mocker.patch.object(gpg, "_extract_tar")
-
-    def isfilemock(path_):
-        if path_ == path:
-            return isfile
-        return will_create_decrypt_file
-
-    mocker.patch.object(os.path, "isfile", side_effect=isfilemock)
-    assert not gpgutils.gpg_decrypt_file.called
+    mocker.patch.object(gpg, "_gpg_decrypt_stream")
+    mocker.patch.object(os.path, "isfile", return_value=isfile)
     decr_path = "{}.decrypted".format(path)
+    mocker.patch.object(
+        os.path,
+        "exists",
+        side_effect=lambda path_: path_ == decr_path and will_create_decrypt_file,
+    )
+    assert not gpgutils.gpg_decrypt_file.called
     if expected == "success":
         ret = gpg._gpg_decrypt(path)
         os.remove.assert_called_once_with(path)
         os.rename.assert_called_once_with(decr_path, path)
-        tarfile.is_tarfile.assert_called_once_with(path)
-        gpg._extract_tar.assert_called_once_with(path)
         assert ret == path
     else:
         with pytest.raises(gpg.GPGException) as excinfo:
@@ -430,106 +481,423 @@ def test__gpg_decrypt(
             )
         assert not os.remove.called
         assert not os.rename.called
-        assert not tarfile.is_tarfile.called
-        assert not gpg._extract_tar.called
+    # Files with an extension aren't tarfiles created by this space
+    assert not gpg._gpg_decrypt_stream.called
     if isfile:
         gpgutils.gpg_decrypt_file.assert_called_once_with(path, decr_path)
     else:
         assert not gpgutils.gpg_decrypt_file.called
 
 
-def test__parse_gpg_version():
-    assert GPG_VERSION == gpg._parse_gpg_version(RAW_GPG_VERSION)
+def fake_gpg_encrypt_stream(stream, recipient_fingerprint, encr_path, sign=None):
+    # Copy the data to "encrypt" as it is
+    with open(encr_path, "wb") as encr_file:
+        shutil.copyfileobj(stream, encr_file)
+    return ENCRYPT_RET_SUCCESS
+
+
+def fake_gpg_decrypt_file(path, decr_path):
+    with open(path, "rb") as encr_file, open(decr_path, "wb") as decr_file:
+        shutil.copyfileobj(encr_file, decr_file)
+    return DECRYPT_RET_SUCCESS
+
+
+def fake_gpg_decrypt_stream(stream, decr_path=None):
+    data = stream.read()
+    if decr_path is not None:
+        with open(decr_path, "wb") as decr_file:
+            decr_file.write(data)
+    return FakeDecryptRet(
+        ok=True,
+        status=SUCCESS_STATUS,
+        stderr="",
+        data=data,
+        valid=True,
+        fingerprint=SOME_FINGERPRINT,
+        pubkey_fingerprint=SOME_FINGERPRINT,
+    )
 
 
-@pytest.mark.parametrize(
-    "path, will_be_dir, sp_raises, expected",
-    [
-        ExTarCase(path="/a/b/c", isdir=True, raises=False, expected="success"),
-        ExTarCase(path="/a/b/d", isdir=False, raises=False, expected="fail"),
-        ExTarCase(path="/a/b/c", isdir=True, raises=True, expected="fail"),
-    ],
-)
-def test__extract_tar(mocker, path, will_be_dir, sp_raises, expected):
-    if sp_raises:
-        mocker.patch.object(subprocess, "check_output", side_effect=OSError("gotcha!"))
-    else:
-        mocker.patch.object(subprocess, "check_output")
-    mocker.patch.object(os, "rename")
-    mocker.patch.object(os, "remove")
-    if will_be_dir:
-        mocker.patch.object(os.path, "isdir", return_value=True)
-    else:
-        mocker.patch.object(os.path, "isdir", return_value=False)
-    tarpath_ext = "{}.tar".format(path)
-    dirname = os.path.dirname(tarpath_ext)
-    if expected == "success":
-        ret = gpg._extract_tar(path)
-        assert ret is None
-        os.remove.assert_called_once_with(tarpath_ext)
-    else:
-        with pytest.raises(gpg.GPGException) as excinfo:
-            ret = gpg._extract_tar(path)
-        assert "Failed to extract {} to a directory at the same" " location.".format(
-            path
-        ) == str(excinfo.value)
-        os.rename.assert_any_call(tarpath_ext, path)
-        assert not os.remove.called
-    os.rename.assert_any_call(path, tarpath_ext)
-    subprocess.check_output.assert_called_once_with(
-        ["tar", "-xf", tarpath_ext, "-C", dirname]
+def fake_gpg_decrypt_process(path, status):
+    return subprocess.Popen(
+        ["cat", path], stdout=subprocess.PIPE, stderr=status, close_fds=True
     )
 
 
-@pytest.mark.parametrize(
-    "path, will_be_file, will_be_tar, sp_raises, expected",
-    [
-        CrTarCase(
-            path="/a/b/c", isfile=True, istar=True, raises=False, expected="success"
-        ),
-        CrTarCase(
-            path="/a/b/c/", isfile=True, istar=True, raises=False, expected="success"
-        ),
-        CrTarCase(
-            path="/a/b/c", isfile=True, istar=False, raises=False, expected="fail"
-        ),
-        CrTarCase(
-            path="/a/b/c", isfile=False, istar=True, raises=False, expected="fail"
-        ),
-        CrTarCase(
-            path="/a/b/c", isfile=False, istar=False, raises=True, expected="fail"
+@pytest.fixture
+def fake_gpg(mocker):
+    mocker.patch.object(
+        gpgutils, "gpg_encrypt_stream", side_effect=fake_gpg_encrypt_stream
+    )
+    mocker.patch.object(
+        gpgutils,
+        "gpg_encrypt_file",
+        side_effect=lambda path, fingerprint: (
+            path + ".gpg",
+            fake_gpg_encrypt_stream(open(path, "rb"), fingerprint, path + ".gpg"),
         ),
-    ],
-)
-def test__create_tar(mocker, path, will_be_file, will_be_tar, sp_raises, expected):
-    if sp_raises:
-        mocker.patch.object(subprocess, "check_output", side_effect=OSError("gotcha!"))
-    else:
-        mocker.patch.object(subprocess, "check_output")
-    mocker.patch.object(os.path, "isfile", return_value=will_be_file)
-    mocker.patch.object(tarfile, "is_tarfile", return_value=will_be_tar)
-    mocker.patch.object(os, "rename")
-    mocker.patch.object(shutil, "rmtree")
-    fixed_path = path.rstrip("/")
-    tarpath = "{}.tar".format(fixed_path)
-    if expected == "success":
-        ret = gpg._create_tar(path)
-        shutil.rmtree.assert_called_once_with(fixed_path)
-        os.rename.assert_called_once_with(tarpath, fixed_path)
-        tarfile.is_tarfile.assert_any_call(fixed_path)
-        assert ret is None
-    else:
-        with pytest.raises(gpg.GPGException) as excinfo:
-            ret = gpg._create_tar(path)
-        assert "Failed to create a tarfile at {} for dir at {}".format(
-            tarpath, fixed_path
-        ) == str(excinfo.value)
-        assert not shutil.rmtree.called
-        assert not os.rename.called
-    if not sp_raises:
-        os.path.isfile.assert_called_once_with(tarpath)
-        if will_be_file:
-            tarfile.is_tarfile.assert_any_call(tarpath)
+    )
+    mocker.patch.object(gpgutils, "gpg_decrypt_file", side_effect=fake_gpg_decrypt_file)
+    mocker.patch.object(
+        gpgutils, "gpg_decrypt_stream", side_effect=fake_gpg_decrypt_stream
+    )
+    mocker.patch.object(
+        gpgutils, "gpg_decrypt_process", side_effect=fake_gpg_decrypt_process
+    )
+    mocker.patch.object(
+        gpgutils, "gpg_decrypt_result", return_value=DECRYPT_RET_SUCCESS
+    )
+    mocker.patch.object(
+        gpgutils, "get_gpg_key", return_value={"fingerprint": SOME_FINGERPRINT}
+    )
+
+
+def test__gpg_encrypt_decrypt_directory(tmpdir, fake_gpg):
+    aip = tmpdir.mkdir("aip-uuid")
+    aip.mkdir("data").join("file.txt").write("contents")
+    aip.join("bagit.txt").write("bagit")
+
+    assert gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT)[0] == str(aip)
+    assert aip.isfile()
+    assert tarfile.is_tarfile(str(aip))
+    assert tmpdir.listdir() == [aip]
+
+    assert gpg._gpg_decrypt(str(aip)) == str(aip)
+    assert aip.isdir()
+    assert aip.join("data", "file.txt").read() == "contents"
+    assert aip.join("bagit.txt").read() == "bagit"
+    assert tmpdir.listdir() == [aip]
+
+
+def test__gpg_encrypt_decrypt_file_without_extension(tmpdir, fake_gpg):
+    package = tmpdir.join("package")
+    package.write("not a tarfile " * 100)
+
+    gpg._gpg_encrypt(str(package), SOME_FINGERPRINT)
+    gpg._gpg_decrypt(str(package))
+
+    assert package.read() == "not a tarfile " * 100
+    assert tmpdir.listdir() == [package]
+
+
+def test__gpg_encrypt_directory_fails(tmpdir, fake_gpg):
+    gpgutils.gpg_encrypt_stream.side_effect = None
+    gpgutils.gpg_encrypt_stream.return_value = ENCRYPT_RET_FAIL
+    aip = tmpdir.mkdir("aip-uuid")
+    aip.join("file.txt").write("contents")
+
+    with pytest.raises(gpg.GPGException):
+        gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT)
+
+    assert aip.join("file.txt").read() == "contents"
+    assert tmpdir.listdir() == [aip]
+
+
+def test__gpg_decrypt_extraction_fails(tmpdir, fake_gpg):
+    aip = tmpdir.mkdir("aip-uuid")
+    aip.join("file.txt").write("contents" * 1000)
+    gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT)
+    # Truncate the tarfile in the middle of the data of file.txt
+    encrypted = aip.read_binary()
+    aip.write_binary(encrypted[: tarfile.BLOCKSIZE * 3 + 10])
+
+    with pytest.raises(gpg.GPGException) as excinfo:
+        gpg._gpg_decrypt(str(aip))
+
+    assert "Failed to decrypt {}. Reason: tar exited with status".format(aip) in str(
+        excinfo.value
+    )
+    assert aip.isfile()
+    assert tmpdir.listdir() == [aip]
+
+
+def test_browse_indexed_package(tmpdir, mocker, fake_gpg):
+    mocker.patch("common.utils.get_setting", return_value=False)
+    mocker.patch.object(gpg, "_get_gpg_version", return_value=GPG_VERSION)
+    src = tmpdir.mkdir("src").mkdir("aip-uuid")
+    src.join("bagit.txt").write("bagit")
+    src.mkdir("data").join("file.txt").write("contents")
+    dst = tmpdir.mkdir("gpg").join("aip-uuid")
+    gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space())
+    gpg_space.move_from_storage_service(
+        str(src), str(dst), package=MockPackage(should_have_pointer=False)
+    )
+    assert dst.isfile()
+    index_path = tmpdir.join("gpg", ".aip-uuid.index.gpg")
+    assert index_path.isfile()
+    mocker.spy(gpg, "_gpg_decrypt")
+
+    assert gpg_space.browse(str(dst)) == {
+        "directories": [b"data"],
+        "entries": [b"bagit.txt", b"data"],
+        "properties": {b"bagit.txt": {"size": 5}, b"data": {"object count": 1}},
+    }
+    assert gpg_space.browse(str(dst.join("data"))) == {
+        "directories": [],
+        "entries": [b"file.txt"],
+        "properties": {b"file.txt": {"size": 8}},
+    }
+    assert not gpg._gpg_decrypt.called
+
+    gpg_space.delete_path(str(dst))
+    assert tmpdir.join("gpg").listdir() == []
+
+
+def test_browse_indexes_unindexed_package(tmpdir, mocker, fake_gpg):
+    mocker.patch("common.utils.get_setting", return_value=False)
+    mocker.patch.object(
+        gpg, "_encr_path2key_fingerprint", return_value=SOME_FINGERPRINT
+    )
+    aip = tmpdir.mkdir("aip-uuid")
+    aip.mkdir("data").join("file.txt").write("contents")
+    gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT)
+    encrypted = aip.read_binary()
+    mocker.spy(gpg, "_gpg_decrypt")
+
+    for __ in range(2):
+        assert gpg.GPG().browse(str(aip.join("data"))) == {
+            "directories": [],
+            "entries": [b"file.txt"],
+            "properties": {b"file.txt": {"size": 8}},
+        }
+
+    # The package was decrypted once to index it, and left as it was
+    assert gpg._gpg_decrypt.call_count == 1
+    assert aip.read_binary() == encrypted
+    assert sorted(tmpdir.listdir()) == [tmpdir.join(".aip-uuid.index.gpg"), aip]
+
+
+def test_move_to_storage_service_extracts_member(tmpdir, mocker, fake_gpg):
+    aip = tmpdir.mkdir("gpg").mkdir("aip-uuid")
+    aip.join("bagit.txt").write("bagit")
+    aip.mkdir("data").join("file.txt").write("contents")
+    aip.join("data").mkdir("sub").join("other.txt").write("other")
+    gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT)
+    encrypted = aip.read_binary()
+    mocker.spy(gpg, "_gpg_decrypt")
+    staging = tmpdir.mkdir("staging")
+    gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space())
+
+    gpg_space.move_to_storage_service(
+        str(aip.join("data", "file.txt")), str(staging.join("file.txt")), None
+    )
+    gpg_space.move_to_storage_service(
+        str(aip.join("data", "sub")) + "/", str(staging.join("sub")) + "/", None
+    )
+
+    assert staging.join("file.txt").read() == "contents"
+    assert staging.join("sub", "other.txt").read() == "other"
+    assert sorted(staging.listdir()) == [staging.join("file.txt"), staging.join("sub")]
+    # The package was neither decrypted in place nor rewritten
+    assert not gpg._gpg_decrypt.called
+    assert aip.read_binary() == encrypted
+    assert tmpdir.join("gpg").listdir() == [aip]
+
+
+def test__gpg_extract_member_not_a_tarfile(tmpdir, fake_gpg):
+    package = tmpdir.join("package.7z")
+    package.write("not a tarfile " * 100)
+    decr_path = tmpdir.join("package.decrypted")
+
+    with pytest.raises(gpg.GPGException) as excinfo:
+        gpg._gpg_extract_member(str(package), "package/file.txt", str(decr_path))
+
+    assert "The decrypted data is not a tarfile" in str(excinfo.value)
+    assert tmpdir.listdir() == [package]
+
+
+def make_aip(parent):
+    aip = parent.mkdir("aip-uuid")
+    aip.join("bagit.txt").write("bagit")
+    data = aip.mkdir("data")
+    data.join("file1.bin").write_binary(os.urandom(5000))
+    data.mkdir("sub").join("file2.bin").write_binary(os.urandom(3000))
+    data.join("link").mksymlinkto("sub")
+    data.mkdir("empty")
+    return aip
+
+
+def read_tree(path):
+    return sorted(
+        (p.relto(path), None if p.isdir() else p.read_binary()) for p in path.visit()
+    )
+
+
+def test__gpg_encrypt_decrypt_container_directory(tmpdir, mocker, fake_gpg):
+    aip = make_aip(tmpdir)
+    tree = read_tree(aip)
+
+    assert gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT, 1000)[0] == str(aip)
+
+    assert aip.isfile()
+    assert aip.read_binary().startswith(gpg.CONTAINER_MAGIC)
+    manifest, __ = gpg._read_manifest(str(aip), SOME_FINGERPRINT)
+    assert manifest["segment_size"] == 1000
+    assert len(manifest["segments"]) == -(-manifest["size"] // 1000) > 8
+    assert sorted(manifest["members"]) == [
+        "aip-uuid",
+        "aip-uuid/bagit.txt",
+        "aip-uuid/data",
+        "aip-uuid/data/empty",
+        "aip-uuid/data/file1.bin",
+        "aip-uuid/data/link",
+        "aip-uuid/data/sub",
+        "aip-uuid/data/sub/file2.bin",
+    ]
+    # The manifest is signed
+    gpgutils.gpg_encrypt_stream.assert_called_with(
+        mocker.ANY, SOME_FINGERPRINT, mocker.ANY, sign=SOME_FINGERPRINT
+    )
+    assert tmpdir.listdir() == [aip]
+
+    assert gpg._gpg_decrypt(str(aip), SOME_FINGERPRINT) == str(aip)
+    assert aip.isdir()
+    assert read_tree(aip) == tree
+    assert tmpdir.listdir() == [aip]
+
+
+def test__gpg_encrypt_decrypt_container_file(tmpdir, fake_gpg):
+    package = tmpdir.join("package.7z")
+    contents = os.urandom(2500)
+    package.write_binary(contents)
+
+    gpg._gpg_encrypt(str(package), SOME_FINGERPRINT, 1000)
+    manifest, __ = gpg._read_manifest(str(package), SOME_FINGERPRINT)
+    assert manifest["members"] is None
+    assert len(manifest["segments"]) == 3
+    gpg._gpg_decrypt(str(package), SOME_FINGERPRINT)
+
+    assert package.read_binary() == contents
+    assert tmpdir.listdir() == [package]
+
+
+def test__gpg_encrypt_container_bounds_segments_in_flight(
+    tmpdir, mocker, settings, fake_gpg
+):
+    settings.GPG_SEGMENTS_IN_FLIGHT = 2
+    pending = []
+    add = gpg._SegmentEncrypter.add
+
+    def add_and_count(self, data):
+        add(self, data)
+        pending.append(len(self._pending))
+
+    mocker.patch.object(gpg._SegmentEncrypter, "add", add_and_count)
+    package = tmpdir.join("package.7z")
+    contents = os.urandom(5500)
+    package.write_binary(contents)
+
+    gpg._gpg_encrypt(str(package), SOME_FINGERPRINT, 1000)
+    gpg._gpg_decrypt(str(package), SOME_FINGERPRINT)
+
+    # With the segment being cut, two segments are held at most
+    assert pending == [1] * 6
+    assert package.read_binary() == contents
+
+
+def test_segment_size_is_bounded():
+    field = gpg.GPG._meta.get_field("segment_size")
+    field.run_validators(gpg.MAX_SEGMENT_SIZE)
+    with pytest.raises(ValidationError):
+        field.run_validators(gpg.MAX_SEGMENT_SIZE + 1)
+
+
+def test_move_to_storage_service_extracts_member_from_container(
+    tmpdir, mocker, fake_gpg
+):
+    mocker.patch.object(gpg, "_get_gpg_version", return_value=GPG_VERSION)
+    mocker.patch.object(
+        gpg, "_encr_path2key_fingerprint", return_value=SOME_FINGERPRINT
+    )
+    aip = make_aip(tmpdir.mkdir("src"))
+    file2 = aip.join("data", "sub", "file2.bin").read_binary()
+    dst = tmpdir.mkdir("gpg").join("aip-uuid")
+    gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space(), segment_size=1)
+    # Segments of 1 KiB
+    mocker.patch.object(gpg, "MiB", 1024)
+    gpg_space.move_from_storage_service(
+        str(aip), str(dst), package=MockPackage(should_have_pointer=False)
+    )
+    assert dst.read_binary().startswith(gpg.CONTAINER_MAGIC)
+    manifest, __ = gpg._read_manifest(str(dst), SOME_FINGERPRINT)
+    mocker.spy(gpg, "_decrypt_segment")
+    staging = tmpdir.mkdir("staging")
+
+    gpg_space.move_to_storage_service(
+        str(dst.join("data", "sub")), str(staging.join("sub")), None
+    )
+
+    assert staging.join("sub", "file2.bin").read_binary() == file2
+    assert staging.listdir() == [staging.join("sub")]
+    # Only the segments with the member were decrypted
+    assert 3 <= gpg._decrypt_segment.call_count < len(manifest["segments"]) // 2
+
+
+def test_move_to_storage_service_checks_container_key(tmpdir, fake_gpg):
+    package = tmpdir.mkdir("gpg").join("package.7z")
+    package.write("contents")
+    gpg._gpg_encrypt(str(package), SOME_FINGERPRINT, 1000)
+    dst = tmpdir.join("staging", "package.7z")
+    gpg_space = gpg.GPG(key=SOME_FINGERPRINT, space=space.Space())
+
+    with pytest.raises(gpg.GPGException):
+        gpg_space.move_to_storage_service(
+            str(package),
+            str(dst),
+            None,
+            package=MockPackage(fingerprint=SOME_OTHER_FINGERPRINT),
+        )
+    gpg_space.move_to_storage_service(
+        str(package), str(dst), None, package=MockPackage()
+    )
+
+    assert dst.read() == "contents"
+
+
+def test__gpg_decrypt_container_checksum_mismatch(tmpdir, fake_gpg):
+    aip = make_aip(tmpdir)
+    gpg._gpg_encrypt(str(aip), SOME_FINGERPRINT, 1000)
+    manifest, __ = gpg._read_manifest(str(aip), SOME_FINGERPRINT)
+    offset = manifest["segments"][2]["offset"]
+    container = bytearray(aip.read_binary())
+    container[offset] ^= 0xFF
+    aip.write_binary(bytes(container))
+
+    with pytest.raises(gpg.GPGException) as excinfo:
+        gpg._gpg_decrypt(str(aip), SOME_FINGERPRINT)
+
+    assert "Checksum mismatch for the segment at offset {} of {}".format(
+        offset, aip
+    ) == str(excinfo.value)
+    assert aip.isfile()
+    assert tmpdir.listdir() == [aip]
+
+
+def test__read_manifest_not_signed_with_package_key(tmpdir, fake_gpg):
+    package = tmpdir.join("package.7z")
+    package.write("contents")
+    gpg._gpg_encrypt(str(package), SOME_FINGERPRINT, 1000)
+
+    # Signed with another key of the keyring
+    with pytest.raises(gpg.GPGException) as excinfo:
+        gpg._gpg_decrypt(str(package), SOME_OTHER_FINGERPRINT)
+
+    assert "The manifest of {} is not signed with the key {}".format(
+        package, SOME_OTHER_FINGERPRINT
+    ) == str(excinfo.value)
+    assert tmpdir.listdir() == [package]
+
+
+def test__read_index_fails(tmpdir, fake_gpg):
+    package = tmpdir.join("package")
+    tmpdir.join(".package.index.gpg").write("not json")
+
+    assert gpg._read_index(str(package)) is None
+    assert tmpdir.listdir() == [tmpdir.join(".package.index.gpg")]
+
+
+def test__parse_gpg_version():
+    assert GPG_VERSION == gpg._parse_gpg_version(RAW_GPG_VERSION)
 
 
 class TestGPG(TestCase):
@@ -545,21 +913,20 @@ class TestGPG(TestCase):
         assert package.current_path == exp_curr_path
         assert package.encryption_key_fingerprint == EXP_FINGERPRINT
 
-        encr_path = exp_curr_path
+        # The package is in the location at /home
+        encr_path = "/home/{}".format(exp_curr_path)
         assert gpg._encr_path2key_fingerprint(encr_path) == EXP_FINGERPRINT
 
-        encr_path = "/abs/path/to/{}".format(exp_curr_path)
+        encr_path = "/home/{}/data/objects/somefile.jpg".format(exp_curr_path)
         assert gpg._encr_path2key_fingerprint(encr_path) == EXP_FINGERPRINT
 
-        encr_path = "{}/data/objects/somefile.jpg".format(exp_curr_path)
-        assert gpg._encr_path2key_fingerprint(encr_path) == EXP_FINGERPRINT
-
-        encr_path = "/abs/path/to/{}/data/objects/somefile.jpg".format(exp_curr_path)
-        assert gpg._encr_path2key_fingerprint(encr_path) == EXP_FINGERPRINT
-
-        with pytest.raises(gpg.GPGException) as excinfo:
-            encr_path = "/some/non/matching/path.jpg"
-            gpg._encr_path2key_fingerprint(encr_path)
-        assert "Unable to find package matching encrypted path {}".format(
-            encr_path
-        ) in str(excinfo.value)
+        for encr_path in (
+            "/abs/path/to/{}".format(exp_curr_path),
+            "/home/{}".format(os.path.dirname(exp_curr_path)),
+            "/some/non/matching/path.jpg",
+        ):
+            with pytest.raises(gpg.GPGException) as excinfo:
+                gpg._encr_path2key_fingerprint(encr_path)
+            assert "Unable to find package matching encrypted path {}".format(
+                encr_path
+            ) in str(excinfo.value)
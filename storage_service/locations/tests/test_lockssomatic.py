@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
+import shutil
+import subprocess
+import tempfile
 
 from django.test import TestCase
+from lxml import etree
+import mock
 import vcr
 
+from common import utils
 from locations import models
+from locations.models.lockssomatic import _hash_byte_ranges, _split_file
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 FIXTURES_DIR = os.path.abspath(os.path.join(THIS_DIR, "..", "fixtures"))
@@ -16,6 +24,10 @@ class TestLockssomatic(TestCase):
 
     def setUp(self):
         self.lom_object = models.Lockssomatic.objects.all()[0]
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
 
     @vcr.use_cassette(
         os.path.join(FIXTURES_DIR, "vcr_cassettes", "test_lockssomatic_bad_url.yaml")
@@ -26,3 +38,170 @@ class TestLockssomatic(TestCase):
         assert self.lom_object.au_size == 0
         assert self.lom_object.collection_iri is None
         assert self.lom_object.checksum_type is None
+
+    def test_split_file(self):
+        file_path = os.path.join(self.tmp_dir, "aip.7z")
+        with open(file_path, "wb") as f:
+            f.write(os.urandom(50 * 1024))
+        name = os.path.join(self.tmp_dir, "aip.tar")
+
+        chunks = _split_file(file_path, name, 20, "sha256")
+
+        assert [path for path, _, _ in chunks] == [
+            name + "-1",
+            name + "-2",
+            name + "-3",
+        ]
+        for path, size, checksum in chunks:
+            with open(path, "rb") as f:
+                data = f.read()
+            assert size == len(data) == 20 * 1024
+            assert checksum == hashlib.sha256(data).hexdigest()
+        # Nothing is left behind but the file and its chunks
+        assert sorted(os.listdir(self.tmp_dir)) == [
+            "aip.7z",
+            "aip.tar-1",
+            "aip.tar-2",
+            "aip.tar-3",
+        ]
+        # The chunks are a multi-volume tar of the file
+        extract_dir = os.path.join(self.tmp_dir, "extract")
+        os.mkdir(extract_dir)
+        subprocess.check_call(
+            ["tar", "-x", "-M", "-C", extract_dir]
+            + ["-f{}".format(path) for path, _, _ in chunks]
+        )
+        with open(file_path, "rb") as f, open(
+            os.path.join(extract_dir, file_path.lstrip("/")), "rb"
+        ) as g:
+            assert f.read() == g.read()
+
+    def test_split_file_fails(self):
+        name = os.path.join(self.tmp_dir, "aip.tar")
+        with self.assertRaises(subprocess.CalledProcessError):
+            _split_file(os.path.join(self.tmp_dir, "missing"), name, 20, "md5")
+        assert os.listdir(self.tmp_dir) == []
+
+    def test_hash_byte_ranges(self):
+        file_path = os.path.join(self.tmp_dir, "aip.7z")
+        data = os.urandom(50)
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        assert _hash_byte_ranges(file_path, 20, "md5") == [
+            (0, 19, hashlib.md5(data[:20]).hexdigest()),
+            (20, 39, hashlib.md5(data[20:40]).hexdigest()),
+            (40, 49, hashlib.md5(data[40:]).hexdigest()),
+        ]
+
+    def test_chunk_byte_range(self):
+        self.lom_object.pointer_root = etree.fromstring(
+            """<mets:mets xmlns:mets="http://www.loc.gov/METS/">
+              <mets:fileSec>
+                <mets:fileGrp USE="LOCKSS chunk">
+                  <mets:file ID="aip.7z.au-1" BEGIN="0" END="19" BETYPE="BYTE"/>
+                  <mets:file ID="aip.7z.au-2" BEGIN="20" END="29" BETYPE="BYTE"/>
+                  <mets:file ID="aip.tar-1"/>
+                </mets:fileGrp>
+              </mets:fileSec>
+              <mets:structMap>
+                <mets:div TYPE="Archival Information Package">
+                  <mets:div TYPE="LOCKSS chunk" ORDER="1">
+                    <mets:fptr FILEID="aip.7z.au-1"/>
+                  </mets:div>
+                  <mets:div TYPE="LOCKSS chunk" ORDER="2">
+                    <mets:fptr FILEID="aip.7z.au-2"/>
+                  </mets:div>
+                  <mets:div TYPE="LOCKSS chunk" ORDER="3">
+                    <mets:fptr FILEID="aip.tar-1"/>
+                  </mets:div>
+                </mets:div>
+              </mets:structMap>
+            </mets:mets>"""
+        )
+        package = models.Package()
+
+        assert self.lom_object.chunk_byte_range(package, "2") == ("aip.7z.au-2", 20, 29)
+        assert self.lom_object.chunk_byte_range(package, "3") is None
+        assert self.lom_object.chunk_byte_range(package, "4") is None
+
+    def test_create_resource_uses_stored_metadata(self):
+        self.lom_object.pointer_root = etree.parse(
+            os.path.join(
+                FIXTURES_DIR, "pointer.c0f8498f-b92e-4a8b-8941-1b34ba062ed8.xml"
+            )
+        )
+        file_path = os.path.join(self.tmp_dir, "aip.7z")
+        with open(file_path, "wb") as f:
+            f.write(b"aip")
+        package = models.Package(
+            uuid="c0f8498f-b92e-4a8b-8941-1b34ba062ed8",
+            current_path="aip.7z",
+            misc_attributes={
+                "dublincore": {"title": "Title", "description": "Description"}
+            },
+        )
+
+        self.lom_object._download_url = mock.Mock(return_value="http://ss/aip")
+        with mock.patch.object(package, "extract_file") as extract_file:
+            entry, slug = self.lom_object._create_resource(package, [file_path])
+
+        assert not extract_file.called
+        assert slug == "Title"
+        entry = etree.fromstring(str(entry))
+        assert entry.findtext("atom:title", namespaces=utils.NSMAP) == "Title"
+        assert entry.findtext("atom:summary", namespaces=utils.NSMAP) == "Description"
+        assert entry.findtext("atom:author/atom:name", namespaces=utils.NSMAP) == "test"
+        content = entry.find("lom:content", namespaces=utils.NSMAP)
+        assert content.get("checksumValue") == hashlib.md5(b"aip").hexdigest()
+        assert float(content.get("size")) == 1
+
+    def test_dublin_core_is_recorded_when_stored(self):
+        mets_dir = os.path.join(self.tmp_dir, "aip", "data")
+        os.makedirs(mets_dir)
+        mets_path = os.path.join(mets_dir, "METS.1234.xml")
+        with open(mets_path, "w") as f:
+            f.write(
+                '<mets:mets xmlns:mets="http://www.loc.gov/METS/" '
+                'xmlns:dcterms="http://purl.org/dc/terms/">'
+                '<mets:dmdSec><mets:mdWrap MDTYPE="DC"><mets:xmlData>'
+                "<dcterms:dublincore><dcterms:title>Title</dcterms:title>"
+                "</dcterms:dublincore></mets:xmlData></mets:mdWrap></mets:dmdSec>"
+                "</mets:mets>"
+            )
+        package = models.Package(uuid="1234", current_path="aip.7z")
+
+        with mock.patch.object(
+            package, "extract_file", return_value=(mets_path, self.tmp_dir + "-x")
+        ) as extract_file, mock.patch.object(self.lom_object.space, "move_rsync"):
+            self.lom_object.move_from_storage_service(
+                "staging/aip.7z", "lockss/aip.7z", package=package
+            )
+            extract_file.assert_called_once_with("aip/data/METS.1234.xml")
+            extract_file.reset_mock()
+
+            assert self.lom_object._dublin_core(package) == {"title": "Title"}
+            assert not extract_file.called
+
+        assert package.misc_attributes["dublincore"] == {"title": "Title"}
+
+    def test_dublin_core_is_recorded_for_older_packages(self):
+        mets_path = os.path.join(self.tmp_dir, "METS.1234.xml")
+        with open(mets_path, "w") as f:
+            f.write(
+                '<mets:mets xmlns:mets="http://www.loc.gov/METS/" '
+                'xmlns:dcterms="http://purl.org/dc/terms/">'
+                '<mets:dmdSec><mets:mdWrap MDTYPE="DC"><mets:xmlData>'
+                "<dcterms:dublincore><dcterms:title>Title</dcterms:title>"
+                "</dcterms:dublincore></mets:xmlData></mets:mdWrap></mets:dmdSec>"
+                "</mets:mets>"
+            )
+        package = models.Package(uuid="1234", current_path="aip.7z")
+
+        with mock.patch.object(
+            package, "extract_file", return_value=(mets_path, self.tmp_dir + "-x")
+        ), mock.patch.object(package, "save") as save:
+            assert self.lom_object._dublin_core(package) == {"title": "Title"}
+
+        save.assert_called_once_with(update_fields=["misc_attributes"])
+        assert package.misc_attributes["dublincore"] == {"title": "Title"}
@@ -377,6 +377,39 @@ class TestPackage(TestCase):
             body = '{"download_url": "http://ss.com/api/v2/file/%s/download/"}' % uuid
             mocked_execute.assert_called_with(url, body)
 
+    @mock.patch("locations.models.Package._update_existing_ptr_loc_info")
+    @mock.patch("locations.models.Space.move_to_storage_service")
+    @mock.patch("locations.models.Space.server_side_copy")
+    @mock.patch(
+        "locations.models.Space.posix_move",
+        side_effect=models.PosixMoveUnsupportedError,
+    )
+    def test_move_prefers_server_side_copy(
+        self, mock_posix_move, mock_server_side_copy, mock_move_to_ss, mock_update_ptr
+    ):
+        package = models.Package.objects.get(
+            uuid="6aebdb24-1b6b-41ab-b4a3-df9a73726a34"
+        )
+        to_location = models.Location.objects.get(
+            uuid="4056b25d-6a85-4557-b9a5-9c85565fd892"
+        )
+        source_path = os.path.join(
+            package.current_location.relative_path, package.current_path
+        )
+
+        package.move(to_location)
+
+        mock_server_side_copy.assert_called_once_with(
+            source_path=source_path,
+            destination_path=os.path.join(
+                to_location.relative_path, package.current_path
+            ),
+            destination_space=to_location.space,
+            package=None,
+        )
+        assert not mock_move_to_ss.called
+        assert package.current_location == to_location
+
     def test_replicate_aip(self):
         space_dir = tempfile.mkdtemp(dir=self.tmp_dir, prefix="space")
         replication_dir = tempfile.mkdtemp(dir=self.tmp_dir, prefix="replication")
@@ -1,14 +1,21 @@
+import hashlib
 import os
+import shutil
+import tempfile
 
+import bagit
 import botocore
 import boto3
 import mock
 import pytest
 
+from django.core.cache import cache
 from django.test import TestCase
 from moto import mock_s3
 
+from common import utils
 from locations import models
+from locations.models.space import clear_client_cache
 
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -23,9 +30,12 @@ class TestS3Storage(TestCase):
         self.mock = mock_s3()
         self.mock.start()
         self.s3_object = models.S3.objects.get(id=1)
+        cache.clear()
+        clear_client_cache()
 
     def tearDown(self):
         self.mock.stop()
+        clear_client_cache()
 
     def test_bucket_name(self):
         assert self.s3_object.bucket_name == "test-bucket"
@@ -94,3 +104,229 @@ class TestS3Storage(TestCase):
         assert "timestamp" in properties
         assert properties["e_tag"] == '"e917f867114dedf9bdb430e838da647d"'
         assert properties["size"] == 1564
+
+    def test_browse_lists_only_the_directory(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        for key in ("dir/", "dir/a.txt", "dir/sub/b.txt", "dir/sub/deeper/c.txt"):
+            client.put_object(Bucket="test-bucket", Key=key, Body=b"data")
+
+        contents = self.s3_object.browse("/dir")
+        assert sorted(contents["entries"]) == ["a.txt", "sub"]
+        assert contents["directories"] == ["sub"]
+        assert list(contents["properties"]) == ["a.txt"]
+        assert "next_marker" not in contents
+
+    def test_browse_pages(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        for name in ("one", "two", "three"):
+            client.put_object(
+                Bucket="test-bucket", Key="dir/{}/file.txt".format(name), Body=b""
+            )
+
+        page = self.s3_object.browse("/dir", limit=2)
+        assert page["directories"] == ["one", "three"]
+        page = self.s3_object.browse("/dir", limit=2, marker=page["next_marker"])
+        assert page["directories"] == ["two"]
+        assert "next_marker" not in page
+
+    def test_browse_cache_invalidated_by_writes(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        client.put_object(Bucket="test-bucket", Key="dir/a.txt", Body=b"a")
+        assert self.s3_object.browse("/dir")["entries"] == ["a.txt"]
+
+        # Changes made behind the space's back are not seen until expiry
+        client.put_object(Bucket="test-bucket", Key="dir/b.txt", Body=b"b")
+        assert self.s3_object.browse("/dir")["entries"] == ["a.txt"]
+
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        with open(os.path.join(src_dir, "c.txt"), "wb") as f:
+            f.write(b"c")
+        self.s3_object.move_from_storage_service(
+            os.path.join(src_dir, "c.txt"), "/dir/c.txt"
+        )
+        assert self.s3_object.browse("/dir")["entries"] == ["a.txt", "b.txt", "c.txt"]
+
+    def test_move_to_records_package_checksums(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        client.upload_file(
+            os.path.join(FIXTURES_DIR, "working_bag.zip"),
+            "test-bucket",
+            "subdir/bag.zip",
+        )
+        package = models.Package()
+        dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest_dir)
+        dest_path = os.path.join(dest_dir, "bag.zip")
+
+        self.s3_object.move_to_storage_service(
+            "/subdir/bag.zip", dest_path, None, package=package
+        )
+
+        with open(os.path.join(FIXTURES_DIR, "working_bag.zip"), "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        assert package.transfer_checksums == {"sha256": expected}
+        assert utils.generate_checksum(dest_path, "sha256").hexdigest() == expected
+
+    def test_transfer_config(self):
+        config = self.s3_object.transfer_config
+        assert config.max_concurrency == 10
+        assert config.multipart_chunksize == 8 * 1024 * 1024
+        assert config.use_threads
+
+        self.s3_object.s3_part_size = 16
+        self.s3_object.s3_max_concurrency = 4
+        config = self.s3_object.transfer_config
+        assert config.max_concurrency == 4
+        assert config.multipart_threshold == 16 * 1024 * 1024
+        assert config.multipart_chunksize == 16 * 1024 * 1024
+        assert not self.s3_object.object_transfer_config.use_threads
+
+    def test_move_directory_round_trip(self):
+        self.s3_object.s3_part_size = 5
+        self.s3_object.s3_max_concurrency = 3
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        contents = {
+            "small.txt": b"small",
+            "sub/other.txt": b"other" * 100,
+            "sub/deeper/large.bin": os.urandom(6 * 1024 * 1024),
+        }
+        for name, data in contents.items():
+            path = os.path.join(src_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+
+        self.s3_object.move_from_storage_service(src_dir, "/aips/transfer")
+
+        client = boto3.client("s3", region_name="us-east-1")
+        keys = client.list_objects(Bucket="test-bucket", Prefix="aips/transfer/")
+        assert sorted(obj["Key"] for obj in keys["Contents"]) == [
+            "aips/transfer/small.txt",
+            "aips/transfer/sub/deeper/large.bin",
+            "aips/transfer/sub/other.txt",
+        ]
+
+        dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest_dir)
+        self.s3_object.move_to_storage_service(
+            "/aips/transfer/", os.path.join(dest_dir, ""), None
+        )
+        for name, data in contents.items():
+            with open(os.path.join(dest_dir, name), "rb") as f:
+                assert f.read() == data
+
+    def test_delete_path_deletes_in_batches(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        for idx in range(5):
+            client.put_object(
+                Bucket="test-bucket", Key="aips/pkg/file{}.txt".format(idx), Body=b""
+            )
+        client.put_object(Bucket="test-bucket", Key="aips/other.txt", Body=b"")
+        resource = self.s3_object.s3_resource
+        delete_objects = mock.Mock(wraps=resource.meta.client.delete_objects)
+        resource.meta.client.delete_objects = delete_objects
+
+        with mock.patch("locations.models.s3.DELETE_BATCH_SIZE", 2):
+            self.s3_object.delete_path("/aips/pkg/")
+
+        assert delete_objects.call_count == 3
+        keys = client.list_objects_v2(Bucket="test-bucket")["Contents"]
+        assert [obj["Key"] for obj in keys] == ["aips/other.txt"]
+
+    def test_delete_path_missing(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+
+        with pytest.raises(models.StorageException):
+            self.s3_object.delete_path("/aips/pkg/")
+
+    def test_delete_path_reports_errors(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        client.put_object(Bucket="test-bucket", Key="aips/pkg/file.txt", Body=b"")
+        resource = self.s3_object.s3_resource
+        resource.meta.client.delete_objects = mock.Mock(
+            return_value={
+                "Errors": [
+                    {
+                        "Key": "aips/pkg/file.txt",
+                        "Code": "AccessDenied",
+                        "Message": "Access Denied",
+                    }
+                ]
+            }
+        )
+
+        with pytest.raises(models.StorageException) as excinfo:
+            self.s3_object.delete_path("/aips/pkg/")
+        assert "aips/pkg/file.txt: Access Denied" in str(excinfo.value)
+
+    def test_server_side_copy(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        for name in ("a.txt", "sub/b.txt"):
+            client.put_object(
+                Bucket="test-bucket", Key="aips/pkg/" + name, Body=name.encode()
+            )
+
+        self.s3_object.server_side_copy(
+            "/aips/pkg", "/replicas/pkg", self.s3_object.space
+        )
+
+        for name in ("a.txt", "sub/b.txt"):
+            obj = client.get_object(Bucket="test-bucket", Key="replicas/pkg/" + name)
+            assert obj["Body"].read() == name.encode()
+
+    def test_server_side_copy_missing(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+
+        with pytest.raises(models.StorageException):
+            self.s3_object.server_side_copy(
+                "/aips/pkg", "/replicas/pkg", self.s3_object.space
+            )
+
+    def test_server_side_copy_unsupported(self):
+        other = models.S3(
+            s3_endpoint_url="https://s3.example.com", s3_region="us-east-1"
+        )
+        dest_space = mock.Mock(**{"get_child_space.return_value": other})
+
+        with pytest.raises(models.ServerSideCopyUnsupportedError):
+            self.s3_object.server_side_copy("/aips/pkg", "/replicas/pkg", dest_space)
+
+        dest_space.get_child_space.return_value = mock.Mock()
+        with pytest.raises(models.ServerSideCopyUnsupportedError):
+            self.s3_object.server_side_copy("/aips/pkg", "/replicas/pkg", dest_space)
+
+    def test_check_package_fixity(self):
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        bag_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bag_dir)
+        with open(os.path.join(bag_dir, "test.txt"), "wb") as f:
+            f.write(b"test")
+        bagit.make_bag(bag_dir)
+        for path, dirs, files in os.walk(bag_dir):
+            for basename in files:
+                entry = os.path.join(path, basename)
+                key = "aips/bag/" + os.path.relpath(entry, bag_dir)
+                client.upload_file(entry, "test-bucket", key)
+        package = mock.Mock(full_path="/aips/bag")
+
+        assert self.s3_object.check_package_fixity(package) == (True, [], "", None)
+
+        client.put_object(
+            Bucket="test-bucket", Key="aips/bag/data/test.txt", Body=b"changed"
+        )
+        success, failures, _, _ = self.s3_object.check_package_fixity(package)
+        assert success is False
+        assert {failure.path for failure in failures} == {"data/test.txt"}
@@ -1,7 +1,19 @@
+import io
+import os
+
+from concurrent.futures import ThreadPoolExecutor
 import pytest
+from django.test import TestCase
 from scandir import scandir
 
-from locations.models.space import path2browse_dict
+from locations import models
+from locations.models import StorageException
+from locations.models.space import (
+    _partition_files,
+    clear_client_cache,
+    paginate_browse,
+    path2browse_dict,
+)
 
 
 def _restrict_access_to(restricted_path):
@@ -129,3 +141,235 @@ def test_path2browse_dict_object_counting_ignores_read_protected_directories(
             "tree_a.txt": {"size": 6},
         },
     }
+
+
+def test_paginate_browse():
+    objects = {
+        "entries": ["tree_a.txt", "first", "second", "error.txt"],
+        "directories": ["first", "second"],
+        "properties": {"first": {"object count": 2}, "tree_a.txt": {"size": 6}},
+    }
+    page = paginate_browse(objects, limit=2)
+    assert page == {
+        "entries": ["error.txt", "first"],
+        "directories": ["first"],
+        "properties": {"first": {"object count": 2}},
+        "next_marker": "first",
+    }
+    page = paginate_browse(objects, limit=2, marker=page["next_marker"])
+    assert page == {
+        "entries": ["second", "tree_a.txt"],
+        "directories": ["second"],
+        "properties": {"tree_a.txt": {"size": 6}},
+    }
+    assert paginate_browse(objects, marker="second")["entries"] == ["tree_a.txt"]
+
+
+def _listing(path):
+    return sorted(
+        (os.path.relpath(dirpath, path), sorted(dirnames), sorted(filenames))
+        for dirpath, dirnames, filenames in os.walk(path)
+    )
+
+
+def test_partition_files(tree):
+    tree.join("big.bin").write("x" * 100)
+
+    partitions = _partition_files(str(tree), "tree", 3)
+
+    assert partitions[0] == ["tree/big.bin"]
+    assert sorted(partitions[1] + partitions[2]) == [
+        "tree/error.txt",
+        "tree/first/first_B.txt",
+        "tree/first/first_a.txt",
+        "tree/second/second_a.txt",
+        "tree/second/third/third_a.txt",
+        "tree/tree_a.txt",
+    ]
+    assert len(partitions[1]) == len(partitions[2]) == 3
+
+
+@pytest.mark.parametrize("source_suffix, dest_subdir", [("", "tree"), ("/", "")])
+def test_move_rsync_parallel(
+    tree, tmpdir, mocker, settings, source_suffix, dest_subdir
+):
+    settings.RSYNC_WORKERS = 3
+    destination = tmpdir.mkdir("destination")
+    rsync = mocker.patch("locations.models.space._rsync", wraps=models.space._rsync)
+
+    models.Space().move_rsync(str(tree) + source_suffix, str(destination))
+
+    assert _listing(str(destination.join(dest_subdir))) == _listing(str(tree))
+    assert destination.join(dest_subdir, "second", "third", "third_a.txt").read() == (
+        "third A"
+    )
+    # Three rsync processes for the files, and one for the directories
+    assert rsync.call_count == 4
+
+
+@pytest.mark.parametrize("source_suffix, dest_subdir", [("", "tree"), ("/", "")])
+def test_move_rsync_copies_local_directories(
+    tree, tmpdir, mocker, source_suffix, dest_subdir
+):
+    tree.join("tree_a.txt").setmtime(1234567890)
+    destination = tmpdir.mkdir("destination")
+    popen = mocker.patch("subprocess.Popen")
+
+    models.Space().move_rsync(str(tree) + source_suffix, str(destination))
+
+    assert not popen.called
+    assert _listing(str(destination.join(dest_subdir))) == _listing(str(tree))
+    assert destination.join(dest_subdir, "second", "third", "third_a.txt").read() == (
+        "third A"
+    )
+    copied = destination.join(dest_subdir, "tree_a.txt")
+    assert copied.mtime() == 1234567890
+    assert (
+        copied.stat().mode & 0o777
+        == (tree.join("tree_a.txt").stat().mode | 0o660) & 0o770
+    )
+
+
+@pytest.mark.parametrize("dest_suffix", ["", "/"])
+def test_move_rsync_copies_local_files(tmpdir, mocker, dest_suffix):
+    tmpdir.join("source.txt").write("contents")
+    destination = tmpdir.mkdir("destination")
+    popen = mocker.patch("subprocess.Popen")
+
+    models.Space().move_rsync(
+        str(tmpdir.join("source.txt")), str(destination) + dest_suffix
+    )
+
+    assert not popen.called
+    assert destination.join("source.txt").read() == "contents"
+
+
+def test_move_rsync_falls_back_to_rsync(tree, tmpdir, mocker):
+    mocker.patch(
+        "common.fastcopy.copyfile", side_effect=IOError(13, "Permission denied")
+    )
+    popen = _failing_rsync(mocker, 0, b"")
+
+    models.Space().move_rsync(str(tree), str(tmpdir.join("destination")))
+
+    assert popen.call_args[0][0][-3:] == [
+        "-r",
+        str(tree),
+        str(tmpdir.join("destination")),
+    ]
+
+
+@pytest.mark.parametrize("source_suffix, dest_subdir", [("", "tree"), ("/", "")])
+def test_move_rsync_links_on_same_device(
+    tree, tmpdir, mocker, source_suffix, dest_subdir
+):
+    destination = tmpdir.mkdir("destination")
+    destination.ensure(dest_subdir, "tree_a.txt").write("previous")
+    copyfile = mocker.patch("common.fastcopy.copyfile")
+
+    models.Space().move_rsync(
+        str(tree) + source_suffix, str(destination), try_link_local=True
+    )
+
+    assert not copyfile.called
+    assert _listing(str(destination.join(dest_subdir))) == _listing(str(tree))
+    for name in ("tree_a.txt", "second/third/third_a.txt"):
+        linked = destination.join(dest_subdir, name)
+        assert linked.samefile(tree.join(name))
+    assert tree.join("tree_a.txt").read() == "tree A"
+
+
+def test_move_rsync_copies_across_devices(tree, tmpdir, mocker):
+    mocker.patch("locations.models.space._same_device", return_value=False)
+    link = mocker.patch("os.link")
+
+    models.Space().move_rsync(
+        str(tree), str(tmpdir.mkdir("destination")), try_link_local=True
+    )
+
+    assert not link.called
+    copied = tmpdir.join("destination", "tree", "tree_a.txt")
+    assert copied.read() == "tree A"
+    assert not copied.samefile(tree.join("tree_a.txt"))
+
+
+def _failing_rsync(mocker, returncode, output):
+    def popen(command, **kwargs):
+        return mocker.Mock(stdout=io.BytesIO(output), returncode=returncode)
+
+    return mocker.patch("subprocess.Popen", side_effect=popen)
+
+
+def test_move_rsync_retries_network_errors(mocker, settings):
+    settings.RSYNC_RETRIES = 2
+    popen = _failing_rsync(mocker, 255, b"ssh: connect to host: timed out\n")
+
+    with pytest.raises(StorageException) as excinfo:
+        models.Space().move_rsync("user@host:/src", "/dst")
+
+    assert "ssh: connect to host: timed out" in str(excinfo.value)
+    assert popen.call_count == 3
+
+
+def test_move_rsync_does_not_retry_other_errors(mocker, settings):
+    settings.RSYNC_RETRIES = 2
+    popen = _failing_rsync(mocker, 23, b"rsync: link_stat failed\n")
+
+    with pytest.raises(StorageException):
+        models.Space().move_rsync("/src", "/dst")
+
+    assert popen.call_count == 1
+
+
+class TestClientCache(TestCase):
+
+    fixtures = ["base.json", "s3.json"]
+
+    def setUp(self):
+        clear_client_cache()
+        self.space = models.Space.objects.get(
+            uuid="ae37f081-8baf-4d5d-9b1f-aebe367f1707"
+        )
+
+    def tearDown(self):
+        clear_client_cache()
+
+    def test_child_space_is_fresh(self):
+        child = self.space.get_child_space()
+        assert isinstance(child, models.S3)
+        assert self.space.get_child_space() is not child
+
+    def test_client_is_reused(self):
+        resource = self.space.get_child_space().s3_resource
+        assert self.space.get_child_space().s3_resource is resource
+
+    def test_client_changes_with_settings(self):
+        child = self.space.get_child_space()
+        resource = child.s3_resource
+        child.aws_access_key_id = "other-key"
+        child.aws_secret_access_key = "other-secret"
+        child.save()
+        assert self.space.get_child_space().s3_resource is not resource
+
+    def test_each_thread_has_its_own_client(self):
+        child = self.space.get_child_space()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(lambda: child.s3_resource).result()
+        assert other is not child.s3_resource
+
+
+def test_nfs_replica_is_independent_copy(tmpdir):
+    # Package.replicate stages the master, and moves the staged copy to the
+    # replicator location.
+    master = tmpdir.mkdir("aips").join("aip.7z")
+    master.write("aip")
+    staged = tmpdir.mkdir("staging").join("aip.7z")
+    replica = tmpdir.mkdir("replicas").join("aip.7z")
+    nfs = models.NFS(space=models.Space())
+
+    nfs.move_to_storage_service(str(master), str(staged), None)
+    nfs.move_from_storage_service(str(staged), str(replica))
+
+    assert replica.read() == "aip"
+    assert not replica.samefile(master)
+    assert master.read() == "aip"
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
 
 from django.test import TestCase
+import mock
 import pytest
 import vcr
 
+from common import checksums
 from locations import models
+from locations.models.space import clear_client_cache
 from . import TempDirMixin
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -18,6 +23,8 @@ class TestSwift(TempDirMixin, TestCase):
 
     def setUp(self):
         super(TestSwift, self).setUp()
+        clear_client_cache()
+        self.addCleanup(clear_client_cache)
         self.swift_object = models.Swift.objects.first()
 
     def test_has_required_attributes(self):
@@ -168,3 +175,141 @@ class TestSwift(TempDirMixin, TestCase):
         # Verify deleted
         resp = self.swift_object.browse("transfers/SampleTransfers/")
         assert "test" not in resp["directories"]
+
+    def test_move_to_ss_large_object(self):
+        # The ETag of a large object isn't the MD5 of its content
+        connection = mock.Mock()
+        connection.get_object.return_value = (
+            {"etag": '"not-the-md5"', "x-static-large-object": "True"},
+            iter([b"01234", b"56789"]),
+        )
+        test_file = self.tmpdir / "large.bin"
+
+        with mock.patch.object(models.Swift, "connection", connection):
+            self.swift_object.move_to_storage_service(
+                "aips/large.bin", str(test_file), None
+            )
+
+        assert test_file.read_bytes() == b"0123456789"
+        connection.get_object.assert_called_once_with(
+            "artefactual", "aips/large.bin", resp_chunk_size=checksums.BUFFER_SIZE
+        )
+
+    def test_move_from_ss_large_file(self):
+        test_file = self.tmpdir / "large.bin"
+        test_file.write_bytes(b"0123456789")
+        uploaded = {}
+
+        def put_object(container, obj, contents, content_length=None, **kwargs):
+            if hasattr(contents, "read"):
+                contents = contents.read(content_length)
+            uploaded[(container, obj)] = (contents, kwargs)
+            return hashlib.md5(contents).hexdigest()
+
+        connection = mock.Mock(**{"put_object.side_effect": put_object})
+        with mock.patch(
+            "swiftclient.client.Connection", return_value=connection
+        ), mock.patch("locations.models.swift.SEGMENT_SIZE", 4):
+            self.swift_object.move_from_storage_service(
+                str(test_file), "aips/large.bin"
+            )
+
+        connection.put_container.assert_called_once_with("artefactual_segments")
+        segments = sorted(key for key in uploaded if key[0] == "artefactual_segments")
+        assert [uploaded[key][0] for key in segments] == [b"0123", b"4567", b"89"]
+        assert [uploaded[key][1]["etag"] for key in segments] == [
+            hashlib.md5(data).hexdigest() for data in (b"0123", b"4567", b"89")
+        ]
+        contents, kwargs = uploaded[("artefactual", "aips/large.bin")]
+        assert kwargs["query_string"] == "multipart-manifest=put"
+        manifest = json.loads(contents)
+        assert [entry["path"] for entry in manifest] == [
+            u"/artefactual_segments/" + key[1] for key in segments
+        ]
+        assert [entry["size_bytes"] for entry in manifest] == [4, 4, 2]
+        assert manifest[2]["etag"] == hashlib.md5(b"89").hexdigest()
+
+    def test_move_from_ss_sends_md5(self):
+        test_file = self.tmpdir / "small.bin"
+        test_file.write_bytes(b"0123456789")
+        md5 = hashlib.md5(b"0123456789").hexdigest()
+        connection = mock.Mock(**{"put_object.return_value": md5})
+        with mock.patch("swiftclient.client.Connection", return_value=connection):
+            self.swift_object.move_from_storage_service(
+                str(test_file), "aips/small.bin"
+            )
+
+        assert connection.put_object.call_args[1]["etag"] == md5
+        assert not connection.delete_object.called
+
+    def test_server_side_copy(self):
+        connection = mock.Mock(**{"head_object.return_value": {"etag": '"abc"'}})
+
+        with mock.patch.object(models.Swift, "connection", connection):
+            self.swift_object.server_side_copy(
+                "aips/pkg.7z", "replicas/pkg.7z", self.swift_object.space
+            )
+
+        connection.copy_object.assert_called_once_with(
+            "artefactual", "aips/pkg.7z", destination=u"/artefactual/replicas/pkg.7z"
+        )
+        assert not connection.put_object.called
+
+    def test_server_side_copy_large_object(self):
+        segments = [
+            {"name": "/artefactual_segments/aips/pkg.7z/slo/1/00000000", "hash": "a"},
+            {"name": "/artefactual_segments/aips/pkg.7z/slo/1/00000001", "hash": "b"},
+        ]
+        for segment in segments:
+            segment["bytes"] = 4
+        connection = mock.Mock(
+            **{
+                "head_object.return_value": {"x-static-large-object": "True"},
+                "get_object.return_value": ({}, json.dumps(segments)),
+            }
+        )
+
+        with mock.patch.object(models.Swift, "connection", connection):
+            self.swift_object.server_side_copy(
+                "aips/pkg.7z", "replicas/pkg.7z", self.swift_object.space
+            )
+
+        connection.get_object.assert_called_once_with(
+            "artefactual", "aips/pkg.7z", query_string="multipart-manifest=get"
+        )
+        new_paths = [
+            u"/artefactual_segments/replicas/pkg.7z/slo/copy/00000000",
+            u"/artefactual_segments/replicas/pkg.7z/slo/copy/00000001",
+        ]
+        assert connection.copy_object.call_args_list == [
+            mock.call(
+                "artefactual_segments",
+                "aips/pkg.7z/slo/1/0000000%d" % idx,
+                destination=new_path,
+            )
+            for idx, new_path in enumerate(new_paths)
+        ]
+        connection.put_object.assert_called_once_with(
+            "artefactual",
+            obj="replicas/pkg.7z",
+            contents=mock.ANY,
+            query_string="multipart-manifest=put",
+        )
+        manifest = json.loads(connection.put_object.call_args[1]["contents"])
+        assert manifest == [
+            {"path": new_paths[0], "etag": "a", "size_bytes": 4},
+            {"path": new_paths[1], "etag": "b", "size_bytes": 4},
+        ]
+
+    def test_server_side_copy_dynamic_large_object_unsupported(self):
+        connection = mock.Mock(
+            **{"head_object.return_value": {"x-object-manifest": "segments/pkg"}}
+        )
+
+        with mock.patch.object(models.Swift, "connection", connection):
+            with pytest.raises(models.ServerSideCopyUnsupportedError):
+                self.swift_object.server_side_copy(
+                    "aips/pkg.7z", "replicas/pkg.7z", self.swift_object.space
+                )
+
+        assert not connection.copy_object.called
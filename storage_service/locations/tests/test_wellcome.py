@@ -1,26 +1,35 @@
+import hashlib
 import os
 import random
 import shutil
+import tarfile
 import tempfile
 from StringIO import StringIO
 import uuid
 
+import bagit
 import boto3
-import json
 from lxml import etree
 import mock
 import pytest
-import subprocess
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from moto import mock_s3
+from wellcome_storage_service import BagNotFound
 
 from locations import models
 from locations.models.wellcome import (
     extract_accession_identifiers,
     extract_dc_identifiers,
     get_common_prefix,
+    get_wellcome_identifier,
     NoCommonPrefix,
+    NoWellcomeIdentifierFound,
+    update_bag_info,
+    update_tag_manifest,
+    WellcomeIdentifier,
 )
+from locations.models.space import clear_client_cache
 
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -57,9 +66,12 @@ class WellcomeTestBase(TestCase):
 
     def setUp(self):
         self.wellcome_object = models.WellcomeStorageService.objects.get(id=1)
+        clear_client_cache()
+        self.addCleanup(clear_client_cache)
 
         self._s3 = boto3.client("s3", region_name="us-east-1")
         self._s3.create_bucket(Bucket=self.wellcome_object.s3_bucket)
+        self._s3.create_bucket(Bucket='ia-bucket')
 
         self.tmp_dir = tempfile.mkdtemp()
 
@@ -79,6 +91,43 @@ class WellcomeTestBase(TestCase):
         package.refresh_from_db = mock.Mock(side_effect=set_package_to_uploaded)
         return package
 
+    def get_bag_package(self):
+        package = self.get_package()
+        package.misc_attributes["wellcome.version"] = "v3"
+        package.misc_attributes["wellcome.space"] = "name-of-space"
+        package.misc_attributes["wellcome.external_identifier"] = "bag-id"
+        return package
+
+    def create_bag(self, files):
+        manifest_files = []
+        for name, contents in files:
+            path = 'v3/' + name
+            self._s3.upload_fileobj(StringIO(contents), 'ia-bucket', 'bucket-subdir/bag-id/' + path)
+            manifest_files.append({
+                'checksum': hashlib.sha256(contents).hexdigest(),
+                'name': name,
+                'path': path,
+                'size': len(contents),
+            })
+        return {
+            'location': {
+                'bucket': 'ia-bucket',
+                'path': 'bucket-subdir/bag-id',
+                'provider': {
+                    'id': 'aws-s3-ia',
+                }
+            },
+            'manifest': {
+                'checksumAlgorithm': 'SHA-256',
+                'files': manifest_files[1:],
+            },
+            'tagManifest': {
+                'checksumAlgorithm': 'SHA-256',
+                'files': manifest_files[:1],
+            },
+            'version': 'v3',
+        }
+
 
 class TestWellcomeMoveFromStorageService(WellcomeTestBase):
     @mock.patch('time.sleep')
@@ -147,32 +196,50 @@ class TestWellcomeMoveFromStorageService(WellcomeTestBase):
             ingest_type='create',
         )
 
-    @mock.patch('time.sleep')
+    @mock.patch('locations.models.wellcome.get_wellcome_identifier')
     @mock.patch('locations.models.wellcome.StorageServiceClient')
-    def test_waits_for_callback(self, mock_wellcome_client_class, mock_sleep):
-        package = self.get_package()
+    def test_submits_ingest_without_waiting(self, mock_wellcome_client_class, mock_get_identifier):
+        package = models.Package.objects.get(uuid=self.package_uuid)
+        package.misc_attributes['wellcome.ingest_location'] = 'https://example.com/old-ingest'
+        package.save()
+        mock_get_identifier.return_value = WellcomeIdentifier(
+            space='born-digital',
+            external_identifier=package.uuid,
+            internal_identifier=package.uuid,
+        )
+        mock_wellcome = mock_wellcome_client_class.return_value
+        mock_wellcome.create_s3_ingest.return_value = 'https://example.com/ingest'
+
         self.wellcome_object.move_from_storage_service(
             os.path.join(FIXTURES_DIR, 'small_compressed_bag.zip'),
             '/born-digital/bag.zip',
             package=package
         )
 
-        assert package.refresh_from_db.call_count == 1
+        package.refresh_from_db()
+        assert package.status == models.Package.STAGING
+        assert package.misc_attributes['wellcome.ingest_location'] == 'https://example.com/ingest'
+        assert not mock_wellcome.get_ingest_from_location.called
 
-    @mock.patch('time.sleep')
+    @mock.patch('locations.models.wellcome.get_wellcome_identifier')
     @mock.patch('locations.models.wellcome.StorageServiceClient')
-    def test_tries_fetching_ingest_if_no_callback(self, mock_wellcome_client_class, mock_sleep):
-        package = models.Package.objects.get(uuid="6465da4a-ea88-4300-ac56-9641125f1276")
-        package.current_path = "locations/fixtures/bag-6465da4a-ea88-4300-ac56-9641125f1276.zip"
-        package.status = models.Package.STAGING
-        package.save()
+    def test_keeps_status_of_early_callback(self, mock_wellcome_client_class, mock_get_identifier):
+        package = models.Package.objects.get(uuid=self.package_uuid)
+        mock_get_identifier.return_value = WellcomeIdentifier(
+            space='born-digital',
+            external_identifier=package.uuid,
+            internal_identifier=package.uuid,
+        )
 
-        storage_service_response = create_storage_service_response(status="succeeded")
-        storage_service_response["bag"]["info"]["externalIdentifier"] = "external-id"
-        storage_service_response["bag"]["info"]["version"] = "v3"
+        def create_s3_ingest(**kwargs):
+            # The callback completes the ingest before we record it
+            models.Package.objects.filter(uuid=package.uuid).update(
+                status=models.Package.UPLOADED
+            )
+            return 'https://example.com/ingest'
 
         mock_wellcome = mock_wellcome_client_class.return_value
-        mock_wellcome.get_ingest_from_location.return_value = storage_service_response
+        mock_wellcome.create_s3_ingest.side_effect = create_s3_ingest
 
         self.wellcome_object.move_from_storage_service(
             os.path.join(FIXTURES_DIR, 'small_compressed_bag.zip'),
@@ -182,128 +249,122 @@ class TestWellcomeMoveFromStorageService(WellcomeTestBase):
 
         package.refresh_from_db()
         assert package.status == models.Package.UPLOADED
-        assert package.current_path == 'bag-6465da4a-ea88-4300-ac56-9641125f1276.zip'
-        assert package.misc_attributes['wellcome.external_identifier'] == "6465da4a-ea88-4300-ac56-9641125f1276"
-        assert package.misc_attributes['wellcome.version'] == 'v3'
+        assert package.misc_attributes['wellcome.ingest_location'] == 'https://example.com/ingest'
 
-    @mock.patch("time.sleep")
-    @mock.patch("locations.models.wellcome.StorageServiceClient")
-    def test_tries_fetching_failed_ingest_if_no_callback(
-        self, mock_wellcome_client_class, mock_sleep
-    ):
-        package = models.Package.objects.get(
-            uuid="6465da4a-ea88-4300-ac56-9641125f1276"
-        )
-        path = "locations/fixtures/bag-6465da4a-ea88-4300-ac56-9641125f1276.zip"
-        package.current_path = path
+
+class TestWellcomeUpdatePackageStatus(WellcomeTestBase):
+
+    def get_staging_package(self):
+        package = models.Package.objects.get(uuid=self.package_uuid)
+        package.current_path = "locations/fixtures/bag-6465da4a-ea88-4300-ac56-9641125f1276.zip"
         package.status = models.Package.STAGING
+        package.misc_attributes['wellcome.ingest_location'] = 'https://example.com/ingest'
         package.save()
+        return package
 
-        storage_service_response = create_storage_service_response(status="failed")
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_completes_succeeded_ingest(self, mock_wellcome_client_class):
+        package = self.get_staging_package()
+        storage_service_response = create_storage_service_response(status="succeeded")
+        storage_service_response["bag"]["info"]["version"] = "v3"
         mock_wellcome = mock_wellcome_client_class.return_value
         mock_wellcome.get_ingest_from_location.return_value = storage_service_response
 
-        with pytest.raises(models.StorageException, match="Failed to store package"):
-            self.wellcome_object.move_from_storage_service(
-                src_path=os.path.join(FIXTURES_DIR, "small_compressed_bag.zip"),
-                dest_path="/born-digital/bag.zip",
-                package=package
-            )
+        status, _ = self.wellcome_object.update_package_status(package)
 
+        mock_wellcome.get_ingest_from_location.assert_called_with('https://example.com/ingest')
+        assert status == models.Package.UPLOADED
         package.refresh_from_db()
-        assert package.status == models.Package.FAIL
-
-    @mock.patch("time.sleep")
-    @mock.patch("locations.models.wellcome.StorageServiceClient")
-    def test_tries_fetching_unknown_ingest_if_no_callback(
-        self, mock_wellcome_client_class, mock_sleep
-    ):
-        package = models.Package.objects.get(
-            uuid="6465da4a-ea88-4300-ac56-9641125f1276"
-        )
-        path = "locations/fixtures/bag-6465da4a-ea88-4300-ac56-9641125f1276.zip"
-        package.current_path = path
-        package.status = models.Package.STAGING
-        package.save()
+        assert package.status == models.Package.UPLOADED
+        assert package.current_path == 'bag-6465da4a-ea88-4300-ac56-9641125f1276.zip'
+        assert package.misc_attributes['wellcome.version'] == 'v3'
 
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_completes_failed_ingest(self, mock_wellcome_client_class):
+        package = self.get_staging_package()
         mock_wellcome = mock_wellcome_client_class.return_value
+        mock_wellcome.get_ingest_from_location.return_value = create_storage_service_response(status="failed")
+
+        self.wellcome_object.update_package_status(package)
+
+        package.refresh_from_db()
+        assert package.status == models.Package.FAIL
 
-        # This mimics the case where Archivematica gets an unknown status
-        # from the Wellcome Storage, then later asks again and gets
-        # a "succeeded" ingest.
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_leaves_ingest_in_progress(self, mock_wellcome_client_class):
+        package = self.get_staging_package()
+        mock_wellcome = mock_wellcome_client_class.return_value
         mock_wellcome.get_ingest_from_location.side_effect = [
-            create_storage_service_response(status="unknown"),
+            create_storage_service_response(status="processing"),
             create_storage_service_response(status="succeeded"),
         ]
 
-        self.wellcome_object.move_from_storage_service(
-            src_path=os.path.join(FIXTURES_DIR, "small_compressed_bag.zip"),
-            dest_path="/born-digital/bag.zip",
-            package=package
-        )
+        status, _ = self.wellcome_object.update_package_status(package)
+        assert status == models.Package.STAGING
+        package.refresh_from_db()
+        assert package.status == models.Package.STAGING
 
+        self.wellcome_object.update_package_status(package)
         package.refresh_from_db()
         assert package.status == models.Package.UPLOADED
 
-    @mock.patch('time.sleep')
     @mock.patch('locations.models.wellcome.StorageServiceClient')
-    def test_raises_exception_on_ingest_failure(self, mock_wellcome_client_class, mock_sleep):
-        package = models.Package.objects.get(uuid="6465da4a-ea88-4300-ac56-9641125f1276")
-        package.status = models.Package.STAGING
-        package.save()
+    def test_ignores_package_without_ingest(self, mock_wellcome_client_class):
+        package = models.Package.objects.get(uuid=self.package_uuid)
 
-        # Simulate the callback
-        def set_package_to_fail(*args):
-            package.status = models.Package.FAIL
-            package.save()
-        package.refresh_from_db = mock.Mock(side_effect=set_package_to_fail)
+        status, _ = self.wellcome_object.update_package_status(package)
 
-        with pytest.raises(models.StorageException):
-            self.wellcome_object.move_from_storage_service(
-                os.path.join(FIXTURES_DIR, 'small_compressed_bag.zip'),
-                '/born-digital/bag.zip',
-                package=package
-            )
+        assert status == package.status
+        assert not mock_wellcome_client_class.return_value.get_ingest_from_location.called
 
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_reconcile_command(self, mock_wellcome_client_class):
+        self.get_staging_package()
+        mock_wellcome = mock_wellcome_client_class.return_value
+        mock_wellcome.get_ingest_from_location.return_value = create_storage_service_response(status="succeeded")
 
-class TestWellcomeMoveToStorageService(WellcomeTestBase):
+        call_command('reconcile_wellcome_ingests', stdout=StringIO())
+
+        package = models.Package.objects.get(uuid=self.package_uuid)
+        assert package.status == models.Package.UPLOADED
+
+
+class TestWellcomeClient(WellcomeTestBase):
 
-    @mock_s3
     @mock.patch('locations.models.wellcome.StorageServiceClient')
-    @mock.patch('subprocess.check_call')
-    def test_copies_files_from_ia_provider(self, mock_call, mock_wellcome_client_class):
-        package = self.get_package()
-        package.misc_attributes["wellcome.version"] = "v3"
-        package.misc_attributes["wellcome.space"] = "name-of-space"
-        package.misc_attributes["wellcome.external_identifier"] = "bag-id"
+    def test_client_is_shared(self, mock_wellcome_client_class):
+        client = self.wellcome_object.wellcome_client
+        other = models.WellcomeStorageService.objects.get(id=1)
 
-        self._s3.create_bucket(Bucket='ia-bucket')
-        self._s3.upload_fileobj(StringIO("file contents"), 'ia-bucket', 'bucket-subdir/bag-id/v3/data/file1')
+        assert other.wellcome_client is client
+        mock_wellcome_client_class.assert_called_once_with(
+            api_url=self.wellcome_object.api_root_url,
+            token_url=self.wellcome_object.token_url,
+            client_id=self.wellcome_object.app_client_id,
+            client_secret=self.wellcome_object.app_client_secret,
+        )
 
-        mock_wellcome = mock_wellcome_client_class.return_value
-        mock_wellcome.get_bag.return_value = {
-            'location': {
-                'bucket': 'ia-bucket',
-                'path': 'bucket-subdir/bag-id',
-                'provider': {
-                    'id': 'aws-s3-ia',
-                }
-            },
-            'manifest': {
-                'files': [
-                    {
-                        'name': 'data/file1',
-                        'path': 'v3/data/file1',
-                        'size': 13,
-                    }
-                ]
-            },
-            'tagManifest': {
-                'files': []
-            },
-            'version': 'v3',
-        }
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_new_client_if_settings_change(self, mock_wellcome_client_class):
+        mock_wellcome_client_class.side_effect = lambda **kwargs: mock.Mock()
+        client = self.wellcome_object.wellcome_client
+
+        self.wellcome_object.app_client_secret = 'new-secret'
+
+        assert self.wellcome_object.wellcome_client is not client
+        assert mock_wellcome_client_class.call_count == 2
+
+
+class TestWellcomeMoveToStorageService(WellcomeTestBase):
 
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_downloads_bag_to_tar_gz(self, mock_wellcome_client_class):
+        self.wellcome_object.s3_max_concurrency = 2
+        files = [('bagit.txt', 'BagIt-Version: 0.97\n')] + [
+            ('data/dir%d/file%d' % (i % 2, i), 'file contents %d' % i) for i in range(5)
+        ]
+        mock_wellcome = mock_wellcome_client_class.return_value
+        mock_wellcome.get_bag.return_value = self.create_bag(files)
 
         src_path = '/name-of-space/name-bag-id.tar.gz'
         dest_path = os.path.join(self.tmp_dir, 'name-bag-id.tar.gz')
@@ -311,56 +372,30 @@ class TestWellcomeMoveToStorageService(WellcomeTestBase):
             src_path,
             dest_path,
             'space-uuid',
-            package=package,
+            package=self.get_bag_package(),
         )
 
-        mock_wellcome.get_bag.assert_called_with(space_id='name-of-space', source_id='bag-id', version='v3')
-        mock_call.assert_called_with([
-            'python',
-            '-c',
-            mock.ANY,
-            mock.ANY,
-            dest_path,
-            'name-bag-id',
-        ], stderr=subprocess.STDOUT)
-        assert json.loads(mock_call.call_args[0][0][3]) == mock_wellcome.get_bag.return_value
+        mock_wellcome.get_bag.assert_called_with(space='name-of-space', external_identifier='bag-id', version='v3')
+        with tarfile.open(dest_path) as tar:
+            names = tar.getnames()
+            contents = {
+                member.name: tar.extractfile(member).read()
+                for member in tar.getmembers() if member.isfile()
+            }
+        assert contents == {'name-bag-id/' + name: data for name, data in files}
+        # Files are in the order of the manifest then the tag manifest,
+        # after their directories
+        assert names == [
+            'name-bag-id', 'name-bag-id/data', 'name-bag-id/data/dir0', 'name-bag-id/data/dir0/file0',
+            'name-bag-id/data/dir1', 'name-bag-id/data/dir1/file1',
+            'name-bag-id/data/dir0/file2', 'name-bag-id/data/dir1/file3',
+            'name-bag-id/data/dir0/file4', 'name-bag-id/bagit.txt',
+        ]
 
-    @mock_s3
     @mock.patch('locations.models.wellcome.StorageServiceClient')
-    @mock.patch('subprocess.check_call')
-    def test_supports_path_containing_uuid(self, mock_call, mock_wellcome_client_class):
-        package = self.get_package()
-        package.misc_attributes["wellcome.version"] = "v3"
-        package.misc_attributes["wellcome.space"] = "name-of-space"
-        package.misc_attributes["wellcome.external_identifier"] = "bag-id"
-
-        self._s3.create_bucket(Bucket='ia-bucket')
-        self._s3.upload_fileobj(StringIO("file contents"), 'ia-bucket', 'bucket-subdir/bag-id/v3/data/file1')
-
+    def test_supports_path_containing_uuid(self, mock_wellcome_client_class):
         mock_wellcome = mock_wellcome_client_class.return_value
-        mock_wellcome.get_bag.return_value = {
-            'location': {
-                'bucket': 'ia-bucket',
-                'path': 'bucket-subdir/bag-id',
-                'provider': {
-                    'id': 'aws-s3-ia',
-                },
-            },
-            'manifest': {
-                'files': [
-                    {
-                        'name': 'data/file1',
-                        'path': 'v3/data/file1',
-                        'size': 13,
-                    }
-                ]
-            },
-            'tagManifest': {
-                'files': []
-            },
-            'version': 'v3',
-        }
-
+        mock_wellcome.get_bag.return_value = self.create_bag([('bagit.txt', 'bagit'), ('data/file1', 'file contents')])
 
         src_path = '/name-of-space/aaaa/bbbb/cccc/dddd/eeee/ffff/gggg/hhhh/name-bag-id.tar.gz'
         dest_path = os.path.join(self.tmp_dir, 'aaaa/bbbb/cccc/dddd/eeee/ffff/gggg/hhhh/name-bag-id.tar.gz')
@@ -368,10 +403,107 @@ class TestWellcomeMoveToStorageService(WellcomeTestBase):
             src_path,
             dest_path,
             'space-uuid',
-            package=package,
+            package=self.get_bag_package(),
         )
 
-        mock_wellcome.get_bag.assert_called_with(space_id='name-of-space', source_id='bag-id', version='v3')
+        mock_wellcome.get_bag.assert_called_with(space='name-of-space', external_identifier='bag-id', version='v3')
+        with tarfile.open(dest_path) as tar:
+            assert tar.extractfile('name-bag-id/data/file1').read() == 'file contents'
+
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_checksum_mismatch(self, mock_wellcome_client_class):
+        bag = self.create_bag([('bagit.txt', 'bagit'), ('data/file1', 'file contents')])
+        bag['manifest']['files'][0]['checksum'] = hashlib.sha256('other contents').hexdigest()
+        mock_wellcome_client_class.return_value.get_bag.return_value = bag
+
+        dest_path = os.path.join(self.tmp_dir, 'name-bag-id.tar.gz')
+        with pytest.raises(models.StorageException) as excinfo:
+            self.wellcome_object.move_to_storage_service(
+                '/name-of-space/name-bag-id.tar.gz',
+                dest_path,
+                'space-uuid',
+                package=self.get_bag_package(),
+            )
+
+        assert 'Checksum mismatch for bucket-subdir/bag-id/v3/data/file1' in str(excinfo.value)
+        assert not os.path.exists(dest_path)
+
+
+class TestWellcomeCheckPackageFixity(WellcomeTestBase):
+
+    def setUp(self):
+        super(TestWellcomeCheckPackageFixity, self).setUp()
+        self.package = self.get_bag_package()
+        self.bag = self.create_bag([
+            ('bagit.txt', 'bagit'),
+            ('data/file1', 'file contents 1'),
+            ('data/file2', 'file contents 2'),
+        ])
+        self.bag['createdDate'] = '2019-05-06T07:08:09.123Z'
+
+    def check_package_fixity(self, mock_wellcome_client_class):
+        mock_wellcome_client_class.return_value.get_bag.return_value = self.bag
+        return self.wellcome_object.check_package_fixity(self.package)
+
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_checks_storage_manifest(self, mock_wellcome_client_class):
+        # Nothing is read from S3
+        self.bag['location']['bucket'] = 'missing-bucket'
+
+        result = self.check_package_fixity(mock_wellcome_client_class)
+
+        assert result == (True, [], "", "2019-05-06T07:08:09.123000+00:00")
+        mock_wellcome_client_class.return_value.get_bag.assert_called_with(
+            space='name-of-space', external_identifier='bag-id', version='v3')
+
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_fails_for_other_version(self, mock_wellcome_client_class):
+        self.bag['version'] = 'v2'
+
+        success, failures, message, _ = self.check_package_fixity(mock_wellcome_client_class)
+
+        assert success is False
+        assert message == "Expected version v3 of the bag, found v2"
+
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_fails_for_files_without_checksum(self, mock_wellcome_client_class):
+        del self.bag['manifest']['files'][0]['checksum']
+
+        success, failures, message, _ = self.check_package_fixity(mock_wellcome_client_class)
+
+        assert success is False
+        assert message == "Files without checksum in the storage manifest: data/file1"
+
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_fails_if_bag_not_found(self, mock_wellcome_client_class):
+        mock_wellcome_client_class.return_value.get_bag.side_effect = BagNotFound()
+
+        success, failures, message, timestamp = self.wellcome_object.check_package_fixity(self.package)
+
+        assert (success, failures, timestamp) == (False, [], None)
+        assert message == "Package not found: name-of-space/bag-id"
+
+    def test_not_implemented_without_wellcome_identifier(self):
+        package = self.get_package()
+        with pytest.raises(NotImplementedError):
+            self.wellcome_object.check_package_fixity(package)
+
+    @override_settings(WELLCOME_FIXITY_SAMPLE_SIZE=10)
+    @mock.patch('locations.models.wellcome.StorageServiceClient')
+    def test_verifies_sampled_files(self, mock_wellcome_client_class):
+        assert self.check_package_fixity(mock_wellcome_client_class)[0] is True
+
+        self._s3.upload_fileobj(StringIO("changed"), 'ia-bucket', 'bucket-subdir/bag-id/v3/data/file1')
+        self._s3.delete_object(Bucket='ia-bucket', Key='bucket-subdir/bag-id/v3/data/file2')
+
+        success, failures, message, _ = self.check_package_fixity(mock_wellcome_client_class)
+
+        assert success is False
+        assert sorted((type(f).__name__, f.path) for f in failures) == [
+            ('ChecksumMismatch', 'data/file1'),
+            ('FileMissing', 'data/file2'),
+        ]
+        assert message.startswith("Bag validation failed: ")
 
 
 # TODO: It would be nice to have some end-to-end tests for this functionality.
@@ -542,3 +674,120 @@ def test_extract_dc_identifiers(mets_xml, expected_identifiers):
 def test_extract_accession_identifiers(mets_xml, expected_identifiers):
     tree = etree.fromstring(mets_xml.strip())
     assert list(extract_accession_identifiers(tree)) == expected_identifiers
+
+
+def make_compressed_bag(tmpdir, package_uuid, mets_lines, transfer_mets_lines):
+    bag_dir = tmpdir.mkdir("bag-%s" % package_uuid)
+    objects_dir = bag_dir.mkdir("objects")
+    objects_dir.join("file.txt").write("payload")
+    bag_dir.join("METS.%s.xml" % package_uuid).write("\n".join(mets_lines))
+    objects_dir.mkdir("submissionDocumentation").mkdir("transfer-1234").join(
+        "METS.xml").write("\n".join(transfer_mets_lines))
+    bagit.make_bag(str(bag_dir), {"External-Identifier": package_uuid},
+                   checksums=["md5", "sha256"])
+
+    tar_path = str(tmpdir.join("bag-%s.tar.gz" % package_uuid))
+    with tarfile.open(tar_path, "w:gz") as tar:
+        tar.add(str(bag_dir), arcname="bag-%s" % package_uuid)
+    return tar_path
+
+
+def extract_bag(tar_path, tmpdir):
+    out_dir = tmpdir.mkdir("out")
+    with tarfile.open(tar_path) as tar:
+        tar.extractall(str(out_dir))
+    bag_dirs = out_dir.listdir()
+    assert len(bag_dirs) == 1
+    return bagit.Bag(str(bag_dirs[0]))
+
+
+def test_get_wellcome_identifier_rewrites_bag_info(tmpdir):
+    package_uuid = str(uuid.uuid4())
+    tar_path = make_compressed_bag(
+        tmpdir, package_uuid,
+        mets_lines=[
+            "<mets:mets>",
+            "  <dc:identifier>PPMIA/1/2</dc:identifier>",
+            "  <dc:identifier>PPMIA/1/3</dc:identifier>",
+            "</mets:mets>",
+        ],
+        transfer_mets_lines=["<mets:mets/>"],
+    )
+
+    identifier = get_wellcome_identifier(tar_path, package_uuid, "born-digital")
+
+    assert identifier.space == "born-digital"
+    assert identifier.external_identifier == "PPMIA/1"
+    assert identifier.internal_identifier == package_uuid
+    assert not os.path.exists(tar_path + ".tmp")
+    bag = extract_bag(tar_path, tmpdir)
+    bag.validate()
+    assert bag.info["External-Identifier"] == "PPMIA/1"
+    assert bag.info["Internal-Sender-Identifier"] == package_uuid
+    assert "Payload-Oxum" in bag.info
+
+
+def test_get_wellcome_identifier_uses_accession_numbers(tmpdir):
+    package_uuid = str(uuid.uuid4())
+    tar_path = make_compressed_bag(
+        tmpdir, package_uuid,
+        mets_lines=["<mets:mets/>"],
+        # The last line has no trailing newline
+        transfer_mets_lines=[
+            "<mets:mets>",
+            '<mets:altRecordID TYPE="Accession ID">LEMON/1234</mets:altRecordID>',
+        ],
+    )
+
+    identifier = get_wellcome_identifier(tar_path, package_uuid, "born-digital")
+
+    assert identifier.space == "born-digital-accessions"
+    assert identifier.external_identifier == "LEMON/1234"
+    extract_bag(tar_path, tmpdir).validate()
+
+
+def test_get_wellcome_identifier_preserves_bag_without_identifier(tmpdir):
+    package_uuid = str(uuid.uuid4())
+    tar_path = make_compressed_bag(
+        tmpdir, package_uuid, mets_lines=[], transfer_mets_lines=[])
+    with open(tar_path, "rb") as f:
+        original = f.read()
+
+    with pytest.raises(NoWellcomeIdentifierFound):
+        get_wellcome_identifier(tar_path, package_uuid, "born-digital")
+
+    with open(tar_path, "rb") as f:
+        assert f.read() == original
+    assert not os.path.exists(tar_path + ".tmp")
+
+
+def test_update_tag_manifest():
+    content = b"abc  bagit.txt\nold  bag-info.txt\n"
+    assert update_tag_manifest(content, "md5", {"bag-info.txt": b"info"}) == (
+        b"abc  bagit.txt\n%s  bag-info.txt\n" % hashlib.md5(b"info").hexdigest().encode()
+    )
+
+
+def test_update_bag_info():
+    content = (
+        b"Bag-Software-Agent: bagit.py\n"
+        b"External-Identifier: old\n"
+        b"  continued\n"
+        b"Payload-Oxum: 7.1\n"
+    )
+    assert update_bag_info(content, {"External-Identifier": "new"}) == (
+        b"Bag-Software-Agent: bagit.py\n"
+        b"Payload-Oxum: 7.1\n"
+        b"External-Identifier: new\n"
+    )
+
+
+def test_get_wellcome_identifier_fails_for_invalid_tar_gz(tmpdir):
+    tar_path = tmpdir.join("bag.tar.gz")
+    tar_path.write("not gzipped")
+
+    with pytest.raises(NoWellcomeIdentifierFound):
+        get_wellcome_identifier(str(tar_path), str(uuid.uuid4()), "born-digital")
+
+    assert tar_path.read() == "not gzipped"
+    assert not tmpdir.join("bag.tar.gz.tmp").exists()
@@ -528,8 +528,35 @@ try:
 except ValueError:
     BAG_VALIDATION_NO_PROCESSES = 1
 
+# Number of files of a bag, picked at random, that are read from S3 and
+# checked against the storage manifest when checking the fixity of a package
+# stored in the Wellcome Storage. By default only the manifest is checked.
+try:
+    WELLCOME_FIXITY_SAMPLE_SIZE = int(environ.get("SS_WELLCOME_FIXITY_SAMPLE_SIZE", 0))
+except ValueError:
+    WELLCOME_FIXITY_SAMPLE_SIZE = 0
+
+# Number of rsync processes used to move a local directory, each given a
+# share of its files, and the number of times an rsync that fails with a
+# network error is retried (resuming any partially transferred file).
+try:
+    RSYNC_WORKERS = int(environ.get("SS_RSYNC_WORKERS", 1))
+except ValueError:
+    RSYNC_WORKERS = 1
+try:
+    RSYNC_RETRIES = int(environ.get("SS_RSYNC_RETRIES", 2))
+except ValueError:
+    RSYNC_RETRIES = 2
+
 GNUPG_HOME_PATH = environ.get("SS_GNUPG_HOME_PATH", None)
 
+# Number of segments of a package encrypted or decrypted at the same time in
+# GPG spaces with a segment size. Each of them is held in memory.
+try:
+    GPG_SEGMENTS_IN_FLIGHT = max(int(environ.get("SS_GPG_SEGMENTS_IN_FLIGHT", 4)), 1)
+except ValueError:
+    GPG_SEGMENTS_IN_FLIGHT = 4
+
 # SS uses a Python HTTP library called requests. If this setting is set to True,
 # we will skip the SSL certificate verification process. Read more here:
 # http://docs.python-requests.org/en/master/user/advanced/#ssl-cert-verification